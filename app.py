@@ -1,25 +1,47 @@
+import importlib
 import streamlit as st
 from core.firebase import init_firebase, get_db
 from core.auth import ensure_admin_seed, get_current_user, login_form, signup_form, admin_users_page
-from modules.common import header, change_password_page
-from modules import settings as page_settings
-from modules import dashboard_admin, dashboard_operator, agreements_create, agreements_list, receipts_review, agreement_edit
+from modules.common import header, change_password_page, debug_panel, rerun_scope
+from core import metrics, resilience, tracing
+from services.agreements import list_agreements_for_role
+from services.installments import list_installments
+from services.jobs import get_runner
+from services.outbox import resume_outbox
+import time
+
+BADGE_TTL_SECONDS = 60   # contadores del menú cambiados por otros usuarios tardan a lo sumo esto
+
+def _page(name):
+    # Las páginas (y sus dependencias pesadas: reportlab, pandas, PIL) se importan al usarlas por primera vez
+    return importlib.import_module(f"modules.{name}")
 
 def get_pendientes_comprobantes(db, user):
     count = 0
-    for ag_doc in db.collection("agreements").where("operator_id","==",user["uid"]).stream():
-        items = list(ag_doc.reference.collection("installments").where("receipt_status","==","PENDING").stream())
+    for ag_doc in list_agreements_for_role(db, user):
+        items = [it for it in list_installments(db, ag_doc) if it.to_dict().get("receipt_status") == "PENDING"]
         count += len(items)
     return count
 
 def get_pendientes_convenios_cliente(db, user):
     count = 0
-    for ag_doc in db.collection("agreements").where("client_email","==",user["email"]).stream():
+    for ag_doc in list_agreements_for_role(db, user):
         ag = ag_doc.to_dict()
         if ag.get("status") == "PENDING_ACCEPTANCE":
             count += 1
     return count
 
+def get_badges(db, user):
+    # Un rerun completo no vuelve a recorrer todos los convenios: se cachean por
+    # sesión y se recalculan al vencer o cuando una acción propia los invalida
+    cached = st.session_state.get("_badges")
+    if cached and cached[0] == user.get("uid") and time.monotonic() - cached[1] < BADGE_TTL_SECONDS:
+        return cached[2]
+    counts = (get_pendientes_comprobantes(db, user) if user.get("role")=="operador" else 0,
+              get_pendientes_convenios_cliente(db, user) if user.get("role")=="cliente" else 0)
+    st.session_state["_badges"] = (user.get("uid"), time.monotonic(), counts)
+    return counts
+
 st.set_page_config(page_title="Asistente de Convenios de Pago", page_icon="💳", layout="wide")
 
 # --- Cabecera visual ---
@@ -37,10 +59,18 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 def main():
+    with rerun_scope(), tracing.span("streamlit.rerun", uid=st.session_state.get("uid")), resilience.budget():
+        _main()
+
+def _main():
     init_firebase()
     db = get_db()
-    db.collection("health").document("warmup").set({"ok": True})
+    if not st.session_state.get("_warmup"):
+        db.collection("health").document("warmup").set({"ok": True})
+        st.session_state["_warmup"] = True
     ensure_admin_seed(db)
+    get_runner(db)   # retoma tareas pendientes tras un reinicio
+    resume_outbox()  # y las notificaciones que no llegaron a enviarse
     user = get_current_user(db)
     if not user:
         tab_login, tab_signup = st.tabs(["Iniciar sesión", "Registrarme"])
@@ -49,15 +79,14 @@ def main():
         st.stop()
     header(user)
 
-    pendientes = get_pendientes_comprobantes(db, user) if user.get("role")=="operador" else 0
-    pendientes_cliente = get_pendientes_convenios_cliente(db, user) if user.get("role")=="cliente" else 0
+    pendientes, pendientes_cliente = get_badges(db, user)
     menu = []
     if user.get("role")=="admin":
-        menu += ["🗂️ Panel (admin)", "⚙️ Configuración"]
+        menu += ["🗂️ Panel (admin)", "📈 Analítica (admin)", "🧵 Tareas (admin)", "⚙️ Configuración"]
     if user.get("role")=="operador":
         menu += ["📊 Panel (operador)", f"📥 Comprobantes ({pendientes})"]
     if user.get("role") in ["admin","operador"]:
-        menu += ["📝 Crear convenio"]
+        menu += ["🏦 Conciliación", "📝 Crear convenio"]
     menu += ["📄 Mis convenios"]
     if user.get("role")=="cliente" and pendientes_cliente > 0:
         menu += [f"⏳ Convenios por aceptar ({pendientes_cliente})"]
@@ -74,18 +103,31 @@ def main():
         st.markdown('</div>', unsafe_allow_html=True)
 
     # --- Mapping del menú ---
+    metrics.set_page(choice)
+    tracing.set_attrs(page=choice, role=user.get("role"))
+    with tracing.span("page.render", page=choice):
+        _render(db, user, choice)
+    debug_panel(user)
+
+def _render(db, user, choice):
     if choice.endswith("Panel (admin)"):
-        dashboard_admin.render(db)
+        _page("dashboard_admin").render(db)
+    elif choice.endswith("Analítica (admin)"):
+        _page("analytics_admin").render(db)
+    elif choice.endswith("Tareas (admin)"):
+        _page("jobs_admin").render(db)
     elif choice.endswith("Panel (operador)"):
-        dashboard_operator.render(db, user)
+        _page("dashboard_operator").render(db, user)
     elif choice.endswith("Configuración"):
-        page_settings.render(db)
+        _page("settings").render(db)
     elif choice.endswith("Crear convenio"):
-        agreements_create.render(db, user)
+        _page("agreements_create").render(db, user)
     elif choice.startswith("📥 Comprobantes"):
-        receipts_review.render(db, user)
+        _page("receipts_review").render(db, user)
+    elif choice.endswith("Conciliación"):
+        _page("reconciliation").render(db, user)
     elif choice.startswith("📄 Mis convenios") or choice.startswith("⏳ Convenios por aceptar"):
-        agreements_list.render(db, user)
+        _page("agreements_list").render(db, user)
     elif choice.endswith("Mi contraseña"):
         change_password_page(user)
     elif choice.endswith("Usuarios (admin)"):
@@ -93,7 +135,7 @@ def main():
     elif choice.endswith("Modificar convenio"):
         ag_id = st.session_state.get("edit_agreement_id")
         ag_doc = db.collection("agreements").document(ag_id).get() if ag_id else None
-        agreement_edit.render(db, user, ag_doc)
+        _page("agreement_edit").render(db, user, ag_doc)
 
 if __name__=="__main__":
     main()
@@ -3,9 +3,10 @@ import requests
 import re
 import secrets
 import string
-from firebase_admin import auth as admin_auth
 from google.cloud import firestore
+from core.firebase import backend
 from core.mail import send_email, send_email_admins
+from core import loader, resilience
 
 APP_URL = None
 EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
@@ -19,6 +20,14 @@ def _app_url():
         APP_URL = st.secrets.get("APP_BASE_URL", "https://example.com")
     return APP_URL
 
+def _accounts():
+    # Con DB_BACKEND=sqlite las cuentas viven en la base local (sin Firebase Auth)
+    if backend() == "sqlite":
+        from core import local_auth
+        return local_auth
+    from firebase_admin import auth as admin_auth
+    return admin_auth
+
 def _valid_email(email: str) -> bool:
     return bool(EMAIL_RE.match(email or ""))
 
@@ -26,10 +35,23 @@ def _valid_password(pwd: str) -> bool:
     return isinstance(pwd, str) and len(pwd) >= 6
 
 def firebase_sign_in(email: str, password: str):
+    if backend() == "sqlite":
+        from core import local_auth
+        uid, code = local_auth.sign_in(email, password)
+        if uid:
+            return {"localId": uid, "email": email}
+        st.error("Tu usuario está deshabilitado." if code == "USER_DISABLED" else "Email o contraseña incorrectos.")
+        return None
     url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={_api_key()}"
     payload = {"email": email, "password": password, "returnSecureToken": True}
     try:
-        r = requests.post(url, json=payload, timeout=15)
+        # 4xx (clave incorrecta, usuario deshabilitado) es una respuesta válida; solo 5xx o red cuentan como falla
+        r = resilience.call("identity_toolkit", requests.post, url, json=payload, timeout=8.0, retries=1,
+                            retry_on=(requests.ConnectionError, requests.Timeout),
+                            is_failure=lambda r: r.status_code >= 500)
+    except resilience.Unavailable:
+        st.error("El servicio de autenticación no responde. Intentá de nuevo en unos segundos.")
+        return None
     except requests.RequestException:
         st.error("No se pudo contactar el servicio de autenticación. Intentá de nuevo.")
         return None
@@ -50,7 +72,7 @@ def firebase_sign_in(email: str, password: str):
 def get_current_user(db: firestore.Client):
     uid = st.session_state.get("uid")
     if not uid: return None
-    doc = db.collection("users").document(uid).get()
+    doc = loader.current().get(db.collection("users").document(uid))
     return {"uid": uid, **doc.to_dict()} if doc.exists else None
 
 def login_form(db: firestore.Client):
@@ -91,13 +113,13 @@ def signup_form(db: firestore.Client):
             st.error("Ingresá un email válido y una contraseña de al menos 6 caracteres.")
             return
         try:
-            _ = admin_auth.get_user_by_email(email)
+            _ = _accounts().get_user_by_email(email)
             st.error("Ya existe un usuario con ese email.")
             return
         except Exception:
             pass
         try:
-            user = admin_auth.create_user(email=email, password=password)
+            user = _accounts().create_user(email=email, password=password)
         except Exception as e:
             st.error("No se pudo crear el usuario.")
             st.exception(e)
@@ -131,7 +153,7 @@ def ensure_admin_seed(db: firestore.Client):
     if ok:
         if not _valid_email(email) or not _valid_password(pwd):
             st.error("Ingresá email válido y contraseña (>= 6)."); st.stop()
-        user = admin_auth.create_user(email=email, password=pwd)
+        user = _accounts().create_user(email=email, password=pwd)
         db.collection("users").document(user.uid).set({
             "email": email, "full_name": name, "role": "admin", "status": "APPROVED"
         })
@@ -142,7 +164,7 @@ def role_badge(role: str) -> str:
     return {"admin":"⭐ Admin","operador":"🧰 Operador","cliente":"👤 Cliente"}.get(role, role)
 
 def change_password(uid: str, new_password: str):
-    admin_auth.update_user(uid, password=new_password)
+    _accounts().update_user(uid, password=new_password)
 
 def _gen_temp_password(n=12):
     alphabet = string.ascii_letters + string.digits
@@ -163,7 +185,7 @@ def admin_users_page(db: firestore.Client, user_admin):
                 st.error("Ingresá email válido y contraseña (>=6).")
             else:
                 try:
-                    u = admin_auth.create_user(email=email, password=temp_pwd)
+                    u = _accounts().create_user(email=email, password=temp_pwd)
                     db.collection("users").document(u.uid).set({
                         "email": email, "full_name": full_name, "role": role, "status": "APPROVED"
                     })
@@ -181,14 +203,13 @@ def admin_users_page(db: firestore.Client, user_admin):
         cols[2].write(f"{role_badge(u.get('role'))} · {u.get('status','')}")
         if cols[3].button("Reset clave", key=f"reset_{d.id}"):
             temp = _gen_temp_password()
-            admin_auth.update_user(d.id, password=temp)
-            try:
-                send_email(u.get("email"), "Restablecimiento de contraseña",
-                    f"Hola, {u.get('full_name') or ''}. Tu nueva contraseña temporal es: <b>{temp}</b>.")
+            _accounts().update_user(d.id, password=temp)
+            if send_email(u.get("email"), "Restablecimiento de contraseña",
+                    f"Hola, {u.get('full_name') or ''}. Tu nueva contraseña temporal es: <b>{temp}</b>."):
                 st.success("Contraseña temporal enviada por email.")
-            except Exception:
+            else:
                 st.warning("No se pudo enviar por email.")
         if d.id != user_admin["uid"] and cols[4].button("Eliminar", key=f"del_{d.id}"):
-            try: admin_auth.delete_user(d.id)
+            try: _accounts().delete_user(d.id)
             except Exception: pass
             d.reference.delete(); st.warning("Usuario eliminado."); st.rerun()
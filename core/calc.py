@@ -1,58 +1,108 @@
+import os
 from datetime import date
-from typing import List, Dict
+from decimal import Decimal
+from typing import List, Dict, Tuple
+
+def _get(name, default=None):
+    try:
+        import streamlit as st
+        val = st.secrets.get(name, None)
+        if val is not None:
+            return val
+    except Exception:
+        pass
+    return os.environ.get(name, default)
+
+HALF_EVEN, HALF_UP = "half_even", "half_up"
+ROUNDING = _get("CALC_ROUNDING", HALF_EVEN)   # redondeo a centavos: half_even (bancario) o half_up
+
+# Los cronogramas se calculan en centavos enteros: el principal y la tasa se
+# convierten una vez a enteros/fracción exacta (desde su representación
+# decimal) y cada interés es un cociente entero redondeado según ROUNDING. Sin
+# redondeos de float intermedios, el saldo cierra exacto: la última cuota se
+# lleva el remanente y, si la cuota fija agota el saldo antes, las siguientes
+# solo pagan lo que queda (la suma de capital es siempre el principal).
+
+_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
 
 def add_months(d: date, months: int) -> date:
     month = d.month - 1 + months
     year = d.year + month // 12
     month = month % 12 + 1
-    day = min(d.day, [31,
-                      29 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 28,
-                      31, 30, 31, 30, 31, 31, 30, 31, 30, 31][month-1])
-    return date(year, month, day)
+    last = 29 if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else _DAYS[month - 1]
+    return date(year, month, min(d.day, last))
 
 def iso(d: date) -> str:
-    return d.strftime("%Y-%m-%d")
+    return d.isoformat()
+
+def _div(a: int, b: int, rounding: str) -> int:
+    # a / b redondeado a entero (b > 0)
+    q, rem = divmod(a, b)
+    twice = 2 * rem
+    if twice > b or (twice == b and (rounding == HALF_UP or q % 2)):
+        return q + 1
+    return q
+
+def _ratio(x) -> Tuple[int, int]:
+    # Fracción exacta del valor decimal que se ve (0.05 -> 1/20, no el binario del float)
+    return Decimal(repr(float(x))).as_integer_ratio()
+
+def to_cents(amount, rounding: str = None) -> int:
+    num, den = _ratio(amount)
+    return _div(num * 100, den, rounding or ROUNDING)
 
-def schedule_declining(principal: float, r: float, n: int, start_date: date) -> List[Dict]:
-    cap_fixed = round(principal / n, 2)
-    saldo = round(principal, 2)
-    items: List[Dict] = []
+def declining_cents(principal: int, r, n: int, rounding: str = None) -> List[Tuple[int, int, int]]:
+    # -> [(capital, interés, total)] en centavos; capital fijo e interés sobre saldo
+    rounding = rounding or ROUNDING
+    num, den = _ratio(r)
+    cap_fixed = _div(principal, n, rounding)
+    saldo, rows = principal, []
     for i in range(1, n + 1):
-        interest = round(saldo * r, 2)
-        capital = cap_fixed if i < n else round(saldo, 2)
-        total = round(capital + interest, 2)
-        due = add_months(start_date, i - 1)
-        items.append({"number": i, "due_date": iso(due),
-                      "capital": capital, "interest": interest, "total": total})
-        saldo = max(0.0, round(saldo - capital, 2))
-    if saldo != 0:
-        last = items[-1]; adjust = round(saldo, 2)
-        last["capital"] = round(last["capital"] + adjust, 2)
-        last["total"] = round(last["capital"] + last["interest"], 2)
-    return items
-
-def schedule_french(principal: float, r: float, n: int, start_date: date) -> List[Dict]:
-    if r == 0:
-        cuota = round(principal / n, 2)
-    else:
-        cuota = round(principal * (r / (1 - (1 + r) ** (-n))), 2)
+        interest = _div(saldo * num, den, rounding)
+        capital = min(cap_fixed, saldo) if i < n else saldo
+        rows.append((capital, interest, capital + interest))
+        saldo -= capital
+    return rows
 
-    saldo = round(principal, 2)
-    items: List[Dict] = []
+def french_cents(principal: int, r, n: int, rounding: str = None) -> List[Tuple[int, int, int]]:
+    # -> [(capital, interés, total)] en centavos; cuota fija P·r / (1 - (1+r)^-n) calculada exacta
+    rounding = rounding or ROUNDING
+    num, den = _ratio(r)
+    if num == 0:
+        cuota = _div(principal, n, rounding)
+    else:
+        grow = (den + num) ** n
+        cuota = _div(principal * num * grow, den * (grow - den ** n), rounding)
+    saldo, rows = principal, []
     for i in range(1, n + 1):
-        interest = round(saldo * r, 2)
-        if i < n:
-            capital = round(cuota - interest, 2)
-            total_i = cuota
-        else:
-            capital = round(saldo, 2)
-            total_i = round(capital + interest, 2)
-        due = add_months(start_date, i - 1)
-        items.append({"number": i, "due_date": iso(due),
-                      "capital": capital, "interest": interest, "total": total_i})
-        saldo = max(0.0, round(saldo - capital, 2))
-    if saldo != 0:
-        last = items[-1]; adjust = round(saldo, 2)
-        last["capital"] = round(last["capital"] + adjust, 2)
-        last["total"] = round(last["capital"] + last["interest"], 2)
-    return items
+        interest = _div(saldo * num, den, rounding)
+        capital = min(cuota - interest, saldo) if i < n else saldo
+        rows.append((capital, interest, capital + interest))
+        saldo -= capital
+    return rows
+
+def due_dates(start_date: date, n: int) -> List[str]:
+    # Vencimientos ISO como add_months(start_date, i - 1), sin crear un date por fila
+    y, m0, day = start_date.year, start_date.month - 1, start_date.day
+    out = []
+    for i in range(n):
+        year, month = y + (m0 + i) // 12, (m0 + i) % 12 + 1
+        d = day if day <= 28 else min(day, 29 if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+                                      else _DAYS[month - 1])
+        out.append(f"{year:04d}-{month:02d}-{d:02d}")
+    return out
+
+def schedule_cents(method: str, principal: float, r: float, n: int, rounding: str = None) -> List[Tuple[int, int, int]]:
+    # Para procesos masivos (tools.maintain): filas en centavos sin armar dicts ni floats
+    fn = declining_cents if method == "declining" else french_cents
+    return fn(to_cents(principal, rounding), r, n, rounding)
+
+def _items(rows, start_date: date) -> List[Dict]:
+    return [{"number": i + 1, "due_date": due, "capital": capital / 100, "interest": interest / 100, "total": total / 100}
+            for i, ((capital, interest, total), due) in enumerate(zip(rows, due_dates(start_date, len(rows))))]
+
+def schedule_declining(principal: float, r: float, n: int, start_date: date, rounding: str = None) -> List[Dict]:
+    return _items(declining_cents(to_cents(principal, rounding), r, n, rounding), start_date)
+
+def schedule_french(principal: float, r: float, n: int, start_date: date, rounding: str = None) -> List[Dict]:
+    return _items(french_cents(to_cents(principal, rounding), r, n, rounding), start_date)
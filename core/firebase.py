@@ -1,8 +1,8 @@
 import json
 import os
+import time
 from typing import Optional
-import firebase_admin
-from firebase_admin import credentials, firestore as admin_firestore, storage as admin_storage
+from core import metrics
 
 try:
     import streamlit as st
@@ -22,7 +22,15 @@ def _get(name: str, default=None):
             pass
     return os.environ.get(name, default)
 
+def backend() -> str:
+    # "firestore" (default) o "sqlite" para instalaciones de un solo nodo / offline
+    return str(_get("DB_BACKEND", "firestore")).strip().lower()
+
 def init_firebase() -> None:
+    if backend() == "sqlite":
+        return
+    import firebase_admin
+    from firebase_admin import credentials
     if firebase_admin._apps:
         return
 
@@ -51,11 +59,41 @@ def init_firebase() -> None:
 def get_db():
     global _DB
     if _DB is None:
-        _DB = admin_firestore.client()
+        if backend() == "sqlite":
+            from core.sqlite_db import SQLiteClient
+            _DB = metrics.instrument(SQLiteClient(_get("SQLITE_PATH", "convenios.db")))
+        else:
+            from firebase_admin import firestore as admin_firestore
+            _DB = metrics.instrument(admin_firestore.client())
     return _DB
 
 def get_bucket():
     global _BUCKET
     if _BUCKET is None:
-        _BUCKET = admin_storage.bucket()
+        if backend() == "sqlite":
+            from core.sqlite_db import LocalBucket
+            _BUCKET = LocalBucket(_get("LOCAL_STORAGE_DIR", "storage"))
+        else:
+            from firebase_admin import storage as admin_storage
+            _BUCKET = admin_storage.bucket()
     return _BUCKET
+
+def run_transaction(db, fn, *args, **kwargs):
+    # fn(tx, ...) se reintenta ante conflictos en Firestore; en SQLite corre
+    # bajo BEGIN IMMEDIATE.
+    raw = metrics.unwrap(db)
+    if hasattr(raw, "run_transaction"):
+        # La transacción de SQLite también se instrumenta: sus escrituras se
+        # cuentan al confirmar, como en Firestore
+        done = []
+        def counted(tx, *a, **kw):
+            w = metrics.wrap_writer(tx)
+            result = fn(w, *a, **kw)
+            done.append((w, time.perf_counter()))
+            return result
+        result = raw.run_transaction(counted, *args, **kwargs)
+        w, t0 = done[-1]
+        w.committed(time.perf_counter() - t0)
+        return result
+    from google.cloud import firestore as gcf
+    return gcf.transactional(fn)(db.transaction(), *args, **kwargs)
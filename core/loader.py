@@ -0,0 +1,73 @@
+import threading
+
+# Lecturas de documentos por pedido (rerun de Streamlit o pasada del worker):
+# se juntan las referencias pendientes y se resuelven con un solo get_all; lo
+# leído queda memorizado hasta el próximo begin(). Los snapshots que el
+# llamador ya tiene se pueden cargar con prime() para no releerlos.
+
+_LOCAL = threading.local()
+
+
+class DocLoader:
+    def __init__(self):
+        self._cache = {}
+        self.hits = 0
+        self.fetched = 0
+
+    def prime(self, *snaps):
+        for s in snaps:
+            if s is not None:
+                self._cache[s.reference.path] = s
+        return self
+
+    def forget(self, *refs):
+        for r in refs:
+            self._cache.pop(r.path, None)
+
+    def get_many(self, db, refs):
+        refs = list(refs)
+        missing = {}
+        for r in refs:
+            if r.path in self._cache:
+                self.hits += 1
+            else:
+                missing.setdefault(r.path, r)
+        if missing:
+            for snap in db.get_all(list(missing.values())):
+                self._cache[snap.reference.path] = snap
+            self.fetched += len(missing)
+        return [self._cache[r.path] for r in refs]
+
+    def get(self, ref):
+        snap = self._cache.get(ref.path)
+        if snap is not None:
+            self.hits += 1
+            return snap
+        snap = self._cache[ref.path] = ref.get()
+        self.fetched += 1
+        return snap
+
+
+def begin():
+    _LOCAL.loader = DocLoader()
+    return _LOCAL.loader
+
+
+def current() -> DocLoader:
+    loader = getattr(_LOCAL, "loader", None)
+    return loader if loader is not None else begin()
+
+
+def snapshot(doc):
+    # Acepta un snapshot (lo memoriza) o una referencia (la lee una sola vez)
+    if hasattr(doc, "to_dict"):
+        current().prime(doc)
+        return doc
+    return current().get(doc)
+
+
+def user(db, uid):
+    if not uid:
+        return None
+    snap = current().get(db.collection("users").document(uid))
+    return (snap.to_dict() or {}) if snap.exists else None
@@ -0,0 +1,80 @@
+import hashlib
+import hmac
+import secrets
+from types import SimpleNamespace
+from core.firebase import get_db
+
+# Cuentas para DB_BACKEND=sqlite: reemplaza a firebase_admin.auth y a Identity
+# Toolkit con la misma forma de uso (create_user/get_user_by_email/
+# update_user/delete_user). El hash PBKDF2 va en la colección `local_auth`
+# (id = uid), aparte de `users`, para que el perfil que se lee en cada rerun
+# no lo lleve.
+
+COLLECTION = "local_auth"
+ITERATIONS = 200_000
+
+
+class UserNotFoundError(Exception):
+    pass
+
+
+class EmailAlreadyExistsError(Exception):
+    pass
+
+
+def _hash(password, salt=None, iterations=ITERATIONS):
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), iterations).hex()
+    return f"pbkdf2_sha256${iterations}${salt}${digest}"
+
+
+def _check(password, stored):
+    try:
+        _, iterations, salt, _ = stored.split("$")
+        return hmac.compare_digest(_hash(password, salt, int(iterations)), stored)
+    except (AttributeError, ValueError):
+        return False
+
+
+def _find(email):
+    for snap in get_db().collection(COLLECTION).where("email", "==", email.strip().lower()).limit(1).stream():
+        return snap
+    return None
+
+
+def get_user_by_email(email):
+    snap = _find(email)
+    if snap is None:
+        raise UserNotFoundError(email)
+    return SimpleNamespace(uid=snap.id, email=snap.to_dict().get("email"))
+
+
+def create_user(email, password):
+    email = email.strip().lower()
+    if _find(email) is not None:
+        raise EmailAlreadyExistsError(email)
+    ref = get_db().collection(COLLECTION).document()
+    ref.set({"email": email, "password_hash": _hash(password), "disabled": False})
+    return SimpleNamespace(uid=ref.id, email=email)
+
+
+def update_user(uid, password):
+    ref = get_db().collection(COLLECTION).document(uid)
+    if not ref.get().exists:
+        raise UserNotFoundError(uid)
+    ref.update({"password_hash": _hash(password)})
+
+
+def delete_user(uid):
+    get_db().collection(COLLECTION).document(uid).delete()
+
+
+def sign_in(email, password):
+    # -> (uid, None) o (None, código con los nombres de Identity Toolkit)
+    snap = _find(email)
+    data = snap.to_dict() if snap is not None else {}
+    if snap is None or not _check(password, data.get("password_hash")):
+        return None, "INVALID_PASSWORD"
+    if data.get("disabled"):
+        return None, "USER_DISABLED"
+    return snap.id, None
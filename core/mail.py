@@ -6,6 +6,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
+from core import resilience, tracing
 
 LOG = logging.getLogger(__name__)
 
@@ -48,7 +49,30 @@ def _build(subject, sender, to_addrs, html, text=None, reply_to=None,
         msg.attach(part)
     return msg
 
+# Solo se reintenta lo que puede ser pasajero; credenciales inválidas, no
+_TRANSIENT = (TimeoutError, ConnectionError, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+
 def _open():
+    # Con el circuito abierto o sin presupuesto, falla al instante: el llamador ya sabe degradar
+    with tracing.span("smtp.connect") as s:
+        try:
+            server, sender = resilience.call("smtp", _connect, timeout=float(_get("SMTP_TIMEOUT", 10)),
+                                             retries=int(_get("SMTP_RETRIES", 1)), retry_on=_TRANSIENT)
+        except resilience.Unavailable as e:
+            LOG.warning("SMTP no disponible: %s", e)
+            server, sender = None, None
+        except (smtplib.SMTPException, OSError, socket.error) as e:
+            LOG.exception("SMTP error: %s", e)
+            server, sender = None, None
+        s.set(ok=server is not None)
+        return server, sender
+
+def _send(server, msg, attachments=0):
+    with tracing.span("smtp.send", attachments=attachments or None,
+                      bytes=len(msg.as_bytes()) if tracing.enabled() else None):
+        server.send_message(msg)
+
+def _connect(timeout):
     host = _get("SMTP_HOST")
     port = int(_get("SMTP_PORT", 587))
     user = _get("SMTP_USER")
@@ -59,20 +83,19 @@ def _open():
     if not host or not user or not password:
         LOG.warning("SMTP no configurado; omitiendo envío.")
         return None, None
-    timeout = float(_get("SMTP_TIMEOUT", 15))
     ctx = ssl.create_default_context()
+    if use_ssl:
+        server = smtplib.SMTP_SSL(host, port, context=ctx, timeout=timeout)
+    else:
+        server = smtplib.SMTP(host, port, timeout=timeout)
     try:
-        if use_ssl:
-            server = smtplib.SMTP_SSL(host, port, context=ctx, timeout=timeout)
-        else:
-            server = smtplib.SMTP(host, port, timeout=timeout)
-            if use_tls:
-                server.starttls(context=ctx)
+        if use_tls and not use_ssl:
+            server.starttls(context=ctx)
         server.login(user, password)
-        return server, sender
-    except (smtplib.SMTPException, OSError, socket.error) as e:
-        LOG.exception("SMTP error: %s", e)
-        return None, None
+    except BaseException:
+        server.close()
+        raise
+    return server, sender
 
 def send_email(to_email: str, subject: str, html: str, text: str = None,
                reply_to: Optional[str] = None,
@@ -81,16 +104,37 @@ def send_email(to_email: str, subject: str, html: str, text: str = None,
     if not server: return False
     try:
         msg = _build(subject, sender, [to_email], html, text, reply_to, attachments)
-        server.send_message(msg); return True
+        _send(server, msg, len(attachments or [])); return True
     except smtplib.SMTPException as e:
         LOG.exception("Error enviando a %s: %s", to_email, e); return False
     finally:
         try: server.quit()
         except: pass
 
-def send_email_admins(subject: str, html: str, text: str = None) -> bool:
+def admin_emails() -> List[str]:
     admins = _get("ADMIN_EMAILS", "") or ""
-    recipients = [e.strip() for e in admins.split(",") if e.strip()]
+    return [e.strip() for e in admins.split(",") if e.strip()]
+
+def send_many(messages: List[Tuple[str, str, str]]) -> List[str]:
+    # Varios (destinatario, asunto, html) en una sola sesión SMTP; devuelve los destinatarios fallidos
+    if not messages: return []
+    server, sender = _open()
+    if not server: return [to for to, _, _ in messages]
+    failed = []
+    try:
+        for to, subject, html in messages:
+            try:
+                _send(server, _build(subject, sender, [to], html))
+            except Exception as e:
+                LOG.warning("Error enviando a %s: %s", to, e)
+                failed.append(to)
+    finally:
+        try: server.quit()
+        except: pass
+    return failed
+
+def send_email_admins(subject: str, html: str, text: str = None) -> bool:
+    recipients = admin_emails()
     if not recipients: return False
     server, sender = _open()
     if not server: return False
@@ -99,7 +143,7 @@ def send_email_admins(subject: str, html: str, text: str = None) -> bool:
         for to in recipients:
             try:
                 msg = _build(subject, sender, [to], html, text)
-                server.send_message(msg)
+                _send(server, msg)
             except Exception:
                 ok = False
     finally:
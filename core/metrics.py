@@ -0,0 +1,324 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from core import tracing
+
+LOG = logging.getLogger(__name__)
+if os.environ.get("FIRESTORE_METRICS_LOG"):
+    # Una línea JSON por rerun, para análisis offline
+    _h = logging.FileHandler(os.environ["FIRESTORE_METRICS_LOG"], encoding="utf-8")
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    LOG.addHandler(_h); LOG.setLevel(logging.INFO)
+
+# Streamlit ejecuta cada rerun en el hilo de su sesión: los contadores por
+# rerun viven en un threading.local; los totales del proceso van aparte.
+_LOCAL = threading.local()
+_TOTALS_LOCK = threading.Lock()
+_TOTALS = defaultdict(float)
+_FIELDS = ("reads", "writes", "deletes", "queries", "latency_ms")
+_SKIP_PREFIXES = ("core.metrics", "google.", "grpc", "proto")
+
+
+def _new_stats(page=None):
+    return {"page": page or "(global)", "started": time.time(),
+            "rows": defaultdict(lambda: dict.fromkeys(_FIELDS, 0))}
+
+
+def _stats():
+    s = getattr(_LOCAL, "stats", None)
+    if s is None:
+        s = _LOCAL.stats = _new_stats()
+    return s
+
+
+def begin_rerun(page=None):
+    _LOCAL.stats = _new_stats(page)
+
+
+def set_page(page: str):
+    _stats()["page"] = page
+
+
+def _caller() -> str:
+    f = sys._getframe(2)
+    while f is not None:
+        mod = f.f_globals.get("__name__", "")
+        if not mod.startswith(_SKIP_PREFIXES):
+            return f"{mod}.{f.f_code.co_name}"
+        f = f.f_back
+    return "?"
+
+
+def record(op: str, reads=0, writes=0, deletes=0, elapsed=0.0, caller=None):
+    s = _stats()
+    caller = caller or _caller()
+    row = s["rows"][(s["page"], caller)]
+    row["reads"] += reads; row["writes"] += writes; row["deletes"] += deletes
+    row["queries"] += 1 if op in ("query", "get", "get_all") else 0
+    row["latency_ms"] += elapsed * 1000.0
+    with _TOTALS_LOCK:
+        _TOTALS["reads"] += reads; _TOTALS["writes"] += writes
+        _TOTALS["deletes"] += deletes
+        _TOTALS["queries"] += 1 if op in ("query", "get", "get_all") else 0
+        _TOTALS["latency_ms"] += elapsed * 1000.0
+    tracing.record_span(f"firestore.{op}", elapsed, caller=caller, reads=reads or None,
+                        writes=writes or None, deletes=deletes or None)
+
+
+def rows():
+    return [{"page": page, "caller": caller, **{k: round(v, 1) for k, v in r.items()}}
+            for (page, caller), r in _stats()["rows"].items()]
+
+
+def totals():
+    out = dict.fromkeys(_FIELDS, 0)
+    for r in _stats()["rows"].values():
+        for k in _FIELDS:
+            out[k] += r[k]
+    out["latency_ms"] = round(out["latency_ms"], 1)
+    return out
+
+
+def process_totals():
+    with _TOTALS_LOCK:
+        return {k: _TOTALS.get(k, 0) for k in _FIELDS}
+
+
+def log_rerun(**extra):
+    s = _stats()
+    LOG.info(json.dumps({"event": "firestore_ops", "page": s["page"],
+                         "elapsed_ms": round((time.time() - s["started"]) * 1000, 1),
+                         "totals": totals(), "rows": rows(), **extra},
+                        ensure_ascii=False, default=str))
+
+
+# --- Envoltorio instrumentado del cliente de Firestore ---
+
+class _Proxy:
+    __slots__ = ("_wrapped",)
+
+    def __init__(self, wrapped):
+        self._wrapped = wrapped
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def __repr__(self):
+        return f"<instrumented {self._wrapped!r}>"
+
+
+def _unwrap(obj):
+    return obj._wrapped if isinstance(obj, _Proxy) else obj
+
+
+def _stream(op, it, caller):
+    # Solo cuenta el tiempo dentro de cada next(): lo que el llamador hace en su
+    # bucle entre documento y documento no es latencia de la consulta
+    n = 0; elapsed = 0.0
+    it = iter(it)
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                snap = next(it)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - t0
+            n += 1
+            yield _Snapshot(snap)
+    finally:
+        # Firestore cobra una lectura aunque la consulta no devuelva documentos
+        record(op, reads=max(n, 1), elapsed=elapsed, caller=caller)
+
+
+class _Query(_Proxy):
+    __slots__ = ()
+
+    def _chain(name):
+        def method(self, *args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            return _Query(getattr(self._wrapped, name)(*args, **kwargs))
+        return method
+
+    where = _chain("where")
+    order_by = _chain("order_by")
+    limit = _chain("limit")
+    limit_to_last = _chain("limit_to_last")
+    offset = _chain("offset")
+    select = _chain("select")
+    start_at = _chain("start_at")
+    start_after = _chain("start_after")
+    end_at = _chain("end_at")
+    end_before = _chain("end_before")
+    del _chain
+
+    def stream(self, *args, **kwargs):
+        return _stream("query", self._wrapped.stream(*args, **kwargs), _caller())
+
+    def get(self, *args, **kwargs):
+        return list(_stream("query", self._wrapped.stream(*args, **kwargs), _caller()))
+
+    def document(self, *path):
+        return _DocRef(self._wrapped.document(*path))
+
+    def add(self, data, *args, **kwargs):
+        t0 = time.perf_counter()
+        ts, ref = self._wrapped.add(data, *args, **kwargs)
+        record("write", writes=1, elapsed=time.perf_counter() - t0)
+        return ts, _DocRef(ref)
+
+    @property
+    def parent(self):
+        p = self._wrapped.parent
+        return _DocRef(p) if p is not None else None
+
+
+class _DocRef(_Proxy):
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return _unwrap(other) == self._wrapped
+
+    def __hash__(self):
+        return hash(self._wrapped.path)
+
+    def get(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        snap = self._wrapped.get(*args, **kwargs)
+        record("get", reads=1, elapsed=time.perf_counter() - t0)
+        return _Snapshot(snap)
+
+    def _write(name, kind):
+        def method(self, *args, **kwargs):
+            t0 = time.perf_counter()
+            res = getattr(self._wrapped, name)(*args, **kwargs)
+            record(name, elapsed=time.perf_counter() - t0, **{kind: 1})
+            return res
+        return method
+
+    set = _write("set", "writes")
+    create = _write("create", "writes")
+    update = _write("update", "writes")
+    delete = _write("delete", "deletes")
+    del _write
+
+    def collection(self, *path):
+        return _Query(self._wrapped.collection(*path))
+
+    @property
+    def parent(self):
+        return _Query(self._wrapped.parent)
+
+
+class _Snapshot(_Proxy):
+    __slots__ = ()
+
+    @property
+    def reference(self):
+        return _DocRef(self._wrapped.reference)
+
+
+class _Writer(_Proxy):
+    # WriteBatch / Transaction: las escrituras se cuentan al confirmar
+    __slots__ = ("_pending",)
+
+    def __init__(self, wrapped):
+        super().__init__(wrapped)
+        self._pending = {"writes": 0, "deletes": 0}
+
+    def _op(name, kind):
+        def method(self, ref, *args, **kwargs):
+            getattr(self._wrapped, name)(_unwrap(ref), *args, **kwargs)
+            self._pending[kind] += 1
+            return self
+        return method
+
+    set = _op("set", "writes")
+    create = _op("create", "writes")
+    update = _op("update", "writes")
+    delete = _op("delete", "deletes")
+    del _op
+
+    def get(self, ref_or_query, *args, **kwargs):
+        t0 = time.perf_counter()
+        target = _unwrap(ref_or_query)
+        res = self._wrapped.get(target, *args, **kwargs)
+        if not hasattr(res, "to_dict") and not hasattr(target, "stream"):
+            # Transaction.get(doc_ref) devuelve un generador en google-cloud-firestore
+            res = next(iter(res))
+        if hasattr(res, "to_dict"):
+            record("get", reads=1, elapsed=time.perf_counter() - t0)
+            return _Snapshot(res)
+        return _stream("query", res, _caller())
+
+    def commit(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        res = self._wrapped.commit(*args, **kwargs)
+        self.committed(time.perf_counter() - t0)
+        return res
+
+    def committed(self, elapsed):
+        record("commit", elapsed=elapsed, **self._pending)
+        self._pending = {"writes": 0, "deletes": 0}
+
+    # Transaction de Firestore: gcf.transactional confirma con _commit (no con
+    # commit) y vuelve a correr la función en cada reintento, tras _begin
+    def _begin(self, *args, **kwargs):
+        self._pending = {"writes": 0, "deletes": 0}
+        return self._wrapped._begin(*args, **kwargs)
+
+    def _commit(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        res = self._wrapped._commit(*args, **kwargs)
+        self.committed(time.perf_counter() - t0)
+        return res
+
+    def _rollback(self, *args, **kwargs):
+        self._pending = {"writes": 0, "deletes": 0}
+        return self._wrapped._rollback(*args, **kwargs)
+
+
+class InstrumentedClient(_Proxy):
+    __slots__ = ()
+
+    def collection(self, *path):
+        return _Query(self._wrapped.collection(*path))
+
+    def collection_group(self, collection_id):
+        return _Query(self._wrapped.collection_group(collection_id))
+
+    def document(self, *path):
+        return _DocRef(self._wrapped.document(*path))
+
+    def batch(self):
+        return _Writer(self._wrapped.batch())
+
+    def transaction(self, **kwargs):
+        return _Writer(self._wrapped.transaction(**kwargs))
+
+    def get_all(self, references, *args, **kwargs):
+        refs = [_unwrap(r) for r in references]
+        return _stream("get_all", self._wrapped.get_all(refs, *args, **kwargs), _caller())
+
+
+def instrument(client):
+    return client if isinstance(client, InstrumentedClient) else InstrumentedClient(client)
+
+
+def unwrap(obj):
+    return _unwrap(obj)
+
+
+def wrap_writer(batch_or_tx):
+    return batch_or_tx if isinstance(batch_or_tx, _Writer) else _Writer(batch_or_tx)
+
+
+def wrap_snapshot(snap):
+    # Snapshots que llegan por otra vía (p. ej. listeners): sus referencias
+    # quedan instrumentadas como las del resto de la app
+    return snap if isinstance(snap, _Snapshot) else _Snapshot(snap)
@@ -0,0 +1,191 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from core import tracing
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    try:
+        import streamlit as st
+        val = st.secrets.get(name, None)
+        if val is not None:
+            return val
+    except Exception:
+        pass
+    return os.environ.get(name, default)
+
+BREAKER_FAILURES = int(_get("BREAKER_FAILURES", 3))               # fallos seguidos que abren el circuito
+BREAKER_RESET_SECONDS = float(_get("BREAKER_RESET_SECONDS", 30))  # abierto antes de dejar pasar una prueba
+ACTION_BUDGET_SECONDS = float(_get("ACTION_BUDGET_SECONDS", 20))  # tiempo total de red por acción de usuario
+RETRY_BASE_SECONDS = float(_get("RETRY_BASE_SECONDS", 0.25))
+
+# Dependencias externas (SMTP, Cloudinary, Identity Toolkit) detrás de un
+# circuit breaker por nombre: tras BREAKER_FAILURES fallos seguidos el
+# circuito se abre y las llamadas fallan al instante con CircuitOpen; pasado
+# BREAKER_RESET_SECONDS deja pasar una sola prueba (semiabierto) que lo
+# cierra o lo vuelve a abrir. Cada acción de usuario corre con un
+# presupuesto de tiempo (budget): el timeout de cada intento es el menor entre
+# el propio y lo que queda, y los reintentos (backoff exponencial con jitter)
+# no se hacen si no entran.
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class Unavailable(Exception):
+    pass
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+class DeadlineExceeded(Unavailable):
+    pass
+
+
+class Breaker:
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.threshold = failures
+        self.reset = reset
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._fails = 0
+        self._opened = 0.0
+        self._probe = None     # llamada que tiene el único lugar de prueba en semiabierto
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self.last_error = None
+
+    def allow(self):
+        # -> token de la llamada (a devolver con release) o None si el circuito la rechaza
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened >= self.reset:
+                self.state, self._probe = HALF_OPEN, None
+            if self.state == CLOSED or (self.state == HALF_OPEN and self._probe is None):
+                token = object()
+                if self.state == HALF_OPEN:
+                    self._probe = token
+                self.stats["calls"] += 1
+                return token
+            self.stats["rejected"] += 1
+            return None
+
+    def release(self, token):
+        # Si la prueba terminó sin success/failure (excepción no contada, st.rerun...), libera el lugar
+        with self._lock:
+            if self._probe is token:
+                self._probe = None
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                LOG.info("Circuito %s cerrado", self.name)
+            self.state, self._fails, self._probe = CLOSED, 0, None
+
+    def failure(self, err=None):
+        with self._lock:
+            self._fails += 1
+            self.stats["failures"] += 1
+            self.last_error = f"{type(err).__name__}: {err}" if err is not None else None
+            if self.state == HALF_OPEN or self._fails >= self.threshold:
+                if self.state != OPEN:
+                    self.stats["opened"] += 1
+                    LOG.warning("Circuito %s abierto tras %s fallo(s): %s", self.name, self._fails, self.last_error)
+                self.state, self._opened, self._probe = OPEN, time.monotonic(), None
+
+    def snapshot(self):
+        with self._lock:
+            wait = max(0.0, self.reset - (time.monotonic() - self._opened)) if self.state == OPEN else 0.0
+            return {"name": self.name, "state": self.state, "consecutive_failures": self._fails,
+                    "retry_in": round(wait, 1), "last_error": self.last_error, **self.stats}
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def breaker(name):
+    with _BREAKERS_LOCK:
+        b = _BREAKERS.get(name)
+        if b is None:
+            b = _BREAKERS[name] = Breaker(name)
+        return b
+
+
+def states():
+    with _BREAKERS_LOCK:
+        items = list(_BREAKERS.values())
+    return [b.snapshot() for b in sorted(items, key=lambda b: b.name)]
+
+
+@contextmanager
+def budget(seconds=ACTION_BUDGET_SECONDS):
+    # Anidado, vale el más restrictivo; también sirve como decorador (fragmentos)
+    prev = getattr(_LOCAL, "deadline", None)
+    deadline = time.monotonic() + seconds
+    _LOCAL.deadline = deadline if prev is None else min(prev, deadline)
+    try:
+        yield
+    finally:
+        _LOCAL.deadline = prev
+
+
+def remaining():
+    deadline = getattr(_LOCAL, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _timeout(name, timeout):
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0.05:
+        raise DeadlineExceeded(f"{name}: sin tiempo en el presupuesto de la acción")
+    return min(timeout, left)
+
+
+def call(name, fn, *args, timeout=10.0, retries=0, retry_on=(OSError,), is_failure=None, **kwargs):
+    # fn recibe timeout=; is_failure(resultado) marca respuestas fallidas (p. ej. HTTP 5xx),
+    # que en el último intento se devuelven igual
+    b = breaker(name)
+    for attempt in range(retries + 1):
+        # Primero el presupuesto: sin tiempo no se ocupa el lugar de prueba del circuito
+        t = _timeout(name, timeout)
+        token = b.allow()
+        if token is None:
+            raise CircuitOpen(f"{name}: circuito abierto")
+        try:
+            with tracing.span(f"{name}.call", attempt=attempt, timeout=round(t, 2)) as sp:
+                try:
+                    result = fn(*args, timeout=t, **kwargs)
+                except Exception as e:
+                    b.failure(e)
+                    sp.set(error=type(e).__name__)
+                    if attempt == retries or not isinstance(e, retry_on) or not _backoff(attempt):
+                        raise
+                    continue
+                if is_failure is not None and is_failure(result):
+                    b.failure()
+                    sp.set(failed=True)
+                    if attempt < retries and _backoff(attempt):
+                        continue
+                    return result
+            b.success()
+            return result
+        finally:
+            b.release(token)
+
+
+def _backoff(attempt):
+    # Jitter completo; si la espera no entra en el presupuesto, no se reintenta
+    wait = random.uniform(0, RETRY_BASE_SECONDS * 2 ** attempt)
+    left = remaining()
+    if left is not None and wait >= left - 0.05:
+        return False
+    time.sleep(wait)
+    return True
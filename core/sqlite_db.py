@@ -0,0 +1,559 @@
+import copy
+import json
+import os
+import random
+import sqlite3
+import string
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# Backend embebido con la misma superficie que usamos del cliente de Firestore
+# (collection/where/order_by/stream, document get/set/update/delete, batch,
+# collection_group, get_all). Cada documento es una fila JSON; los campos por
+# los que filtramos tienen índices de expresión sobre json_extract.
+
+try:
+    from google.cloud.firestore_v1 import transforms as _gt
+    _GOOGLE_SERVER_TS = _gt.SERVER_TIMESTAMP
+    _GOOGLE_DELETE = _gt.DELETE_FIELD
+except Exception:
+    _GOOGLE_SERVER_TS = _GOOGLE_DELETE = None
+
+
+class _Sentinel:
+    def __init__(self, name): self.name = name
+    def __repr__(self): return f"sqlite_db.{self.name}"
+
+
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")
+DELETE_FIELD = _Sentinel("DELETE_FIELD")
+
+
+class NotFound(Exception):
+    pass
+
+
+class AlreadyExists(Exception):
+    pass
+
+
+_TS_TAG = "\ufdd0ts:"
+_ID_CHARS = string.ascii_letters + string.digits
+
+# (columna de alcance, campo): "parent" sirve a consultas sobre una colección
+# concreta, "coll" a collection_group.
+_INDEXES = [
+    ("parent", "email"),
+    ("parent", "operator_id"),
+    ("parent", "client_email"),
+    ("parent", "status"),
+    ("parent", "receipt_status"),
+    ("parent", "paid"),
+    ("parent", "number"),
+    ("coll", "receipt_status"),
+    ("coll", "due_date"),
+    ("coll", "next_reminder_at"),
+    ("coll", "shard"),
+    ("parent", "shard"),
+    ("coll", "updated_at"),
+    ("parent", "updated_at"),
+    ("parent", "ts"),
+    ("parent", "agreement_id"),
+]
+
+
+def _auto_id() -> str:
+    return "".join(random.choice(_ID_CHARS) for _ in range(20))
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _jpath(field: str) -> str:
+    return "$" + "".join('."' + part.replace('"', "") + '"' for part in field.split("."))
+
+
+def _jx(field: str) -> str:
+    # Literal (no parámetro) para que SQLite use los índices de expresión
+    return f"json_extract(data, '{_jpath(field)}')"
+
+
+def _encode(v):
+    if isinstance(v, datetime):
+        if v.tzinfo is None:
+            v = v.replace(tzinfo=timezone.utc)
+        return _TS_TAG + v.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+    if isinstance(v, dict):
+        return {k: _encode(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_encode(x) for x in v]
+    return v
+
+
+def _decode(v):
+    if isinstance(v, str) and v.startswith(_TS_TAG):
+        return datetime.fromisoformat(v[len(_TS_TAG):])
+    if isinstance(v, dict):
+        return {k: _decode(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_decode(x) for x in v]
+    return v
+
+
+def _is_server_ts(v):
+    return v is SERVER_TIMESTAMP or (_GOOGLE_SERVER_TS is not None and v is _GOOGLE_SERVER_TS)
+
+
+def _is_delete(v):
+    return v is DELETE_FIELD or (_GOOGLE_DELETE is not None and v is _GOOGLE_DELETE)
+
+
+def _transform(current, v, now):
+    if _is_server_ts(v):
+        return now
+    kind = type(v).__name__
+    if kind == "Increment":
+        return (current or 0) + v.value
+    if kind == "ArrayUnion":
+        cur = list(current or [])
+        return cur + [x for x in v.values if x not in cur]
+    if kind == "ArrayRemove":
+        return [x for x in (current or []) if x not in v.values]
+    if isinstance(v, dict):
+        return {k: _transform((current or {}).get(k) if isinstance(current, dict) else None, x, now)
+                for k, x in v.items() if not _is_delete(x)}
+    return v
+
+
+def _set_path(data: Dict, field: str, v, now):
+    parts = field.split(".")
+    node = data
+    for p in parts[:-1]:
+        if not isinstance(node.get(p), dict):
+            node[p] = {}
+        node = node[p]
+    if _is_delete(v):
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = _transform(node.get(parts[-1]), v, now)
+
+
+def _merge(dst: Dict, src: Dict, now):
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            _merge(dst[k], v, now)
+        elif _is_delete(v):
+            dst.pop(k, None)
+        else:
+            dst[k] = _transform(dst.get(k), v, now)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, create_time=None, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+    @property
+    def id(self): return self.reference.id
+
+    @property
+    def exists(self): return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str):
+        node = self._data or {}
+        for p in field.split("."):
+            node = node[p]
+        return copy.deepcopy(node)
+
+
+class DocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+
+    def __eq__(self, other):
+        return getattr(other, "path", None) == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f"<sqlite DocumentReference {self.path}>"
+
+    @property
+    def id(self): return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self): return CollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, *path):
+        return CollectionReference(self._client, "/".join((self.path,) + path))
+
+    def get(self, *args, **kwargs):
+        return self._client._get(self.path)
+
+    def set(self, data, merge=False):
+        self._client._write([("set", self.path, data, merge)])
+
+    def create(self, data):
+        self._client._write([("create", self.path, data, False)])
+
+    def update(self, data):
+        self._client._write([("update", self.path, data, False)])
+
+    def delete(self):
+        self._client._write([("delete", self.path, None, False)])
+
+
+class Query:
+    def __init__(self, client, scope: str, value: str, filters=(), orders=(),
+                 limit=None, offset=None, cursors=()):
+        self._client = client
+        self._scope, self._value = scope, value
+        self._filters, self._orders = tuple(filters), tuple(orders)
+        self._limit, self._offset, self._cursors = limit, offset, tuple(cursors)
+
+    def _copy(self, **kw):
+        args = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                    offset=self._offset, cursors=self._cursors)
+        args.update(kw)
+        return Query(self._client, self._scope, self._value, **args)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        desc = str(direction).upper().startswith("DESC")
+        return self._copy(orders=self._orders + ((field_path, desc),))
+
+    def select(self, field_paths): return self._copy()
+    def limit(self, count): return self._copy(limit=count)
+    def offset(self, num_to_skip): return self._copy(offset=num_to_skip)
+    def start_at(self, cursor): return self._copy(cursors=self._cursors + (("start", cursor, False),))
+    def start_after(self, cursor): return self._copy(cursors=self._cursors + (("start", cursor, True),))
+    def end_at(self, cursor): return self._copy(cursors=self._cursors + (("end", cursor, False),))
+    def end_before(self, cursor): return self._copy(cursors=self._cursors + (("end", cursor, True),))
+
+    def _cond(self, field, op, value):
+        x = _jx(field)
+        if op == "==":
+            if value is None:
+                return f"json_type(data, '{_jpath(field)}') = 'null'", []
+            return f"{x} = ?", [_encode(value)]
+        if op == "!=":
+            return f"{x} IS NOT NULL AND {x} != ?", [_encode(value)]
+        if op in ("<", "<=", ">", ">="):
+            return f"{x} {op} ?", [_encode(value)]
+        if op in ("in", "not-in"):
+            marks = ",".join("?" * len(value)) or "NULL"
+            neg = "NOT " if op == "not-in" else ""
+            return f"{x} {neg}IN ({marks})", [_encode(v) for v in value]
+        if op in ("array_contains", "array_contains_any"):
+            vals = [value] if op == "array_contains" else list(value)
+            marks = ",".join("?" * len(vals)) or "NULL"
+            return (f"EXISTS (SELECT 1 FROM json_each(data, '{_jpath(field)}') WHERE value IN ({marks}))",
+                    [_encode(v) for v in vals])
+        raise ValueError(f"Operador no soportado: {op}")
+
+    def _cursor_cond(self, kind, cursor, strict):
+        if isinstance(cursor, DocumentSnapshot) or hasattr(cursor, "reference"):
+            data = cursor.to_dict() or {}
+            tiebreak = cursor.reference.path
+        else:
+            data, tiebreak = cursor, None
+        keys = [(f, d, _encode(DocumentSnapshot(None, data).get(f))) for f, d in self._orders]
+        fwd = kind == "start"
+        terms, args = [], []
+        for i, (f, desc, v) in enumerate(keys):
+            prefix = [f"{_jx(g)} = ?" for g, _, _ in keys[:i]]
+            cmp = ">" if fwd != desc else "<"
+            last = i == len(keys) - 1 and tiebreak is None
+            op = cmp if (strict or not last) else cmp + "="
+            terms.append(" AND ".join(prefix + [f"{_jx(f)} {op} ?"]))
+            args += [w for _, _, w in keys[:i]] + [v]
+        if tiebreak is not None:
+            prefix = [f"{_jx(g)} = ?" for g, _, _ in keys]
+            cmp = ">" if fwd else "<"
+            terms.append(" AND ".join(prefix + [f"path {cmp}{'' if strict else '='} ?"]))
+            args += [w for _, _, w in keys] + [tiebreak]
+        return "(" + " OR ".join(f"({t})" for t in terms) + ")", args
+
+    def _sql(self):
+        where, args = [f"{self._scope} = ?"], [self._value]
+        for f, op, v in self._filters:
+            c, a = self._cond(f, op, v); where.append(c); args += a
+        for f, _ in self._orders:
+            where.append(f"json_type(data, '{_jpath(f)}') IS NOT NULL")
+        for kind, cursor, strict in self._cursors:
+            c, a = self._cursor_cond(kind, cursor, strict); where.append(c); args += a
+        order = [f"{_jx(f)} {'DESC' if d else 'ASC'}" for f, d in self._orders] + ["path ASC"]
+        sql = (f"SELECT path, data, create_time, update_time FROM docs WHERE {' AND '.join(where)} "
+               f"ORDER BY {', '.join(order)}")
+        if self._limit is not None or self._offset:
+            sql += " LIMIT ? OFFSET ?"; args += [-1 if self._limit is None else self._limit, self._offset or 0]
+        return sql, args
+
+    def stream(self, *args, **kwargs):
+        sql, params = self._sql()
+        for row in self._client._query(sql, params):
+            yield self._client._snapshot(*row)
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path: str):
+        super().__init__(client, "parent", path)
+        self.path = path
+
+    @property
+    def id(self): return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return DocumentReference(self._client, self.path.rsplit("/", 1)[0]) if "/" in self.path else None
+
+    def document(self, document_id: Optional[str] = None):
+        return DocumentReference(self._client, f"{self.path}/{document_id or _auto_id()}")
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        ref.create(document_data)
+        return _now(), ref
+
+    def list_documents(self, page_size=None):
+        for (path,) in self._client._query("SELECT path FROM docs WHERE parent = ? ORDER BY path", [self.path]):
+            yield DocumentReference(self._client, path)
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops: List = []
+
+    def set(self, reference, document_data, merge=False):
+        self._ops.append(("set", reference.path, document_data, merge)); return self
+
+    def create(self, reference, document_data):
+        self._ops.append(("create", reference.path, document_data, False)); return self
+
+    def update(self, reference, field_updates, option=None):
+        self._ops.append(("update", reference.path, field_updates, False)); return self
+
+    def delete(self, reference, option=None):
+        self._ops.append(("delete", reference.path, None, False)); return self
+
+    def __len__(self):
+        return len(self._ops)
+
+    def commit(self, *args, **kwargs):
+        ops, self._ops = self._ops, []
+        self._client._write(ops)
+        return []
+
+
+class Transaction(WriteBatch):
+    # Lecturas directas + escrituras diferidas hasta commit; run_transaction
+    # sostiene el lock y un BEGIN IMMEDIATE durante toda la función.
+    def get(self, ref_or_query, *args, **kwargs):
+        if hasattr(ref_or_query, "stream"):
+            return ref_or_query.stream()
+        return self._client._get(ref_or_query.path)
+
+
+class SQLiteClient:
+    def __init__(self, path: str = "convenios.db"):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_schema()
+
+    def _init_schema(self):
+        with self._lock:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS docs (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                coll TEXT NOT NULL,
+                data TEXT NOT NULL,
+                create_time TEXT NOT NULL,
+                update_time TEXT NOT NULL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_docs_parent ON docs(parent)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_docs_coll ON docs(coll)")
+            for scope, field in _INDEXES:
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{scope}_{field.replace('.', '_')} "
+                                   f"ON docs({scope}, {_jx(field)})")
+
+    # --- API compatible con firestore.Client ---
+
+    def collection(self, *path):
+        return CollectionReference(self, "/".join(path))
+
+    def collection_group(self, collection_id: str):
+        return Query(self, "coll", collection_id)
+
+    def document(self, *path):
+        return DocumentReference(self, "/".join(path))
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self)
+
+    def get_all(self, references, *args, **kwargs):
+        paths = [r.path for r in references]
+        found = {}
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for row in self._query(f"SELECT path, data, create_time, update_time FROM docs WHERE path IN ({marks})", chunk):
+                found[row[0]] = row
+        for p in dict.fromkeys(paths):
+            yield self._snapshot(*found[p]) if p in found else DocumentSnapshot(DocumentReference(self, p), None)
+
+    def run_transaction(self, fn, *args, **kwargs):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tx = Transaction(self)
+                result = fn(tx, *args, **kwargs)
+                self._apply(tx._ops)
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- internos ---
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _snapshot(self, path, data, create_time, update_time):
+        return DocumentSnapshot(DocumentReference(self, path), _decode(json.loads(data)),
+                                datetime.fromisoformat(create_time), datetime.fromisoformat(update_time))
+
+    def _get(self, path):
+        rows = self._query("SELECT path, data, create_time, update_time FROM docs WHERE path = ?", [path])
+        return self._snapshot(*rows[0]) if rows else DocumentSnapshot(DocumentReference(self, path), None)
+
+    def _write(self, ops):
+        with self._lock:
+            if self._conn.in_transaction:
+                self._apply(ops); return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._apply(ops)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _apply(self, ops):
+        now = _now()
+        stamp = now.isoformat()
+        for kind, path, data, merge in ops:
+            row = self._conn.execute("SELECT data, create_time FROM docs WHERE path = ?", [path]).fetchone()
+            current = _decode(json.loads(row[0])) if row else None
+            if kind == "delete":
+                self._conn.execute("DELETE FROM docs WHERE path = ?", [path]); continue
+            if kind == "create" and row:
+                raise AlreadyExists(path)
+            if kind == "update" and not row:
+                raise NotFound(path)
+            if kind == "update":
+                new = current
+                for field, v in data.items():
+                    _set_path(new, field, v, now)
+            elif merge and current is not None:
+                new = current; _merge(new, data, now)
+            else:
+                new = {}; _merge(new, data, now)
+            parent, _ = path.rsplit("/", 1)
+            self._conn.execute(
+                "INSERT INTO docs(path, parent, coll, data, create_time, update_time) VALUES (?,?,?,?,?,?) "
+                "ON CONFLICT(path) DO UPDATE SET data = excluded.data, update_time = excluded.update_time",
+                [path, parent, parent.rsplit("/", 1)[-1], json.dumps(_encode(new), ensure_ascii=False),
+                 row[1] if row else stamp, stamp])
+
+
+# --- Storage local (equivalente mínimo al bucket de Firebase) ---
+
+class LocalBlob:
+    def __init__(self, root: str, name: str):
+        self.name = name
+        self._file = os.path.join(root, *name.split("/"))
+        self.content_type = None
+
+    @property
+    def size(self):
+        return os.path.getsize(self._file) if os.path.exists(self._file) else None
+
+    @property
+    def updated(self):
+        if not os.path.exists(self._file):
+            return None
+        return datetime.fromtimestamp(os.path.getmtime(self._file), timezone.utc)
+
+    def exists(self):
+        return os.path.exists(self._file)
+
+    def upload_from_string(self, data, content_type=None):
+        os.makedirs(os.path.dirname(self._file), exist_ok=True)
+        with open(self._file, "wb") as fh:
+            fh.write(data.encode("utf-8") if isinstance(data, str) else data)
+        self.content_type = content_type
+
+    def upload_from_file(self, file_obj, content_type=None, rewind=False):
+        if rewind and hasattr(file_obj, "seek"):
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type)
+
+    def download_as_bytes(self):
+        if not os.path.exists(self._file):
+            raise NotFound(self.name)
+        with open(self._file, "rb") as fh:
+            return fh.read()
+
+    def delete(self):
+        if not os.path.exists(self._file):
+            raise NotFound(self.name)
+        os.remove(self._file)
+
+    def generate_signed_url(self, expiration=None, **kwargs):
+        return "file://" + os.path.abspath(self._file)
+
+
+class LocalBucket:
+    def __init__(self, root: str = "storage"):
+        self.root = root
+        self.name = f"local:{root}"
+
+    def blob(self, name: str):
+        return LocalBlob(self.root, name)
+
+    def list_blobs(self, prefix: str = ""):
+        for base, _, files in os.walk(self.root):
+            for f in files:
+                name = os.path.relpath(os.path.join(base, f), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    yield LocalBlob(self.root, name)
@@ -0,0 +1,206 @@
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+TRACE_FILE = _get("TRACE_FILE")                              # vacío = tracing apagado
+TRACE_SAMPLE_RATE = float(_get("TRACE_SAMPLE_RATE", 0.05))   # fracción de trazas que se guardan
+TRACE_SLOW_MS = float(_get("TRACE_SLOW_MS", 2000))           # más lentas que esto se guardan siempre (0 = no)
+TRACE_MAX_SPANS = int(_get("TRACE_MAX_SPANS", 2000))         # tope por traza (el worker genera muchas)
+SERVICE_NAME = _get("TRACE_SERVICE_NAME", "convenios")
+
+# Spans livianos con el formato OTLP/JSON de OpenTelemetry: una línea por
+# traza en TRACE_FILE, legible por el receptor `otlpjsonfile` del collector o
+# por cualquier script. El span actual vive en un ContextVar, así que cada
+# hilo (rerun, tarea, worker) arma su propio árbol. La decisión de muestreo
+# se toma en la raíz; las trazas no muestreadas se descartan al cerrar salvo
+# que superen TRACE_SLOW_MS.
+
+_CURRENT = ContextVar("trace_span", default=None)
+_WRITE_LOCK = threading.Lock()
+
+def enabled():
+    return bool(TRACE_FILE)
+
+def _hex(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+class _Trace:
+    __slots__ = ("trace_id", "sampled", "recording", "spans", "dropped")
+
+    def __init__(self):
+        self.trace_id = _hex(128)
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+        self.recording = self.sampled or TRACE_SLOW_MS > 0
+        self.spans = []
+        self.dropped = 0
+
+class Span:
+    __slots__ = ("name", "trace", "span_id", "parent_id", "start_ns", "end_ns", "attrs", "error")
+
+    def __init__(self, name, trace, parent_id, attrs, start_ns=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = _hex(64)
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attrs = {k: v for k, v in attrs.items() if v is not None}
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update((k, v) for k, v in attrs.items() if v is not None)
+        return self
+
+    def _finish(self, end_ns=None):
+        self.end_ns = end_ns or time.time_ns()
+        tr = self.trace
+        # La raíz termina última y lleva trace.sampled/dropped_spans: los hijos dejan su lugar libre
+        if self.parent_id is None or len(tr.spans) < TRACE_MAX_SPANS - 1:
+            tr.spans.append(self)
+        else:
+            tr.dropped += 1
+
+class _NoopSpan:
+    __slots__ = ("trace", "span_id")
+
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.span_id = None
+
+    def set(self, **attrs):
+        return self
+
+_NOOP = _NoopSpan()
+
+@contextmanager
+def span(name, **attrs):
+    if not TRACE_FILE:
+        yield _NOOP
+        return
+    parent = _CURRENT.get()
+    tr = parent.trace if parent is not None else _Trace()
+    if not tr.recording:
+        if parent is not None:
+            yield parent
+            return
+        s = _NoopSpan(tr)
+    else:
+        s = Span(name, tr, parent.span_id if parent is not None else None, attrs)
+    token = _CURRENT.set(s)
+    try:
+        yield s
+    except Exception as e:
+        # st.rerun()/st.stop() son BaseException: no cuentan como error
+        if isinstance(s, Span):
+            s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _CURRENT.reset(token)
+        if isinstance(s, Span):
+            s._finish()
+            if parent is None:
+                _export(tr, s)
+
+def current():
+    return _CURRENT.get() or _NOOP
+
+def set_attrs(**attrs):
+    current().set(**attrs)
+
+def record_span(name, elapsed, **attrs):
+    # Span ya terminado (p. ej. una operación de Firestore medida por core.metrics)
+    parent = _CURRENT.get()
+    if parent is None or not isinstance(parent, Span):
+        return
+    now = time.time_ns()
+    Span(name, parent.trace, parent.span_id, attrs, start_ns=now - int(elapsed * 1e9))._finish(now)
+
+def _agreement_id(value):
+    path = getattr(value, "path", None) or getattr(getattr(value, "reference", None), "path", None)
+    if isinstance(path, str) and path.startswith("agreements/"):
+        return path.split("/")[1]
+    return None
+
+def traced(name=None, **static):
+    # Decorador para funciones de servicio: agreement_id sale del primer
+    # snapshot/referencia de convenio entre los argumentos y, si devuelven
+    # una lista, su largo queda en result.count
+    def deco(fn):
+        span_name = name or f"{fn.__module__}.{fn.__qualname__}"
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACE_FILE:
+                return fn(*args, **kwargs)
+            attrs = dict(static)
+            for a in list(args) + list(kwargs.values()):
+                ag_id = _agreement_id(a)
+                if ag_id:
+                    attrs["agreement_id"] = ag_id
+                    break
+            with span(span_name, **attrs) as s:
+                result = fn(*args, **kwargs)
+                if isinstance(result, list):
+                    s.set(**{"result.count": len(result)})
+                return result
+        return wrapper
+    return deco
+
+# --- exportación ---
+
+def _value(v):
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+def _otlp(s):
+    out = {"traceId": s.trace.trace_id, "spanId": s.span_id, "name": s.name, "kind": 1,
+           "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(s.end_ns),
+           "attributes": [{"key": k, "value": _value(v)} for k, v in s.attrs.items()],
+           "status": {"code": 2, "message": s.error} if s.error else {}}
+    if s.parent_id:
+        out["parentSpanId"] = s.parent_id
+    return out
+
+def _export(tr, root):
+    slow = TRACE_SLOW_MS > 0 and (root.end_ns - root.start_ns) / 1e6 >= TRACE_SLOW_MS
+    if not (tr.sampled or slow):
+        return
+    if tr.dropped:
+        root.set(**{"trace.dropped_spans": tr.dropped})
+    root.set(**{"trace.sampled": tr.sampled})
+    line = json.dumps({"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+                                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]},
+        "scopeSpans": [{"scope": {"name": "core.tracing"}, "spans": [_otlp(s) for s in tr.spans]}],
+    }]}, ensure_ascii=False, default=str)
+    try:
+        with _WRITE_LOCK, open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        LOG.warning("No se pudo escribir la traza en %s: %s", TRACE_FILE, e)
@@ -0,0 +1,182 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from core.firebase import run_transaction
+
+LOG = logging.getLogger(__name__)
+
+UOW_BATCH_SIZE = 450   # escrituras por batch (Firestore admite 500)
+
+# Unidad de trabajo por acción de página: creates/updates/deletes se acumulan
+# y se confirman juntos al salir del bloque, en batches de UOW_BATCH_SIZE o,
+# con transactional=True (o si hay cuotas embebidas que modificar), en una
+# sola transacción. after_commit() registra efectos (notificaciones, tareas,
+# borrado de archivos) que corren solo si el commit salió bien; on_rollback(),
+# la limpieza de lo hecho fuera de la base antes del commit (archivos subidos)
+# si el bloque o el commit fallan. Mientras hay
+# una acción activa en el hilo, events.record/transition y batch() se suman
+# a ella. Lo escrito no se puede leer antes del commit: las lecturas que
+# dependen de la acción van después del bloque o en un after_commit.
+
+_LOCAL = threading.local()
+
+
+class UnitOfWork:
+    def __init__(self, db, transactional=False):
+        self.db = db
+        self.transactional = transactional
+        self.committed = False
+        self._ops = []     # (op, ref, data, merge)
+        self._rows = []    # (referencia de cuota embebida, campos)
+        self._hooks = []
+        self._undo = []
+
+    # Misma interfaz que un WriteBatch: se puede pasar como batch=
+    def set(self, ref, data, merge=False):
+        self._ops.append(("set", ref, data, merge))
+        return self
+
+    def create(self, ref, data):
+        self._ops.append(("create", ref, data, False))
+        return self
+
+    def update(self, ref, data):
+        if getattr(ref, "embedded", False):
+            self._rows.append((ref, data))
+        else:
+            self._ops.append(("update", ref, data, False))
+        return self
+
+    def delete(self, ref):
+        self._ops.append(("delete", ref, None, False))
+        return self
+
+    def after_commit(self, fn, *args, **kwargs):
+        self._hooks.append((fn, args, kwargs))
+
+    def on_rollback(self, fn, *args, **kwargs):
+        self._undo.append((fn, args, kwargs))
+
+    def rollback(self):
+        undo, self._undo, self._hooks = self._undo, [], []
+        for fn, args, kwargs in reversed(undo):
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                LOG.exception("Falló la limpieza tras un commit fallido (%s)", getattr(fn, "__name__", fn))
+
+    def __len__(self):
+        return len(self._ops) + len(self._rows)
+
+    def commit(self):
+        if self.committed:
+            return
+        try:
+            if self._rows or self.transactional:
+                self._commit_tx()
+            else:
+                self._commit_batches()
+        except BaseException:
+            self.rollback()
+            raise
+        self.committed = True
+        self._undo = []
+        hooks, self._hooks = self._hooks, []
+        for fn, args, kwargs in hooks:
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                # Lo confirmado no se deshace: un aviso fallido queda en el log
+                LOG.exception("Falló un efecto posterior al commit (%s)", getattr(fn, "__name__", fn))
+
+    @staticmethod
+    def _apply(w, op, ref, data, merge):
+        if op == "set":
+            w.set(ref, data, merge=merge)
+        elif op == "create":
+            w.create(ref, data)
+        elif op == "update":
+            w.update(ref, data)
+        else:
+            w.delete(ref)
+
+    def _commit_batches(self):
+        # Atómico hasta UOW_BATCH_SIZE escrituras; más que eso, por tramos en orden
+        for i in range(0, len(self._ops), UOW_BATCH_SIZE):
+            batch = self.db.batch()
+            for op in self._ops[i:i + UOW_BATCH_SIZE]:
+                self._apply(batch, *op)
+            batch.commit()
+
+    def _commit_tx(self):
+        from services import schedule
+        agreements = {}
+        for ref, fields in self._rows:
+            agreements.setdefault(ref.parent.parent.path, (ref.parent.parent, []))[1].append((ref, fields))
+        if len(self._ops) + len(agreements) > UOW_BATCH_SIZE:
+            raise ValueError(f"Demasiadas escrituras para una transacción ({len(self._ops) + len(agreements)})")
+        now = datetime.now(timezone.utc)
+
+        def fn(tx):
+            cols = {}
+            for path, (ag_ref, rows) in agreements.items():
+                snap = tx.get(ag_ref)
+                c = ((snap.to_dict() or {}) if snap.exists else {}).get("schedule") or {}
+                for ref, fields in rows:
+                    if ref.id not in (c.get("id") or []):
+                        raise ValueError(f"La cuota {ref.id} no existe en el convenio {ag_ref.id}")
+                    schedule.set_row(c, ref.id, fields, now)
+                cols[path] = c
+            for op in self._ops:
+                self._apply(tx, *op)
+            for path, (ag_ref, _) in agreements.items():
+                tx.update(ag_ref, schedule.column_fields(cols[path]))
+        run_transaction(self.db, fn)
+
+
+def current():
+    return getattr(_LOCAL, "uow", None)
+
+
+def _finish(u, prev):
+    _LOCAL.uow = prev
+    u.commit()
+
+
+@contextmanager
+def action(db, transactional=False):
+    # Anidada dentro de otra acción, se suma a la exterior
+    prev = current()
+    if prev is not None:
+        yield prev
+        return
+    u = _LOCAL.uow = UnitOfWork(db, transactional)
+    try:
+        yield u
+    except Exception:
+        _LOCAL.uow = prev   # nada se escribe
+        u.rollback()
+        raise
+    except BaseException:
+        # st.rerun()/st.stop() dentro del bloque: la acción terminó bien
+        _finish(u, prev)
+        raise
+    _finish(u, prev)
+
+
+@contextmanager
+def batch(db):
+    # Escrituras agrupadas de un servicio: dentro de una acción se suman a
+    # ella; fuera, unidad propia confirmada al salir (en tramos si es grande)
+    u = current()
+    if u is not None:
+        yield u
+        return
+    u = UnitOfWork(db)
+    try:
+        yield u
+    except Exception:
+        u.rollback()
+        raise
+    u.commit()
@@ -2,6 +2,8 @@ import streamlit as st
 from services.agreements import get_user_by_email
 from services.config import get_settings
 import datetime
+from google.cloud import firestore as gcf
+from services import events
 
 def render(db, user, ag_doc):
     st.subheader("✏️ Modificar convenio")
@@ -49,7 +51,7 @@ def render(db, user, ag_doc):
         if not client_email or not get_user_by_email(db, client_email):
             st.error("Ingresá un email válido para el cliente.")
             return
-        ag_doc.reference.update({
+        events.transition(ag_doc.reference, {
             "client_email": client_email,
             "title": title,
             "notes": notes,
@@ -59,7 +61,9 @@ def render(db, user, ag_doc):
             "start_date": start_date.strftime("%Y-%m-%d"),
             "status": "PENDING_ACCEPTANCE",
             "rejection_note": "",
-        })
+            "updated_at": gcf.SERVER_TIMESTAMP,
+        }, "AGREEMENT_EDITED", ag_doc.id, db=db, actor=user.get("uid"),
+            status="PENDING_ACCEPTANCE", prev=ag.get("status"))
         st.success("Convenio modificado y reenviado para aceptación.")
         if "edit_agreement_id" in st.session_state:
             del st.session_state["edit_agreement_id"]
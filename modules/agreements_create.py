@@ -5,7 +5,10 @@ from core.firebase import get_bucket
 from services.config import get_settings
 from services.agreements import get_user_by_email, create_agreement
 from services.installments import generate_schedule
-from services.storage import upload_file
+from services import schedule
+from core import uow
+from services.storage import upload_file, delete_if_exists
+from services import derivatives
 from services.notifications import notify_agreement_sent
 from core.mail import send_email
 
@@ -62,26 +65,36 @@ def render(db, user):
         client_doc = None
     method = "declining" if method_label.startswith("Interés") else "french"
     status = "PENDING_ACCEPTANCE" if enviar_aprobacion else "DRAFT"
-    ag_ref = create_agreement(
-        db=db, operator_uid=user["uid"], client_email=client_email, client_doc=client_doc,
-        title=title, notes=notes, principal=principal,
-        interest_rate=round(interest_pct/100.0, 6) if cfg["interest_enabled"] else 0.0,
-        installments=int(installments), method=method, start_date_iso=start_date.strftime("%Y-%m-%d"),
-        status=status
-    )
-    generate_schedule(db, ag_ref)
-    if attach_files:
-        bucket = get_bucket()
-        for f in attach_files:
-            safe = f.name.replace("/", "_")
-            path = f"agreements/{ag_ref.id}/attachments/{safe}"
-            upload_file(bucket, path, f, f.type)
-            ag_ref.collection("attachments").document().set({
-                "name": safe, "path": path, "content_type": f.type, "size": f.size,
-                "uploaded_by": user["uid"]
-            })
+    rate = round(interest_pct/100.0, 6) if cfg["interest_enabled"] else 0.0
+    # Convenio, cronograma, adjuntos y eventos en un solo commit; el aviso, después
+    with uow.action(db) as u:
+        ag_ref = create_agreement(
+            db=db, operator_uid=user["uid"], client_email=client_email, client_doc=client_doc,
+            title=title, notes=notes, principal=principal, interest_rate=rate,
+            installments=int(installments), method=method, start_date_iso=start_date.strftime("%Y-%m-%d"),
+            status=status
+        )
+        generate_schedule(db, ag_ref, ag={
+            "method": method, "principal": round(principal, 2), "interest_rate": rate,
+            "installments": int(installments), "start_date": start_date.strftime("%Y-%m-%d"),
+            "schedule_layout": schedule.layout_for(installments)})
+        if attach_files:
+            bucket = get_bucket()
+            for f in attach_files:
+                safe = f.name.replace("/", "_")
+                path = f"agreements/{ag_ref.id}/attachments/{safe}"
+                # Si el commit no sale, el archivo y sus derivados no quedan huérfanos en el bucket
+                for dp in (path, f"{path}.embed.jpg", f"{path}.thumb.jpg"):
+                    u.on_rollback(delete_if_exists, bucket, dp)
+                upload_file(bucket, path, f, f.type)
+                u.set(ag_ref.collection("attachments").document(), {
+                    "name": safe, "path": path, "content_type": f.type, "size": f.size,
+                    "uploaded_by": user["uid"],
+                    **derivatives.store(bucket, path, f.getvalue(), f.type)
+                })
+        if status == "PENDING_ACCEPTANCE":
+            u.after_commit(notify_agreement_sent, st, db, ag_ref)
     if status == "PENDING_ACCEPTANCE":
-        notify_agreement_sent(st, db, ag_ref)
         st.success("Convenio creado y enviado a aprobación.")
     else:
         st.success("Convenio creado en estado BORRADOR.")
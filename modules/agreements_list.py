@@ -1,195 +1,398 @@
 import streamlit as st
 from services.agreements import list_agreements_for_role, delete_agreement
-from services.installments import mark_paid, mark_unpaid
+from services.installments import mark_paid, mark_unpaid, list_installments, read_installments
 from core.firebase import get_bucket
-from services.pdf_export import build_agreement_pdf
-from core.mail import send_email
+from services.jobs import new_job, submit
+from services import events
+from core import uow
 from services.notifications import (
     notify_agreement_sent,
     notify_agreement_accepted,
-    notify_agreement_rejected
+    notify_agreement_rejected,
+    notify_operator_new_receipt
 )
-from services.cloudinary_upload import upload_to_cloudinary
+from services.search import AgreementIndex
+from services.archive import find_archived, restore
+from modules.common import invalidate_badges, rerun_fragment, fragment_scope
+from core.tracing import traced
+from core import resilience
 from datetime import datetime
+from google.cloud import firestore as gcf
 
 MAX_MB = 5
 ALLOWED_MIME = {"application/pdf","image/jpeg","image/png"}
+COMPACT_THRESHOLD = 12   # cuotas a partir de las cuales se usa la vista tabla por defecto
+PAGE_SIZE = 12
+AGREEMENTS_PAGE_SIZE = 10
 
-def render(db, user):
-    st.subheader("📄 Mis convenios")
-    ags = list_agreements_for_role(db, user)
-    if not ags:
-        st.info("No tenés convenios todavía."); return
+ICONOS_ESTADO = {
+    "DRAFT": "📝",
+    "PENDING_ACCEPTANCE": "⏳",
+    "ACTIVE": "✅",
+    "COMPLETED": "🏁",
+    "REJECTED": "❌"
+}
+COLORES_ESTADO = {
+    "DRAFT": "#888",
+    "PENDING_ACCEPTANCE": "#ff9800",
+    "ACTIVE": "#2e7d32",
+    "COMPLETED": "#1976d2",
+    "REJECTED": "#c62828"
+}
 
-    for ag_doc in ags:
-        ag = ag_doc.to_dict()
-        items = list(ag_doc.reference.collection("installments").order_by("number").stream())
-        pagas = sum(1 for inst in items if inst.to_dict().get("paid"))
-        impagas = len(items) - pagas
-        estado = ag.get("status", "DRAFT")
-        fecha_inicio = ag.get("start_date", "-")
-        fechas = [inst.to_dict().get("due_date") for inst in items]
-        proxima = next((f for f, inst in zip(fechas, items) if not inst.to_dict().get("paid")), "-")
-        ultima = fechas[-1] if fechas else "-"
-        nombre_cliente = ag.get("client_name", ag.get("client_email", ""))
-        fecha = ag.get("created_at")
-        if hasattr(fecha, "strftime"):
-            fecha_str = fecha.strftime("%Y_%m_%d")
-        elif isinstance(fecha, str):
-            fecha_str = fecha.split("T")[0].replace("-", "_")
-        else:
-            fecha_str = "fecha"
-        nombre_convenio = f"{nombre_cliente}_{fecha_str}"
-
-        icono_estado = {
-            "DRAFT": "📝",
-            "PENDING_ACCEPTANCE": "⏳",
-            "ACTIVE": "✅",
-            "COMPLETED": "🏁",
-            "REJECTED": "❌"
-        }.get(estado, "📄")
-        badge_color = {
-            "DRAFT": "#888",
-            "PENDING_ACCEPTANCE": "#ff9800",
-            "ACTIVE": "#2e7d32",
-            "COMPLETED": "#1976d2",
-            "REJECTED": "#c62828"
-        }.get(estado, "#888")
-
-        bg_block = "#222"
-        text_block = "#fff"
-        st.markdown(
-            f"""
+def _version(*docs):
+    # update_time identifica la versión de cada documento: si no cambió, el HTML tampoco
+    return tuple(str(getattr(d, "update_time", None)) for d in docs)
+
+@st.cache_data(max_entries=5000, show_spinner=False)
+def _card_html(ag_id, version, _ag, _items):
+    ag = _ag
+    pagas = sum(1 for inst in _items if inst.get("paid"))
+    impagas = len(_items) - pagas
+    estado = ag.get("status", "DRAFT")
+    fechas = [inst.get("due_date") for inst in _items]
+    proxima = next((inst.get("due_date") for inst in _items if not inst.get("paid")), "-")
+    ultima = fechas[-1] if fechas else "-"
+    badge_color = COLORES_ESTADO.get(estado, "#888")
+    bg_block = "#222"
+    text_block = "#fff"
+    return f"""
             <div style="border:2px solid {badge_color};background:{bg_block};padding:16px 12px 12px 12px;margin-bottom:8px;border-radius:12px;display:flex;align-items:center;">
-                <span style="font-size:1.3em;font-weight:bold;margin-right:12px;color:{badge_color};">{icono_estado}</span>
-                <span style="font-size:1.15em;font-weight:bold;color:{text_block};">{nombre_convenio}</span>
+                <span style="font-size:1.3em;font-weight:bold;margin-right:12px;color:{badge_color};">{ICONOS_ESTADO.get(estado, "📄")}</span>
+                <span style="font-size:1.15em;font-weight:bold;color:{text_block};">{_nombre_convenio(ag)}</span>
                 <span style="margin-left:auto;font-size:1.1em;font-weight:bold;color:{badge_color};background:{bg_block};padding:4px 12px;border-radius:8px;border:1.5px solid {badge_color};">{estado}</span>
             </div>
-            """, unsafe_allow_html=True
-        )
-
-        st.markdown(
-            f"""
             <div style="border:1px solid #444;padding:8px;margin-bottom:4px;border-radius:6px;background:#282828;color:#fff;">
             Cuotas pagas: <b>{pagas}</b> | Cuotas impagas: <b>{impagas}</b><br>
-            Inicio: <b>{fecha_inicio}</b> | Próxima cuota: <b>{proxima}</b> | Última cuota: <b>{ultima}</b>
+            Inicio: <b>{ag.get("start_date", "-")}</b> | Próxima cuota: <b>{proxima}</b> | Última cuota: <b>{ultima}</b>
             </div>
-            """, unsafe_allow_html=True
-        )
+            """
 
-        with st.expander(f"{nombre_convenio}"):
-            # Si el convenio está rechazado, mostrar solo el estado y motivo para cliente y operador
-            if ag.get("status") == "REJECTED":
-                st.markdown(
-                    f"""
-                    <div style="border:1px solid #c62828;padding:12px;margin-bottom:8px;border-radius:10px;background:#2a2a2a;color:#fff;">
-                    <span style="font-size:1.1em;font-weight:bold;color:#c62828;">❌ Convenio rechazado</span><br>
-                    <span style="font-size:0.97em;">Motivo: <b>{ag.get('rejection_note','(sin motivo)')}</b></span>
-                    </div>
-                    """, unsafe_allow_html=True
-                )
-                if user.get("role") == "operador":
-                    st.info("Puedes modificar el convenio y volver a enviarlo al cliente.")
-                    if st.button("Modificar convenio y reenviar", key=f"modificar_{ag_doc.id}"):
-                        st.session_state["edit_agreement_id"] = ag_doc.id
-                        return
-                continue
-
-            if user.get("role") == "operador" and ag.get("status") == "DRAFT":
-                if st.button("Enviar a aprobación", key=f"aprobacion_{ag_doc.id}"):
-                    ag_doc.reference.update({"status": "PENDING_ACCEPTANCE"})
-                    notify_agreement_sent(st, db, ag_doc)
-                    st.success("Convenio enviado a aprobación.")
-                    st.rerun()
-            # --- FINALIZAR CONVENIO Y ENVIAR PDF ---
-            if user.get("role")=="operador" and pagas == len(items) and ag.get("status") != "COMPLETED":
-                if st.button("Finalizar convenio y enviar PDF", key=f"finalizar_{ag_doc.id}"):
-                    ag_doc.reference.update({"status": "COMPLETED"})
-                    bucket = get_bucket()
-                    pdf_bytes = build_agreement_pdf(db, bucket, ag_doc, leyenda="Convenio finalizado")
-                    operador_email = ag.get("operator_email") or user.get("email")
-                    cliente_email = ag.get("client_email")
-                    asunto = f"{nombre_convenio} finalizado"
-                    html = f"<h4>Convenio finalizado</h4><p>Adjunto PDF con todas las cuotas pagas.</p>"
-                    send_email(operador_email, asunto, html, attachments=[(f"{nombre_convenio}.pdf", pdf_bytes, "application/pdf")])
-                    send_email(cliente_email, asunto, html, attachments=[(f"{nombre_convenio}.pdf", pdf_bytes, "application/pdf")])
-                    st.success("PDF generado y enviado por email al operador y cliente. El convenio está FINALIZADO.")
-                    st.rerun()
-            if user.get("role") == "cliente" and ag.get("status") == "PENDING_ACCEPTANCE":
-                col1, col2 = st.columns(2)
-                if col1.button("Aceptar convenio", key=f"aceptar_{ag_doc.id}"):
-                    ag_doc.reference.update({"status": "ACTIVE", "accepted_at": st.session_state.get("now")})
-                    notify_agreement_accepted(st, db, ag_doc)
-                    st.success("Convenio aceptado.")
-                    st.rerun()
-                motivo_rechazo = col2.text_input("Motivo rechazo (opcional)", key=f"motivo_{ag_doc.id}")
-                if col2.button("Rechazar convenio", key=f"rechazar_{ag_doc.id}"):
-                    ag_doc.reference.update({"status": "REJECTED", "rejection_note": motivo_rechazo})
-                    notify_agreement_rejected(st, db, ag_doc.reference, motivo_rechazo)
-                    st.warning("Convenio rechazado.")
-                    st.rerun()
-            if user.get("role") == "admin":
-                if st.button("❌ Eliminar convenio", key=f"del_ag_{ag_doc.id}"):
-                    bucket = get_bucket()
-                    delete_agreement(db, bucket, ag_doc)
-                    st.warning("Convenio eliminado.")
-                    st.rerun()
-            st.write(f"Estado: {ag.get('status','DRAFT')}")
-            for inst in items:
-                d = inst.to_dict()
-                color_bg = "#282828" if d.get("paid") else "#2a2a2a"
-                color_title = "#2e7d32" if d.get("paid") else "#c62828"
-                estado_cuota = "Pagada" if d.get("paid") else "Impaga"
-                icono_cuota = "✔️" if d.get("paid") else "⏳"
-                text_color = "#fff"
-                st.markdown(
-                    f"""
+@st.cache_data(max_entries=20000, show_spinner=False)
+def _installment_html(inst_id, version, _d):
+    d = _d
+    color_bg = "#282828" if d.get("paid") else "#2a2a2a"
+    color_title = "#2e7d32" if d.get("paid") else "#c62828"
+    estado_cuota = "Pagada" if d.get("paid") else "Impaga"
+    icono_cuota = "✔️" if d.get("paid") else "⏳"
+    text_color = "#fff"
+    return f"""
                     <div style="background:{color_bg};border:1.5px solid #444;padding:12px;margin-bottom:10px;border-radius:10px;">
                     <span style="font-size:1.1em;font-weight:bold;color:{color_title};">{icono_cuota} Cuota {d['number']}</span>
                     <span style="float:right;color:{color_title};font-weight:bold;">{estado_cuota}</span><br>
                     <span style="font-size:0.97em;color:{text_color};">Vencimiento: <b>{d['due_date']}</b> | Total: <b>${d['total']:,.2f}</b></span>
                     </div>
-                    """, unsafe_allow_html=True
-                )
-                # --- SOLO PERMITIR REVERTIR SI EL CONVENIO NO ESTÁ COMPLETED ---
-                if d.get("paid") and user.get("role") in ["operador", "admin"] and ag.get("status") != "COMPLETED":
-                    if st.button(f"Revertir cuota {d['number']}", key=f"unpaid_{inst.id}"):
-                        mark_unpaid(inst.reference)
-                        st.warning("⏪ Cuota revertida a impaga.")
-                        st.rerun()
-                if user.get("role")=="operador" and not d.get("paid"):
-                    colA, colB = st.columns(2)
-                    if colA.button(f"Marcar pagada cuota {d['number']} (manual)", key=f"paid_{inst.id}"):
-                        mark_paid(inst.reference, manual_note="Marcada manualmente por operador")
-                        st.success("✔️ Cuota marcada como pagada.")
-                        st.rerun()
-                if user.get("role") == "cliente" and not d.get("paid") and d.get("receipt_status") not in ["PENDING", "APPROVED", "REJECTED"]:
-                    st.markdown("**¿Pagaste esta cuota?**")
-                    comprobante = st.file_uploader(
-                        f"Subí tu comprobante para cuota {d['number']} (PDF/JPG/PNG)", 
-                        type=["pdf", "jpg", "jpeg", "png"], 
-                        key=f"comprobante_{inst.id}"
-                    )
-                    nota_cliente = st.text_input("Nota para el operador (opcional)", key=f"nota_{inst.id}")
-                    if comprobante is not None:
-                        size_mb = comprobante.size / (1024*1024)
-                        if size_mb > MAX_MB:
-                            st.error(f"El archivo excede {MAX_MB} MB.")
-                            continue
-                        if comprobante.type not in ALLOWED_MIME:
-                            st.error("Tipo de archivo no permitido.")
-                            continue
-                    if st.button(f"Declarar pago cuota {d['number']}", key=f"declarar_pago_{inst.id}"):
-                        url_comprobante = None
-                        if comprobante is not None:
-                            url_comprobante = upload_to_cloudinary(comprobante, comprobante.name)
-                        inst.reference.update({
-                            "receipt_status": "PENDING",
-                            "receipt_url": url_comprobante,
-                            "receipt_note": nota_cliente,
-                            "paid": False
-                        })
-                        st.success("¡Pago declarado correctamente! El operador recibirá tu comprobante y te notificará cuando lo apruebe o rechace.")
-                        st.rerun()
-                if user.get("role") in ["operador", "cliente"] and d.get("receipt_url"):
-                    st.markdown(f"{d['receipt_url']}")
+                    """
+
+def _nombre_convenio(ag):
+    nombre_cliente = ag.get("client_name", ag.get("client_email", ""))
+    fecha = ag.get("created_at")
+    if hasattr(fecha, "strftime"):
+        fecha_str = fecha.strftime("%Y_%m_%d")
+    elif isinstance(fecha, str):
+        fecha_str = fecha.split("T")[0].replace("-", "_")
+    else:
+        fecha_str = "fecha"
+    return f"{nombre_cliente}_{fecha_str}"
+
+def render(db, user):
+    st.subheader("📄 Mis convenios")
+    ags = list_agreements_for_role(db, user)
+    if not ags:
+        st.info("No tenés convenios todavía."); return
+
+    # Índice de búsqueda por sesión y usuario: solo se reindexa lo que cambió
+    idx_key = f"_search_idx_{user.get('uid')}"
+    index = st.session_state.setdefault(idx_key, AgreementIndex()).sync(ags)
+    consulta = st.text_input("🔎 Buscar convenio", placeholder="Cliente, email, título, notas o ID",
+                             key="buscar_convenio")
+    hits = index.search(consulta)
+    if hits is not None:
+        ags = [a for a in ags if a.id in hits]
+        st.caption(f"{len(ags)} resultado(s)")
+        _archived_results(db, user, consulta)
+        if not ags:
+            return
+    paginas = max(1, -(-len(ags) // AGREEMENTS_PAGE_SIZE))
+    pagina = 1
+    if paginas > 1:
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, step=1,
+                                 key="pagina_convenios")
+    desde = (pagina - 1) * AGREEMENTS_PAGE_SIZE
+
+    for ag_doc in ags[desde:desde + AGREEMENTS_PAGE_SIZE]:
+        _agreement_card(db, user, ag_doc)
+
+def _archived_results(db, user, consulta):
+    # Los convenios archivados no están en la lista: se buscan por ID o palabras completas del cliente
+    archivados = find_archived(db, consulta, user)
+    if not archivados:
+        return
+    with st.expander(f"🗄️ {len(archivados)} convenio(s) archivado(s)"):
+        for s in archivados:
+            d = s.to_dict()
+            col1, col2 = st.columns([0.8, 0.2])
+            col1.write(f"{_nombre_convenio(d)} · {d.get('status')} · {s.id}")
+            if user.get("role") in ["admin", "operador"] and col2.button("Restaurar", key=f"restaurar_{s.id}"):
+                restore(db, get_bucket(), s.id, actor=user.get("uid"))
+                st.success("Convenio restaurado.")
+                st.rerun()
+
+def _card_data(db, ag_doc):
+    # Tras una acción del propio card se releen convenio y cuotas sin pasar por
+    # el espejo (puede estar atrasado); se conserva lo más nuevo entre eso y lo
+    # que trae la lista en el próximo rerun completo.
+    key = f"_card_{ag_doc.id}"
+    if st.session_state.pop(f"_dirty_{ag_doc.id}", False):
+        fresh = ag_doc.reference.get()
+        st.session_state[key] = (fresh, read_installments(fresh))
+    cached = st.session_state.get(key)
+    if cached and not cached[0].exists:
+        # Eliminado en esta sesión: el espejo todavía puede traerlo en la lista
+        return cached
+    items = list_installments(db, ag_doc)
+    if cached:
+        releido, listado = _stamp(cached[0], *cached[1]), _stamp(ag_doc, *items)
+        if releido is not None and (listado is None or releido > listado):
+            return cached
+    st.session_state.pop(key, None)
+    return ag_doc, items
+
+def _stamp(*docs):
+    ts = [d.update_time for d in docs if getattr(d, "update_time", None) is not None]
+    return max(ts) if ts else None
+
+def _mark_dirty(ag_id):
+    # El próximo render del card relee convenio y cuotas sin pasar por el espejo
+    st.session_state[f"_dirty_{ag_id}"] = True
+
+def _refresh_card(ag_id):
+    # Rerun solo del card: los cambios de una cuota no afectan la lista ni los contadores del menú
+    _mark_dirty(ag_id)
+    rerun_fragment()
+
+@st.fragment
+@fragment_scope("fragment.agreement_card")
+@traced("fragment.agreement_card")   # en un rerun del fragmento es la raíz de la traza
+@resilience.budget()                 # y el presupuesto de red de la acción
+def _agreement_card(db, user, ag_doc):
+    ag_doc, items = _card_data(db, ag_doc)
+    if not ag_doc.exists:
+        return
+    ag = ag_doc.to_dict()
+    datos = [inst.to_dict() for inst in items]
+    pagas = sum(1 for d in datos if d.get("paid"))
+    nombre_convenio = _nombre_convenio(ag)
+
+    st.markdown(_card_html(ag_doc.id, _version(ag_doc, *items), ag, datos), unsafe_allow_html=True)
+
+    with st.expander(f"{nombre_convenio}"):
+        # Si el convenio está rechazado, mostrar solo el estado y motivo para cliente y operador
+        if ag.get("status") == "REJECTED":
+            st.markdown(
+                f"""
+                <div style="border:1px solid #c62828;padding:12px;margin-bottom:8px;border-radius:10px;background:#2a2a2a;color:#fff;">
+                <span style="font-size:1.1em;font-weight:bold;color:#c62828;">❌ Convenio rechazado</span><br>
+                <span style="font-size:0.97em;">Motivo: <b>{ag.get('rejection_note','(sin motivo)')}</b></span>
+                </div>
+                """, unsafe_allow_html=True
+            )
+            if user.get("role") == "operador":
+                st.info("Puedes modificar el convenio y volver a enviarlo al cliente.")
+                if st.button("Modificar convenio y reenviar", key=f"modificar_{ag_doc.id}"):
+                    st.session_state["edit_agreement_id"] = ag_doc.id
+                    st.rerun()   # cambia de página: rerun completo
+            return
+
+        if user.get("role") == "operador" and ag.get("status") == "DRAFT":
+            if st.button("Enviar a aprobación", key=f"aprobacion_{ag_doc.id}"):
+                with uow.action(db) as u:
+                    events.transition(ag_doc.reference, {"status": "PENDING_ACCEPTANCE", "updated_at": gcf.SERVER_TIMESTAMP},
+                                      "AGREEMENT_SENT", ag_doc.id, db=db, actor=user.get("uid"),
+                                      status="PENDING_ACCEPTANCE", prev=ag.get("status"))
+                    u.after_commit(notify_agreement_sent, st, db, ag_doc)
+                st.success("Convenio enviado a aprobación.")
+                _refresh_card(ag_doc.id)
+        # --- FINALIZAR CONVENIO Y ENVIAR PDF ---
+        if user.get("role")=="operador" and pagas == len(items) and ag.get("status") != "COMPLETED":
+            if st.button("Finalizar convenio y enviar PDF", key=f"finalizar_{ag_doc.id}"):
+                # Estado y tarea en el mismo commit: si la sesión se corta, el envío igual ocurre
+                with uow.action(db) as u:
+                    u.update(ag_doc.reference, {"status": "COMPLETED", "completed_at": gcf.SERVER_TIMESTAMP, "updated_at": gcf.SERVER_TIMESTAMP})
+                    job = new_job(db, "finalize_agreement", {"agreement_id": ag_doc.id, "nombre": nombre_convenio,
+                                                             "operator_email": user.get("email")}, user, batch=u)
+                    events.record("AGREEMENT_COMPLETED", ag_doc.id, actor=user.get("uid"), status="COMPLETED",
+                                  prev=ag.get("status"), batch=u, db=db)
+                    u.after_commit(submit, db, job)
+                st.session_state.setdefault("jobs_sesion", {})[ag_doc.id] = job.id
+                _refresh_card(ag_doc.id)
+        job_id = st.session_state.get("jobs_sesion", {}).get(ag_doc.id)
+        if job_id:
+            _job_status(db, ag_doc.id, job_id)
+        aviso = st.session_state.get("jobs_aviso", {}).pop(ag_doc.id, None)
+        if aviso:
+            getattr(st, aviso[0])(aviso[1])
+        if user.get("role") == "cliente" and ag.get("status") == "PENDING_ACCEPTANCE":
+            col1, col2 = st.columns(2)
+            if col1.button("Aceptar convenio", key=f"aceptar_{ag_doc.id}"):
+                with uow.action(db) as u:
+                    events.transition(ag_doc.reference, {"status": "ACTIVE", "accepted_at": st.session_state.get("now"), "updated_at": gcf.SERVER_TIMESTAMP},
+                                      "AGREEMENT_ACCEPTED", ag_doc.id, db=db, actor=user.get("uid"),
+                                      status="ACTIVE", prev=ag.get("status"))
+                    u.after_commit(notify_agreement_accepted, st, db, ag_doc)
+                st.success("Convenio aceptado.")
+                invalidate_badges()
+                _mark_dirty(ag_doc.id)
+                st.rerun()
+            motivo_rechazo = col2.text_input("Motivo rechazo (opcional)", key=f"motivo_{ag_doc.id}")
+            if col2.button("Rechazar convenio", key=f"rechazar_{ag_doc.id}"):
+                with uow.action(db) as u:
+                    events.transition(ag_doc.reference, {"status": "REJECTED", "rejection_note": motivo_rechazo, "updated_at": gcf.SERVER_TIMESTAMP},
+                                      "AGREEMENT_REJECTED", ag_doc.id, db=db, actor=user.get("uid"),
+                                      status="REJECTED", prev=ag.get("status"), note=motivo_rechazo)
+                    u.after_commit(notify_agreement_rejected, st, db, ag_doc, motivo_rechazo)
+                st.warning("Convenio rechazado.")
+                invalidate_badges()
+                _mark_dirty(ag_doc.id)
+                st.rerun()
+        if user.get("role") == "admin":
+            if st.button("❌ Eliminar convenio", key=f"del_ag_{ag_doc.id}"):
+                bucket = get_bucket()
+                delete_agreement(db, bucket, ag_doc, actor=user.get("uid"))
+                st.warning("Convenio eliminado.")
+                invalidate_badges()
+                _mark_dirty(ag_doc.id)
+                st.rerun()
+        st.write(f"Estado: {ag.get('status','DRAFT')}")
+        if st.checkbox("📎 Ver adjuntos", key=f"adjuntos_{ag_doc.id}"):
+            _attachments(ag_doc)
+        if user.get("role") in ["admin", "operador"] and st.checkbox("🕑 Historial", key=f"historial_{ag_doc.id}"):
+            hist = events.history(db, ag_doc.id)
+            st.dataframe([{"Fecha": e.get("ts"), "Evento": e.get("kind"), "Cuota": (e.get("data") or {}).get("number"),
+                           "Estado": e.get("status"), "Monto": e.get("amount"), "Usuario": e.get("actor")}
+                          for e in hist], hide_index=True, use_container_width=True) if hist else st.caption("Sin eventos registrados.")
+        compacta = st.toggle("Vista compacta (tabla)", value=len(items) > COMPACT_THRESHOLD,
+                             key=f"compacta_{ag_doc.id}")
+        if compacta:
+            _schedule_table(db, user, ag, ag_doc, items, datos)
+        else:
+            for inst, d in zip(items, datos):
+                st.markdown(_installment_html(inst.id, _version(inst), d), unsafe_allow_html=True)
+                _installment_actions(db, user, ag_doc, ag, inst, d)
+
+@st.cache_data(max_entries=500, show_spinner=False)
+def _thumb(path):
+    # Las miniaturas no cambian una vez generadas: alcanza con la ruta como clave
+    return get_bucket().blob(path).download_as_bytes()
+
+def _attachments(ag_doc):
+    atts = [a.to_dict() for a in ag_doc.reference.collection("attachments").stream()]
+    if not atts:
+        st.caption("Sin adjuntos."); return
+    cols = st.columns(min(len(atts), 4))
+    for i, ad in enumerate(atts):
+        with cols[i % len(cols)]:
+            if ad.get("thumb_path"):
+                try:
+                    st.image(_thumb(ad["thumb_path"]), caption=ad.get("name"))
+                    continue
+                except Exception:
+                    pass
+            paginas = f" · {ad['pages']} pág." if ad.get("pages") else ""
+            st.caption(f"📄 {ad.get('name')}{paginas}")
+
+@st.fragment(run_every=2)
+@fragment_scope("fragment.job_status")
+def _job_status(db, ag_id, job_id):
+    # Se refresca solo este bloque mientras la tarea corre
+    snap = db.collection("jobs").document(job_id).get()
+    d = snap.to_dict() if snap.exists else {}
+    estado = d.get("status")
+    if estado in ("DONE", "FAILED"):
+        # Terminada: se deja el aviso y un rerun completo saca el fragmento (y su sondeo)
+        st.session_state["jobs_sesion"].pop(ag_id, None)
+        st.session_state.setdefault("jobs_aviso", {})[ag_id] = (
+            ("success", "PDF generado y enviado por email al operador y cliente. El convenio está FINALIZADO.")
+            if estado == "DONE" else
+            ("error", f"No se pudo enviar el PDF: {d.get('error')}. Un admin puede reintentarlo desde Tareas."))
+        st.rerun()
+    st.progress(float(d.get("progress") or 0.0), text=d.get("message") or "En cola")
+
+def _schedule_table(db, user, ag, ag_doc, items, datos):
+    # Una sola tabla paginada en lugar de un bloque HTML + widgets por cuota;
+    # las acciones se muestran solo para la cuota seleccionada.
+    paginas = max(1, -(-len(items) // PAGE_SIZE))
+    pagina = 1
+    if paginas > 1:
+        pagina = st.number_input("Página", min_value=1, max_value=paginas, value=1, step=1,
+                                 key=f"pagina_{ag_doc.id}")
+    desde = (pagina - 1) * PAGE_SIZE
+    filas = [{
+        "Nº": d["number"],
+        "Vencimiento": d["due_date"],
+        "Total": d["total"],
+        "Estado": "Pagada" if d.get("paid") else "Impaga",
+        "Comprobante": d.get("receipt_status") or "-",
+    } for d in datos[desde:desde + PAGE_SIZE]]
+    sel = st.dataframe(
+        filas, hide_index=True, use_container_width=True,
+        column_config={"Total": st.column_config.NumberColumn(format="$%.2f")},
+        on_select="rerun", selection_mode="single-row", key=f"tabla_{ag_doc.id}_{pagina}",
+    )
+    rows = sel.selection.rows if sel else []
+    if not rows:
+        st.caption("Seleccioná una cuota para ver sus acciones.")
+        return
+    i = desde + rows[0]
+    _installment_actions(db, user, ag_doc, ag, items[i], datos[i])
+
+def _installment_actions(db, user, ag_doc, ag, inst, d):
+    # --- SOLO PERMITIR REVERTIR SI EL CONVENIO NO ESTÁ COMPLETED ---
+    if d.get("paid") and user.get("role") in ["operador", "admin"] and ag.get("status") != "COMPLETED":
+        if st.button(f"Revertir cuota {d['number']}", key=f"unpaid_{inst.id}"):
+            mark_unpaid(inst.reference, actor=user.get("uid"))
+            st.warning("⏪ Cuota revertida a impaga.")
+            _refresh_card(ag_doc.id)
+    if user.get("role")=="operador" and not d.get("paid"):
+        colA, colB = st.columns(2)
+        if colA.button(f"Marcar pagada cuota {d['number']} (manual)", key=f"paid_{inst.id}"):
+            mark_paid(inst.reference, manual_note="Marcada manualmente por operador", actor=user.get("uid"))
+            st.success("✔️ Cuota marcada como pagada.")
+            _refresh_card(ag_doc.id)
+    if user.get("role") == "cliente" and not d.get("paid") and d.get("receipt_status") not in ["PENDING", "APPROVED", "REJECTED"]:
+        st.markdown("**¿Pagaste esta cuota?**")
+        comprobante = st.file_uploader(
+            f"Subí tu comprobante para cuota {d['number']} (PDF/JPG/PNG)", 
+            type=["pdf", "jpg", "jpeg", "png"], 
+            key=f"comprobante_{inst.id}"
+        )
+        nota_cliente = st.text_input("Nota para el operador (opcional)", key=f"nota_{inst.id}")
+        if comprobante is not None:
+            size_mb = comprobante.size / (1024*1024)
+            if size_mb > MAX_MB:
+                st.error(f"El archivo excede {MAX_MB} MB.")
+                return
+            if comprobante.type not in ALLOWED_MIME:
+                st.error("Tipo de archivo no permitido.")
+                return
+        if st.button(f"Declarar pago cuota {d['number']}", key=f"declarar_pago_{inst.id}"):
+            url_comprobante = None
+            if comprobante is not None:
+                from services.cloudinary_upload import upload_to_cloudinary
+                url_comprobante = upload_to_cloudinary(comprobante, comprobante.name)
+                if url_comprobante is None:
+                    return   # el error ya se mostró; la declaración queda para otro intento
+            with uow.action(db) as u:
+                events.transition(inst.reference, {
+                    "receipt_status": "PENDING",
+                    "receipt_url": url_comprobante,
+                    "receipt_note": nota_cliente,
+                    "paid": False,
+                    "updated_at": gcf.SERVER_TIMESTAMP
+                }, "RECEIPT_DECLARED", ag_doc.id, inst.id, db=db, actor=user.get("uid"),
+                    amount=d.get("total"), number=d["number"])
+                u.after_commit(notify_operator_new_receipt, st, db, ag_doc, d["number"], user.get("email"))
+            st.success("¡Pago declarado correctamente! El operador recibirá tu comprobante y te notificará cuando lo apruebe o rechace.")
+            _refresh_card(ag_doc.id)
+    if user.get("role") in ["operador", "cliente"] and d.get("receipt_url"):
+        st.markdown(f"{d['receipt_url']}")
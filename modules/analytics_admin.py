@@ -0,0 +1,48 @@
+import time
+import streamlit as st
+from services.analytics import PortfolioAnalytics
+
+REFRESH_SECONDS = 60
+
+@st.cache_resource(show_spinner=False)
+def _analytics(_db):
+    # Un estado por proceso, compartido entre reruns y sesiones de admins
+    return PortfolioAnalytics(_db)
+
+def render(db):
+    st.subheader("📈 Analítica de cartera")
+    an = _analytics(db)
+    left, right = st.columns([0.8, 0.2])
+    if right.button("Actualizar", key="btn_analytics_refresh") or time.time() - an.refreshed_at > REFRESH_SECONDS:
+        with st.spinner("Actualizando..."):
+            an.refresh()
+    left.caption(f"Convenios: {len(an.agreements)} · Cuotas: {len(an.installments)} · "
+                 f"Cambios leídos en la última actualización: {an.last_changes}")
+    res = an.summary()
+
+    st.write("### Cobranza esperada por mes")
+    cf = res["cash_flow"]
+    if cf.empty:
+        st.info("No hay cuotas impagas en convenios activos.")
+    else:
+        st.bar_chart(cf["esperado"])
+        st.dataframe(cf, use_container_width=True,
+                     column_config={"esperado": st.column_config.NumberColumn("Esperado", format="$%.2f")})
+
+    st.write("### Mora por antigüedad (días vencida)")
+    st.dataframe(res["aging"], use_container_width=True,
+                 column_config={"monto": st.column_config.NumberColumn("Monto", format="$%.2f")})
+
+    st.write("### Tasa de cobro por operador")
+    rates = res["collection_rates"]
+    if rates.empty:
+        st.info("Todavía no hay cuotas vencidas.")
+    else:
+        users = {d.id: (d.to_dict() or {}).get("email") for d in
+                 db.get_all([db.collection("users").document(uid) for uid in rates.index if uid])}
+        rates = rates.assign(operador=[users.get(uid) or uid for uid in rates.index])
+        st.dataframe(rates, use_container_width=True, column_config={
+            "exigible": st.column_config.NumberColumn("Exigible", format="$%.2f"),
+            "cobrado": st.column_config.NumberColumn("Cobrado", format="$%.2f"),
+            "tasa_cobro": st.column_config.ProgressColumn("Tasa de cobro", min_value=0.0, max_value=1.0, format="percent"),
+        })
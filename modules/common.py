@@ -1,5 +1,14 @@
+import functools
+import threading
+from contextlib import contextmanager
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 from core.auth import role_badge, change_password
+from core import metrics, loader, resilience
+from services.mirror import current_stats
+from services.outbox import outbox_stats
+
+BREAKER_ICONS = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
 
 def header(user):
     left, right = st.columns([0.8, 0.2])
@@ -10,6 +19,45 @@ def header(user):
     if st.button("Cerrar sesión", key="btn_logout"):
         st.session_state.clear(); st.rerun()
 
+_SCOPE = threading.local()
+
+@contextmanager
+def rerun_scope(page=None, **extra):
+    # Métricas y DocLoader propios de cada rerun (completo o de un fragmento).
+    # Un fragmento que corre dentro del rerun completo se suma a ese.
+    if getattr(_SCOPE, "active", False):
+        yield
+        return
+    _SCOPE.active = True
+    metrics.begin_rerun(page)
+    loader.begin()
+    try:
+        yield
+    finally:
+        _SCOPE.active = False
+        metrics.log_rerun(uid=st.session_state.get("uid"), **extra)
+
+def fragment_scope(name):
+    # Va debajo de @st.fragment: los reruns del fragmento no pasan por app.main
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with rerun_scope(name, fragment=name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def invalidate_badges():
+    # Los contadores del menú se recalculan en el próximo rerun completo
+    st.session_state.pop("_badges", None)
+
+def rerun_fragment():
+    # Rerun del fragmento actual; si la acción llegó en un rerun completo, rerun completo
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
 def change_password_page(user):
     st.subheader("🔒 Cambiar contraseña")
     with st.form("change_pwd"):
@@ -22,3 +70,30 @@ def change_password_page(user):
             else:
                 change_password(user["uid"], new)
                 st.success("Contraseña actualizada.")
+
+def debug_panel(user):
+    if user.get("role") != "admin": return
+    breakers = resilience.states()
+    caidos = [b["name"] for b in breakers if b["state"] != "closed"]
+    if caidos:
+        st.sidebar.warning(f"Servicios degradados: {', '.join(caidos)}. Las acciones que los usan fallan al instante.")
+    with st.sidebar.expander("🔧 Firestore (este rerun)", expanded=False):
+        t = metrics.totals()
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Lecturas", t["reads"]); c2.metric("Escrituras", t["writes"]); c3.metric("Borrados", t["deletes"])
+        st.caption(f"Consultas: {t['queries']} · Latencia acumulada: {t['latency_ms']} ms")
+        st.dataframe(metrics.rows(), use_container_width=True, hide_index=True)
+        mirror = current_stats()
+        if mirror:
+            st.caption(f"Espejo en memoria: {mirror['docs']} docs · ~{mirror['approx_bytes']/1024:.0f} KB "
+                       f"(máx. {mirror['max_docs']} por colección) · reconexiones: {mirror['reconnects']} · {mirror['feeds']}")
+        mail = outbox_stats()
+        st.caption(f"Emails: {mail['events']} eventos → {mail['emails']} enviados en {mail['sessions']} sesiones SMTP "
+                   f"(fallidos: {mail['failed']})")
+        if breakers:
+            st.caption("Servicios externos (circuit breakers de este proceso)")
+            st.dataframe([{
+                "Servicio": b["name"], "Estado": f"{BREAKER_ICONS[b['state']]} {b['state']}",
+                "Fallos seguidos": b["consecutive_failures"], "Reintenta en (s)": b["retry_in"] or None,
+                "Llamadas": b["calls"], "Rechazadas": b["rejected"], "Último error": b["last_error"],
+            } for b in breakers], use_container_width=True, hide_index=True)
@@ -1,4 +1,8 @@
 import streamlit as st
+from services import events
+from services.archive import ARCHIVE_AFTER_MONTHS, archived_counts, candidates
+from services.jobs import new_job, submit
+from core import loader
 
 def render(db):
     st.subheader("📊 Panel (admin)")
@@ -8,6 +12,9 @@ def render(db):
     for a in ags:
         s = a.to_dict().get("status","DRAFT")
         counts[s] = counts.get(s,0)+1
+    archivados = archived_counts(db)
+    for s, n in archivados.items():
+        counts[s] = counts.get(s,0)+n
     st.write("### Estados de convenios")
     def colorize(s):
         if s=="PENDING_ACCEPTANCE": return ":orange[PENDING_ACCEPTANCE]"
@@ -17,8 +24,49 @@ def render(db):
         return s
     for s in states:
         st.markdown(f"- {colorize(s)}: **{counts[s]}**")
+    if archivados:
+        st.caption(f"Incluye {sum(archivados.values())} convenio(s) archivado(s).")
 
     total_sent = counts["PENDING_ACCEPTANCE"]+counts["ACTIVE"]+counts["COMPLETED"]
     accepted = counts["ACTIVE"]+counts["COMPLETED"]
     rate = (accepted/total_sent*100) if total_sent else 0
     st.write(f"**Tasa aceptación**: {rate:.1f}%")
+
+    st.write("### Archivo de convenios cerrados")
+    meses = st.number_input("Archivar COMPLETED/REJECTED cerrados hace más de (meses)", min_value=1,
+                            value=ARCHIVE_AFTER_MONTHS, step=1, key="archivo_meses")
+    if st.button("Archivar ahora", key="btn_archivar"):
+        n = len(candidates(db, int(meses)))
+        if n:
+            uid = st.session_state.get("uid")
+            submit(db, new_job(db, "archive_agreements", {"months": int(meses), "actor": uid}, loader.user(db, uid)))
+            st.success(f"{n} convenio(s) en cola para archivar; el avance se ve en Tareas (admin).")
+        else:
+            st.info("No hay convenios para archivar.")
+
+    st.write("### Actividad (registro de eventos)")
+    if not events.is_backfilled(db):
+        st.info("El registro de eventos todavía no incluye los convenios anteriores a su puesta en marcha.")
+        if st.button("Importar estado actual al registro", key="btn_events_backfill"):
+            n = events.backfill(db, actor=st.session_state.get("uid"))
+            st.success(f"Importados {n} convenios.")
+            st.rerun()
+        return
+    estados = events.fold(db, "agreement_status").get("counts", {})
+    st.caption("Convenios por estado según el registro: " +
+               " · ".join(f"{s}: {n}" for s, n in sorted(estados.items()) if n))
+    actividad = events.fold(db, "activity_by_actor")
+    if actividad:
+        uids = [u for u in actividad if not u.startswith("(")]
+        emails = {d.id: (d.to_dict() or {}).get("email") for d in
+                  db.get_all([db.collection("users").document(u) for u in uids])} if uids else {}
+        st.dataframe([{"Usuario": emails.get(u) or u, **fila} for u, fila in actividad.items()],
+                     hide_index=True, use_container_width=True)
+    diaria = events.fold(db, "daily_activity")
+    if diaria:
+        st.bar_chart({dia: sum(fila.values()) for dia, fila in sorted(diaria.items())[-30:]})
+    if st.button("Reconstruir vistas desde el registro", key="btn_events_replay"):
+        for name in events.VIEWS:
+            events.replay(db, name)
+        st.success("Vistas reconstruidas.")
+        st.rerun()
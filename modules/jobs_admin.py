@@ -0,0 +1,33 @@
+import streamlit as st
+from services.jobs import list_jobs, retry_job
+
+ICONOS = {"QUEUED": "⏳", "RUNNING": "⚙️", "DONE": "✅", "FAILED": "❌"}
+
+def render(db):
+    st.subheader("🧵 Tareas en segundo plano")
+    jobs = list_jobs(db)
+    if not jobs:
+        st.info("No hay tareas registradas."); return
+    st.dataframe([{
+        "Estado": f"{ICONOS.get(d.get('status'), '')} {d.get('status')}",
+        "Tipo": d.get("kind"),
+        "Progreso": d.get("progress") or 0.0,
+        "Detalle": d.get("message"),
+        "Intentos": d.get("attempts", 0),
+        "Creada por": d.get("created_by"),
+        "Creada": d.get("created_at"),
+        "ID": j.id,
+    } for j, d in ((j, j.to_dict() or {}) for j in jobs)], hide_index=True, use_container_width=True,
+        column_config={"Progreso": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0)})
+    fallidas = [j for j in jobs if (j.to_dict() or {}).get("status") == "FAILED"]
+    for j in fallidas:
+        d = j.to_dict()
+        with st.expander(f"❌ {d.get('kind')} · {j.id}"):
+            st.write(f"Parámetros: {d.get('params')}")
+            st.error(d.get("error") or "(sin detalle)")
+            if d.get("traceback"):
+                st.code(d["traceback"])
+            if st.button("Reintentar", key=f"retry_{j.id}"):
+                retry_job(db, j.id)
+                st.success("Tarea reencolada.")
+                st.rerun()
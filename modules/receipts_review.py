@@ -1,13 +1,19 @@
 import streamlit as st
 from services.storage import signed_url
-from services.installments import auto_complete_if_all_paid, mark_paid
+from services.installments import auto_complete_if_all_paid, mark_paid, list_installments
+from services.agreements import list_agreements_for_role
 from services.notifications import notify_client_receipt_decision
 from google.cloud import firestore as gcf
 from core.firebase import get_bucket
+from services import events
+from core import uow
+from core.tracing import traced
+from core import resilience
+from modules.common import invalidate_badges, rerun_fragment, fragment_scope
 
 def render(db, user):
     st.subheader("🔎 Pagos/comprobantes pendientes")
-    pend = db.collection("agreements").where("operator_id","==",user["uid"]).stream()
+    pend = list_agreements_for_role(db, user)
     count = 0
     for ag_doc in pend:
         ag = ag_doc.to_dict()
@@ -20,49 +26,74 @@ def render(db, user):
         else:
             fecha_str = "fecha"
         nombre_convenio = f"{nombre_cliente}_{fecha_str}"
-        items = list(ag_doc.reference.collection("installments").where("receipt_status","==","PENDING").stream())
+        items = [it for it in list_installments(db, ag_doc) if it.to_dict().get("receipt_status") == "PENDING"]
         if not items: continue
         with st.expander(f"{nombre_convenio} — {len(items)} pendientes"):
             for inst in items:
-                d = inst.to_dict()
-                color_bg = "#fffbe6"
-                color_title = "#ff9800"
-                st.markdown(
-                    f"""
-                    <div style="background:{color_bg};border:1px solid #ffd54f;padding:10px;margin-bottom:8px;border-radius:8px;">
-                    <span style="font-size:1.1em;font-weight:bold;color:{color_title};">Cuota {d['number']} (Pendiente de aprobación)</span>
-                    <span style="float:right;color:#c62828;font-weight:bold;">Total: ${d['total']:,.2f}</span><br>
-                    <span style="font-size:0.95em;">Vencimiento: <b>{d['due_date']}</b></span><br>
-                    </div>
-                    """, unsafe_allow_html=True
-                )
-                if d.get("receipt_url"):
-                    st.markdown(f"**Comprobante:** {d['receipt_url']}")
-                else:
-                    st.info("Sin comprobante adjunto (declaración manual).")
-                st.write(f"Nota del cliente: {d.get('receipt_note','')}")
-                note = st.text_input("Observación rechazo", key=f"note_{inst.id}")
-                c1,c2 = st.columns(2)
-                if c1.button("Aprobar / Marcar pagada", key=f"ok_{inst.id}"):
-                    inst.reference.update({
-                        "receipt_status": "APPROVED",
-                        "paid": True,
-                        "paid_at": gcf.SERVER_TIMESTAMP,
-                        "receipt_note": d.get("receipt_note", "")
-                    })
-                    notify_client_receipt_decision(st, db, ag_doc, d["number"], "APROBADO", "")
-                    st.success("Pago aprobado. El cliente será notificado y la cuota se marcará como pagada.")
-                    if auto_complete_if_all_paid(db, ag_doc):
-                        st.success("Convenio COMPLETED.")
-                    st.rerun()
-                if c2.button("Rechazar", key=f"rej_{inst.id}"):
-                    inst.reference.update({
-                        "receipt_status": "REJECTED",
-                        "receipt_note": note or ""
-                    })
-                    notify_client_receipt_decision(st, db, ag_doc, d["number"], "RECHAZADO", note or "")
-                    st.warning("Pago rechazado. El cliente será notificado.")
-                    st.rerun()
+                _receipt_row(db, user, ag_doc, inst)
                 count += 1
     if count == 0:
         st.info("No hay comprobantes pendientes. ¡Todo al día!")
+
+def _reviewed(inst_id, kind, msg):
+    # Se resuelve solo la fila; el contador del menú se recalcula en el próximo rerun completo
+    st.session_state.setdefault("_revisados", {})[inst_id] = (kind, msg)
+    invalidate_badges()
+    rerun_fragment()
+
+@st.fragment
+@fragment_scope("fragment.receipt_row")
+@traced("fragment.receipt_row")
+@resilience.budget()
+def _receipt_row(db, user, ag_doc, inst):
+    revisado = st.session_state.get("_revisados", {}).get(inst.id)
+    if revisado:
+        # El espejo puede tardar en reflejar la decisión: la fila queda resuelta igual
+        getattr(st, revisado[0])(f"Cuota {inst.to_dict()['number']}: {revisado[1]}")
+        return
+    d = inst.to_dict()
+    color_bg = "#fffbe6"
+    color_title = "#ff9800"
+    st.markdown(
+        f"""
+        <div style="background:{color_bg};border:1px solid #ffd54f;padding:10px;margin-bottom:8px;border-radius:8px;">
+        <span style="font-size:1.1em;font-weight:bold;color:{color_title};">Cuota {d['number']} (Pendiente de aprobación)</span>
+        <span style="float:right;color:#c62828;font-weight:bold;">Total: ${d['total']:,.2f}</span><br>
+        <span style="font-size:0.95em;">Vencimiento: <b>{d['due_date']}</b></span><br>
+        </div>
+        """, unsafe_allow_html=True
+    )
+    if d.get("receipt_url"):
+        st.markdown(f"**Comprobante:** {d['receipt_url']}")
+    else:
+        st.info("Sin comprobante adjunto (declaración manual).")
+    st.write(f"Nota del cliente: {d.get('receipt_note','')}")
+    note = st.text_input("Observación rechazo", key=f"note_{inst.id}")
+    c1,c2 = st.columns(2)
+    if c1.button("Aprobar / Marcar pagada", key=f"ok_{inst.id}"):
+        with uow.action(db) as u:
+            events.transition(inst.reference, {
+                "receipt_status": "APPROVED",
+                "paid": True,
+                "paid_at": gcf.SERVER_TIMESTAMP,
+                "receipt_note": d.get("receipt_note", ""),
+                "next_reminder_at": None,
+                "updated_at": gcf.SERVER_TIMESTAMP
+            }, "RECEIPT_APPROVED", ag_doc.id, inst.id, db=db, actor=user.get("uid"),
+                amount=d.get("total"), number=d["number"])
+            u.after_commit(notify_client_receipt_decision, st, db, ag_doc, d["number"], "APROBADO", "")
+        # Después del commit: el cierre lee las cuotas ya actualizadas
+        msg = "Pago aprobado. El cliente será notificado y la cuota se marcará como pagada."
+        if auto_complete_if_all_paid(db, ag_doc, actor=user.get("uid")):
+            msg += " Convenio COMPLETED."
+        _reviewed(inst.id, "success", msg)
+    if c2.button("Rechazar", key=f"rej_{inst.id}"):
+        with uow.action(db) as u:
+            events.transition(inst.reference, {
+                "receipt_status": "REJECTED",
+                "receipt_note": note or "",
+                "updated_at": gcf.SERVER_TIMESTAMP
+            }, "RECEIPT_REJECTED", ag_doc.id, inst.id, db=db, actor=user.get("uid"),
+                amount=d.get("total"), number=d["number"], note=note or "")
+            u.after_commit(notify_client_receipt_decision, st, db, ag_doc, d["number"], "RECHAZADO", note or "")
+        _reviewed(inst.id, "warning", "Pago rechazado. El cliente será notificado.")
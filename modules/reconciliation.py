@@ -0,0 +1,76 @@
+import hashlib
+import streamlit as st
+from services.reconciliation import (RECON_AMOUNT_TOLERANCE, RECON_DATE_WINDOW_DAYS, apply_matches,
+                                     match, read_statement, unpaid_frame)
+from services.notifications import notify_client_receipt_decision
+from modules.common import invalidate_badges
+
+def render(db, user):
+    st.subheader("🏦 Conciliación de extractos")
+    st.caption("Subí el extracto del banco o PSP (CSV o Excel con fecha, importe y cliente/email). "
+               "Se cruza contra todas las cuotas impagas de tus convenios activos.")
+    archivo = st.file_uploader("Extracto", type=["csv", "xlsx", "xls"], key="extracto")
+    c1, c2 = st.columns(2)
+    tolerancia = c1.number_input("Tolerancia de importe ($)", min_value=0.0, value=RECON_AMOUNT_TOLERANCE, step=0.5)
+    ventana = c2.number_input("Ventana de fechas (días)", min_value=0, value=RECON_DATE_WINDOW_DAYS, step=1)
+    hecho = st.session_state.pop("_conciliado", None)
+    if hecho:
+        st.success(hecho)
+    if archivo is None:
+        return
+
+    data = archivo.getvalue()
+    # El cruce se guarda por sesión: tildar o destildar filas no vuelve a leer las cuotas
+    key = (hashlib.sha1(data).hexdigest(), tolerancia, ventana, user.get("uid"))
+    cached = st.session_state.get("_conciliacion")
+    if not cached or cached[0] != key:
+        try:
+            stmt, ilegibles = read_statement(data, archivo.name)
+        except ValueError as e:
+            st.error(str(e)); return
+        with st.spinner("Cruzando extracto con cuotas impagas..."):
+            cached = (key, stmt, ilegibles, *match(stmt, unpaid_frame(db, user), tolerancia, ventana))
+        st.session_state["_conciliacion"] = cached
+    _, stmt, ilegibles, propuestas, sin_match = cached
+    if len(ilegibles):
+        st.warning(f"{len(ilegibles)} fila(s) del extracto no se pudieron leer y no entran en el cruce.")
+        with st.expander(f"Filas no leídas ({len(ilegibles)})"):
+            st.dataframe(ilegibles, hide_index=True, width="stretch",
+                         column_config={"row": "Fila", "date": "Fecha", "amount": "Importe", "client": "Cliente",
+                                        "reason": "Motivo"})
+
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Créditos en el extracto", len(stmt))
+    m2.metric("Pagos identificados", len(propuestas))
+    m3.metric("Sin cuota", len(sin_match))
+    if len(propuestas):
+        tabla = propuestas.assign(confirmar=True)[
+            ["confirmar", "row", "date", "amount", "client", "reference", "number", "due_date", "total",
+             "amount_diff", "days", "receipt_status", "agreement_id"]]
+        editada = st.data_editor(
+            tabla, hide_index=True, width="stretch", key="conciliacion_tabla",
+            disabled=[c for c in tabla.columns if c != "confirmar"],
+            column_config={"confirmar": "✔", "row": "Fila", "date": "Fecha", "amount": "Importe",
+                           "client": "Cliente (extracto)", "reference": "Referencia", "number": "Cuota",
+                           "due_date": "Vencimiento", "total": "Total cuota", "amount_diff": "Dif. $",
+                           "days": "Días", "receipt_status": "Comprobante", "agreement_id": "Convenio"})
+        elegidas = propuestas[editada["confirmar"].values]
+        if st.button(f"Confirmar {len(elegidas)} pago(s)", type="primary", disabled=not len(elegidas)):
+            with st.spinner("Registrando pagos..."):
+                res = apply_matches(db, elegidas, actor=user.get("uid"))
+            # Avisos solo con el commit confirmado; el outbox los agrupa por cliente
+            for m in res["paid"]:
+                notify_client_receipt_decision(st, db, db.collection("agreements").document(m["agreement_id"]),
+                                               m["number"], "APROBADO", "Pago identificado en el extracto bancario")
+            msg = f"{len(res['paid'])} cuota(s) marcadas como pagadas."
+            if res["completed"]:
+                msg += f" {len(res['completed'])} convenio(s) completados."
+            if res["skipped"]:
+                msg += f" {len(res['skipped'])} ya no estaban impagas y se omitieron."
+            st.session_state.pop("_conciliacion", None)
+            st.session_state["_conciliado"] = msg
+            invalidate_badges()
+            st.rerun()
+    if len(sin_match):
+        with st.expander(f"Filas sin cuota ({len(sin_match)})"):
+            st.dataframe(sin_match, hide_index=True, width="stretch")
@@ -1,12 +1,20 @@
 from typing import Optional, List, Dict
 from google.cloud import firestore as gcf
+from services.mirror import get_mirror
+from services import events, schedule
+from core import uow
+from services.installments import read_installments
+from services.reminders import shard_of
+from core.tracing import traced
 
+@traced()
 def get_user_by_email(db, email: str):
     q = db.collection("users").where("email","==",email).limit(1).stream()
     for d in q:
         return d
     return None
 
+@traced()
 def create_agreement(db, operator_uid: str, client_email: str, client_doc,
     title: str, notes: str, principal: float,
     interest_rate: float, installments: int, method: str,
@@ -17,46 +25,68 @@ def create_agreement(db, operator_uid: str, client_email: str, client_doc,
         client_data = client_doc.to_dict()
         client_name = client_data.get("full_name", "")
     ag_ref = db.collection("agreements").document()
-    ag_ref.set({
-        "title": title,
-        "notes": notes,
-        "operator_id": operator_uid,
-        "client_id": client_doc.id if client_doc else None,
-        "client_email": client_email,
-        "client_name": client_name,
-        "principal": round(principal,2),
-        "interest_rate": interest_rate,
-        "installments": int(installments),
-        "method": method,
-        "status": status,
-        "created_at": gcf.SERVER_TIMESTAMP,
-        "start_date": start_date_iso
-    })
+    with uow.batch(db) as batch:
+        batch.set(ag_ref, {
+            "title": title,
+            "notes": notes,
+            "operator_id": operator_uid,
+            "client_id": client_doc.id if client_doc else None,
+            "client_email": client_email,
+            "client_name": client_name,
+            "principal": round(principal,2),
+            "interest_rate": interest_rate,
+            "installments": int(installments),
+            "method": method,
+            "schedule_layout": schedule.layout_for(installments),
+            "status": status,
+            "created_at": gcf.SERVER_TIMESTAMP,
+            "updated_at": gcf.SERVER_TIMESTAMP,
+            "start_date": start_date_iso,
+            "shard": shard_of(ag_ref.id)
+        })
+        events.record("AGREEMENT_CREATED", ag_ref.id, actor=operator_uid, status=status,
+                      amount=round(principal, 2), batch=batch, db=db)
     return ag_ref
 
+@traced()
 def list_agreements_for_role(db, user: Dict):
     role = user.get("role")
     col = db.collection("agreements")
     if role == "operador":
-        q = col.where("operator_id","==", user["uid"])
+        q, filters = col.where("operator_id","==", user["uid"]), {"operator_id": user["uid"]}
     elif role == "cliente":
-        q = col.where("client_email","==", user["email"])
+        q, filters = col.where("client_email","==", user["email"]), {"client_email": user["email"]}
     else:
-        q = col
-    return list(q.stream())
+        q, filters = col, {}
+    mirror = get_mirror(db)
+    ags = mirror.agreements(**filters) if mirror else None
+    return ags if ags is not None else list(q.stream())
 
-def delete_agreement(db, bucket, ag_doc):
-    # borrar cuotas + recibos
-    for it in ag_doc.reference.collection("installments").stream():
-        d = it.to_dict()
-        if d.get("receipt_url"):
-            try: bucket.blob(d["receipt_url"]).delete()
-            except: pass
-        it.reference.delete()
-    # borrar adjuntos
-    for a in ag_doc.reference.collection("attachments").stream():
-        ad = a.to_dict()
-        try: bucket.blob(ad.get("path","")).delete()
+@traced()
+def delete_agreement(db, bucket, ag_doc, actor=None):
+    # Documentos en una unidad de trabajo; los archivos se borran recién
+    # confirmado el commit, para no dejar documentos apuntando a la nada
+    blobs = []
+    with uow.batch(db) as batch:
+        # cuotas + recibos (las embebidas se van con el convenio)
+        embedded = schedule.is_embedded(ag_doc)
+        for it in read_installments(ag_doc):
+            d = it.to_dict()
+            if d.get("receipt_url"):
+                blobs.append(d["receipt_url"])
+            if not embedded:
+                batch.delete(it.reference)
+        # adjuntos
+        for a in ag_doc.reference.collection("attachments").stream():
+            ad = a.to_dict()
+            blobs += [ad[key] for key in ("path", "embed_path", "thumb_path") if ad.get(key)]
+            batch.delete(a.reference)
+        batch.delete(ag_doc.reference)
+        events.record("AGREEMENT_DELETED", ag_doc.id, actor=actor, prev=(ag_doc.to_dict() or {}).get("status"),
+                      batch=batch, db=db)
+        batch.after_commit(_delete_blobs, bucket, blobs)
+
+def _delete_blobs(bucket, paths):
+    for path in paths:
+        try: bucket.blob(path).delete()
         except: pass
-        a.reference.delete()
-    ag_doc.reference.delete()
@@ -0,0 +1,163 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from core.tracing import traced
+from services import schedule
+
+AG_FIELDS = ["operator_id", "client_email", "client_name", "status", "updated_at"]
+AG_SELECT = AG_FIELDS + ["schedule_layout", "schedule"]
+INST_FIELDS = ["number", "due_date", "total", "paid", "paid_at", "updated_at"]
+AGING_BINS = [0, 30, 60, 90, float("inf")]
+AGING_LABELS = ["0-30", "31-60", "61-90", "90+"]
+FULL_RELOAD_SECONDS = 3600   # las bajas no se ven por watermark: recarga completa periódica
+CLOCK_SKEW_SECONDS = 60      # margen entre el reloj local y el del servidor al fijar el watermark inicial
+WATERMARK_LAG_SECONDS = 120  # solapamiento al releer: commits con updated_at anterior al watermark que aparecen tarde
+
+def _frame(snaps, fields, key):
+    # Una sola pasada columnar: listas por campo en vez de un dict por fila
+    cols = {f: [] for f in [key] + fields}
+    for s in snaps:
+        d = s.to_dict() or {}
+        cols[key].append(s.reference.path)
+        for f in fields:
+            cols[f].append(d.get(f))
+    return pd.DataFrame(cols).set_index(key)
+
+def _embedded_frame(snaps):
+    # Cuotas de convenios con cronograma embebido, con la misma ruta que tendrían en la subcolección
+    cols = {f: [] for f in ["path"] + INST_FIELDS}
+    for s in snaps:
+        d = s.to_dict() or {}
+        if not schedule.is_embedded(d):
+            continue
+        for r in schedule.unpack(d.get("schedule")):
+            cols["path"].append(f"{s.reference.path}/installments/{r['id']}")
+            for f in INST_FIELDS:
+                cols[f].append(r.get(f))
+    return pd.DataFrame(cols).set_index("path")
+
+def _watermark(df, current):
+    ts = pd.to_datetime(df["updated_at"], utc=True, errors="coerce").max() if len(df) else pd.NaT
+    if pd.isna(ts):
+        return current
+    return max(current, ts.to_pydatetime()) if current else ts.to_pydatetime()
+
+def _changed(df, changed):
+    # Filas nuevas o con otro updated_at: lo releído por el solapamiento no cuenta como cambio
+    if not len(changed):
+        return 0
+    known = df["updated_at"].reindex(changed.index)
+    return int((known.isna() | (known.astype(str) != changed["updated_at"].astype(str))).sum())
+
+class PortfolioAnalytics:
+    # Estado incremental de la cartera: la primera carga lee todo; las
+    # siguientes solo lo modificado desde el último updated_at visto.
+    def __init__(self, db):
+        self._db = db
+        self._lock = threading.Lock()
+        self.agreements = None
+        self.installments = None
+        self.wm_agreements = None
+        self.wm_installments = None
+        self.loaded_at = 0.0
+        self.refreshed_at = 0.0
+        self.last_changes = 0
+
+    @traced()
+    def refresh(self, force_full=False):
+        with self._lock:
+            full = force_full or self.agreements is None or time.time() - self.loaded_at > FULL_RELOAD_SECONDS
+            if full:
+                ag_snaps = list(self._db.collection("agreements").select(AG_SELECT).stream())
+                self.agreements = _frame(ag_snaps, AG_FIELDS, "path")
+                self.installments = _frame(self._db.collection_group("installments").select(INST_FIELDS).stream(), INST_FIELDS, "path")
+                # Sin updated_at (datos viejos) el piso es la hora de la carga;
+                # releer algo con el margen no importa porque el upsert es idempotente
+                floor = datetime.fromtimestamp(time.time() - CLOCK_SKEW_SECONDS, timezone.utc)
+                self.wm_agreements = _watermark(self.agreements, floor)
+                self.wm_installments = _watermark(self.installments, floor)
+                self.installments = self._upsert(self.installments, _embedded_frame(ag_snaps))
+                self.loaded_at = time.time()
+                self.last_changes = len(self.agreements) + len(self.installments)
+            else:
+                # Se relee con solapamiento: updated_at lo fija el servidor al confirmar, así que un
+                # commit lento puede aparecer con un valor menor al watermark ya visto. Lo releído
+                # se deduplica por ruta en el upsert.
+                lag = timedelta(seconds=WATERMARK_LAG_SECONDS)
+                ag_snaps = list(self._db.collection("agreements").where("updated_at", ">", self.wm_agreements - lag)
+                                .select(AG_SELECT).stream())
+                changed_ag = _frame(ag_snaps, AG_FIELDS, "path")
+                changed_inst = _frame(self._db.collection_group("installments")
+                                      .where("updated_at", ">", self.wm_installments - lag)
+                                      .select(INST_FIELDS).stream(), INST_FIELDS, "path")
+                self.last_changes = _changed(self.agreements, changed_ag) + _changed(self.installments, changed_inst)
+                self.agreements = self._upsert(self.agreements, changed_ag)
+                self.installments = self._upsert(self.installments, changed_inst)
+                self.installments = self._replace_embedded(self.installments, ag_snaps)
+                self.wm_agreements = _watermark(changed_ag, self.wm_agreements)
+                self.wm_installments = _watermark(changed_inst, self.wm_installments)
+            self.refreshed_at = time.time()
+        return self
+
+    @staticmethod
+    def _upsert(df, changed):
+        if not len(changed):
+            return df
+        changed = changed[~changed.index.duplicated(keep="last")]
+        return pd.concat([df.drop(changed.index, errors="ignore"), changed])
+
+    def _replace_embedded(self, df, ag_snaps):
+        # Un convenio embebido que cambió trae su cronograma entero: sus filas se reemplazan
+        paths = {s.reference.path for s in ag_snaps if schedule.is_embedded(s.to_dict() or {})}
+        if not paths:
+            return df
+        df = df[~df.index.str.rsplit("/", n=2).str[0].isin(paths)]
+        return self._upsert(df, _embedded_frame(ag_snaps))
+
+    def _joined(self):
+        inst = self.installments.copy()
+        inst["agreement"] = inst.index.str.rsplit("/", n=2).str[0]
+        inst = inst.join(self.agreements[["operator_id", "status", "client_email"]], on="agreement")
+        inst["due"] = pd.to_datetime(inst["due_date"], errors="coerce")
+        inst["total"] = pd.to_numeric(inst["total"], errors="coerce").fillna(0.0)
+        inst["paid"] = inst["paid"].fillna(False).astype(bool)
+        return inst
+
+    def cash_flow(self) -> pd.DataFrame:
+        # Cobranza esperada por mes (cuotas impagas de convenios activos)
+        inst = self._joined()
+        unpaid = inst[(~inst["paid"]) & (inst["status"] == "ACTIVE") & inst["due"].notna()]
+        out = unpaid.groupby(unpaid["due"].dt.to_period("M").astype(str))["total"].agg(["sum", "count"])
+        return out.rename(columns={"sum": "esperado", "count": "cuotas"}).rename_axis("mes")
+
+    def aging(self, today=None) -> pd.DataFrame:
+        today = pd.Timestamp(today or datetime.now(timezone.utc).date())
+        inst = self._joined()
+        unpaid = inst[(~inst["paid"]) & (inst["status"] == "ACTIVE") & inst["due"].notna()]
+        days = (today - unpaid["due"]).dt.days
+        overdue = unpaid[days > 0].assign(dias=days[days > 0])
+        bucket = pd.cut(overdue["dias"], bins=AGING_BINS, labels=AGING_LABELS)
+        out = overdue.groupby(bucket, observed=False)["total"].agg(["sum", "count"])
+        return out.rename(columns={"sum": "monto", "count": "cuotas"}).rename_axis("dias_vencida")
+
+    def collection_rates(self, today=None) -> pd.DataFrame:
+        # Sobre cuotas ya vencidas: monto cobrado / monto exigible, por operador
+        today = pd.Timestamp(today or datetime.now(timezone.utc).date())
+        inst = self._joined()
+        due = inst[inst["status"].isin(["ACTIVE", "COMPLETED"]) & (inst["due"] <= today)]
+        due = due.assign(cobrado=due["total"].where(due["paid"], 0.0))
+        out = due.groupby("operator_id").agg(exigible=("total", "sum"), cobrado=("cobrado", "sum"),
+                                             cuotas=("total", "count"))
+        out["tasa_cobro"] = (out["cobrado"] / out["exigible"]).where(out["exigible"] > 0)
+        return out.sort_values("tasa_cobro")
+
+    @traced()
+    def summary(self):
+        # Resultados memorizados hasta el próximo refresh (o cambio de día)
+        key = (self.refreshed_at, datetime.now(timezone.utc).date())
+        if getattr(self, "_summary_key", None) != key:
+            self._summary = {"cash_flow": self.cash_flow(), "aging": self.aging(),
+                             "collection_rates": self.collection_rates()}
+            self._summary_key = key
+        return self._summary
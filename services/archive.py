@@ -0,0 +1,197 @@
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore as gcf
+from services import events
+from services.search import tokens
+from core import tracing
+from core.tracing import traced
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+ARCHIVE_AFTER_MONTHS = int(_get("ARCHIVE_AFTER_MONTHS", 6))
+ARCHIVE_PREFIX = _get("ARCHIVE_PREFIX", "archive/agreements")
+ARCHIVE_STATUSES = ("COMPLETED", "REJECTED")
+SUBCOLLECTIONS = ("installments", "attachments")
+STUB_FIELDS = ("client_name", "client_email", "client_id", "operator_id", "operator_email", "status",
+               "principal", "installments", "start_date", "created_at", "completed_at", "updated_at")
+
+# Archivo frío: los convenios cerrados hace más de ARCHIVE_AFTER_MONTHS se
+# guardan como JSONL comprimido en el bucket (una línea para el convenio y una
+# por documento de sus subcolecciones) y salen de `agreements`. En
+# `agreements_archive/<id>` queda un stub con los campos clave y los términos
+# de búsqueda del cliente; restore() los devuelve a la colección caliente.
+# Los archivos de Storage (comprobantes, adjuntos) no se mueven.
+
+def _enc(v):
+    if isinstance(v, datetime):
+        return {"__dt": v.isoformat()}
+    if isinstance(v, dict):
+        return {k: _enc(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_enc(x) for x in v]
+    return v
+
+def _dec(v):
+    if isinstance(v, dict):
+        if set(v) == {"__dt"}:
+            return datetime.fromisoformat(v["__dt"])
+        return {k: _dec(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_dec(x) for x in v]
+    return v
+
+def archive_path(ag_id):
+    return f"{ARCHIVE_PREFIX}/{ag_id}.jsonl.gz"
+
+def _closed_at(d):
+    return d.get("completed_at") or d.get("updated_at") or d.get("created_at")
+
+def _aware(ts):
+    if isinstance(ts, str):
+        try:
+            ts = datetime.fromisoformat(ts)
+        except ValueError:
+            return None
+    if not isinstance(ts, datetime):
+        return None
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+@traced()
+def candidates(db, months=ARCHIVE_AFTER_MONTHS, now=None):
+    # Solo por estado: los convenios anteriores a updated_at no tienen el campo
+    # y un filtro por fecha en la consulta los dejaría afuera
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=30 * months)
+    out = []
+    for status in ARCHIVE_STATUSES:
+        for snap in db.collection("agreements").where("status", "==", status).stream():
+            closed = _aware(_closed_at(snap.to_dict() or {}))
+            if closed is not None and closed < cutoff:
+                out.append(snap)
+    return out
+
+def _dump(ag_snap):
+    lines = [{"coll": None, "id": ag_snap.id, "data": _enc(ag_snap.to_dict() or {})}]
+    for coll in SUBCOLLECTIONS:
+        for s in ag_snap.reference.collection(coll).stream():
+            lines.append({"coll": coll, "id": s.id, "data": _enc(s.to_dict() or {})})
+    body = "\n".join(json.dumps(l, ensure_ascii=False) for l in lines).encode("utf-8")
+    return gzip.compress(body), len(lines) - 1
+
+def _delete_all(db, refs):
+    batch, n = db.batch(), 0
+    for ref in refs:
+        batch.delete(ref)
+        n += 1
+        if n % 400 == 0:
+            batch.commit(); batch = db.batch()
+    batch.commit()
+
+@traced()
+def archive_agreement(db, bucket, ag_snap, actor=None):
+    # Orden seguro ante cortes: 1) archivo subido, 2) marca en el convenio,
+    # 3) borrado de subcolecciones, 4) stub + borrado del convenio en un batch.
+    # Un convenio con archived_path ya tiene su archivo completo y se retoma en 3.
+    d = ag_snap.to_dict() or {}
+    path = d.get("archived_path")
+    docs = None
+    if not path or not bucket.blob(path).exists():
+        path = archive_path(ag_snap.id)
+        data, docs = _dump(ag_snap)
+        with tracing.span("storage.upload", path=path, bytes=len(data), docs=docs):
+            bucket.blob(path).upload_from_string(data, content_type="application/gzip")
+        ag_snap.reference.update({"archived_path": path})
+    _delete_all(db, [s.reference for coll in SUBCOLLECTIONS
+                     for s in ag_snap.reference.collection(coll).stream()])
+    stub = {k: d.get(k) for k in STUB_FIELDS if d.get(k) is not None}
+    stub.update({"path": path, "docs": docs, "archived_at": gcf.SERVER_TIMESTAMP, "archived_by": actor,
+                 "terms": sorted(tokens(ag_snap.id) | tokens(d.get("client_name")) | tokens(d.get("client_email")))})
+    batch = db.batch()
+    batch.set(db.collection("agreements_archive").document(ag_snap.id), stub)
+    batch.delete(ag_snap.reference)
+    events.record("AGREEMENT_ARCHIVED", ag_snap.id, actor=actor, batch=batch, db=db, path=path)
+    batch.commit()
+    return path
+
+@traced()
+def restore(db, bucket, ag_id, actor=None):
+    stub_ref = db.collection("agreements_archive").document(ag_id)
+    stub = stub_ref.get()
+    if not stub.exists:
+        raise ValueError(f"El convenio {ag_id} no está archivado")
+    path = stub.to_dict()["path"]
+    lines = [json.loads(l) for l in gzip.decompress(bucket.blob(path).download_as_bytes()).decode("utf-8").splitlines() if l]
+    ag_ref = db.collection("agreements").document(ag_id)
+    batch, n = db.batch(), 0
+    for l in lines:
+        data = _dec(l["data"])
+        if l["coll"] is None:
+            data.pop("archived_path", None)
+            data["updated_at"] = gcf.SERVER_TIMESTAMP   # que analítica y espejo lo vuelvan a ver
+            batch.set(ag_ref, data)
+        else:
+            batch.set(ag_ref.collection(l["coll"]).document(l["id"]), data)
+        n += 1
+        if n % 400 == 0:
+            batch.commit(); batch = db.batch()
+    # El stub se borra al final: si se corta a mitad, restore() se puede repetir
+    batch.delete(stub_ref)
+    events.record("AGREEMENT_RESTORED", ag_id, actor=actor, batch=batch, db=db, path=path)
+    batch.commit()
+    return ag_ref
+
+@traced()
+def find_archived(db, query, user=None, limit=20):
+    # Por ID exacto o por términos del cliente (nombre/email); acotado a lo que el usuario puede ver
+    terms = sorted(tokens(query))
+    if not terms:
+        return []
+    col = db.collection("agreements_archive")
+    ag_id = query.strip()
+    snap = col.document(ag_id).get() if "/" not in ag_id else None
+    found = [snap] if snap is not None and snap.exists else list(col.where("terms", "array_contains", max(terms, key=len)).limit(200).stream())
+    want = set(terms)
+    role = (user or {}).get("role")
+    out = []
+    for s in found:
+        d = s.to_dict() or {}
+        if s.id != ag_id and not want <= set(d.get("terms") or []):
+            continue
+        if role == "operador" and d.get("operator_id") != user.get("uid"):
+            continue
+        if role == "cliente" and d.get("client_email") != user.get("email"):
+            continue
+        out.append(s)
+    return out[:limit]
+
+def archived_counts(db):
+    counts = {}
+    for s in db.collection("agreements_archive").select(["status"]).stream():
+        estado = (s.to_dict() or {}).get("status", "DRAFT")
+        counts[estado] = counts.get(estado, 0) + 1
+    return counts
+
+@traced()
+def run_archival(db, bucket, months=ARCHIVE_AFTER_MONTHS, actor=None, progress=None):
+    cands = candidates(db, months)
+    for i, snap in enumerate(cands):
+        if progress:
+            progress(i / max(len(cands), 1), f"Archivando {i + 1} de {len(cands)}")
+        archive_agreement(db, bucket, snap, actor=actor)
+    return len(cands)
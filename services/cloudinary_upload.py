@@ -1,15 +1,32 @@
 import requests
 import streamlit as st
+from core import resilience
+from core.tracing import traced
 
+CLOUDINARY_TIMEOUT = 30.0   # subida completa; el presupuesto de la acción puede acortarlo
+
+@traced()
 def upload_to_cloudinary(file, filename):
     cloud_name = st.secrets["CLOUDINARY_CLOUD_NAME"]
     api_key = st.secrets["CLOUDINARY_API_KEY"]
     api_secret = st.secrets["CLOUDINARY_API_SECRET"]
     url = f"https://api.cloudinary.com/v1_1/{cloud_name}/auto/upload"
-    files = {"file": (filename, file)}
+    # Bytes y no el archivo: un reintento vuelve a mandar el contenido completo
+    content = file.getvalue() if hasattr(file, "getvalue") else file
+    files = {"file": (filename, content)}
     data = {}
     auth = (api_key, api_secret)
-    response = requests.post(url, files=files, data=data, auth=auth)
+    try:
+        response = resilience.call("cloudinary", requests.post, url, files=files, data=data, auth=auth,
+                                   timeout=CLOUDINARY_TIMEOUT, retries=1,
+                                   retry_on=(requests.ConnectionError, requests.Timeout),
+                                   is_failure=lambda r: r.status_code >= 500)
+    except resilience.Unavailable:
+        st.error("El servicio de archivos no está disponible en este momento. Probá de nuevo en unos minutos.")
+        return None
+    except requests.RequestException:
+        st.error("Error al subir el archivo.")
+        return None
     if response.status_code == 200:
         return response.json()["secure_url"]
     else:
@@ -1,4 +1,6 @@
 from typing import Dict
+from core.tracing import traced
+@traced()
 def get_settings(db) -> Dict:
     doc = db.collection("config").document("settings").get()
     if doc.exists:
@@ -6,6 +8,7 @@ def get_settings(db) -> Dict:
         return {"interest_enabled": bool(d.get("interest_enabled", False))}
     return {"interest_enabled": False}
 
+@traced()
 def set_settings(db, interest_enabled: bool):
     db.collection("config").document("settings").set(
         {"interest_enabled": bool(interest_enabled)}, merge=True
@@ -0,0 +1,91 @@
+import io
+import logging
+import re
+from core import tracing
+from core.tracing import traced
+
+LOG = logging.getLogger(__name__)
+
+EMBED_MAX_PX = 1600     # lado mayor de la versión para el PDF (14x10 cm a ~250 dpi)
+EMBED_QUALITY = 80
+THUMB_MAX_PX = 240
+THUMB_QUALITY = 70
+
+# Derivados que se generan una sola vez al subir un adjunto y se guardan junto
+# al original: <path>.embed.jpg (para el PDF), <path>.thumb.jpg (previews) y,
+# para PDFs, la cantidad de páginas.
+
+# PIL se importa dentro de las funciones: solo lo paga quien sube o exporta adjuntos
+
+def _jpeg(img, max_px, quality):
+    img = img.copy()
+    img.thumbnail((max_px, max_px))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+def _rgb(data):
+    from PIL import Image, ImageOps
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        # JPEG no tiene transparencia: se aplana sobre blanco
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, "white")
+        bg.paste(img, mask=img.split()[-1])
+        return bg
+    return img.convert("RGB")
+
+def pdf_page_count(data):
+    try:
+        from pypdf import PdfReader   # opcional; más fiable con object streams
+        return len(PdfReader(io.BytesIO(data)).pages)
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    n = len(re.findall(rb"/Type\s*/Page(?!s)", data))
+    return n or None
+
+def build(data, content_type):
+    # -> {"embed": bytes, "thumb": bytes, "pages": int, "width": int, "height": int} (según el tipo)
+    ctype = (content_type or "").lower()
+    out = {}
+    try:
+        if ctype.startswith("image/"):
+            img = _rgb(data)
+            out["width"], out["height"] = img.size
+            out["embed"] = _jpeg(img, EMBED_MAX_PX, EMBED_QUALITY)
+            out["thumb"] = _jpeg(img, THUMB_MAX_PX, THUMB_QUALITY)
+        elif ctype == "application/pdf":
+            out["pages"] = pdf_page_count(data)
+    except Exception as e:
+        LOG.warning("No se pudieron generar derivados (%s): %s", content_type, e)
+    return out
+
+@traced()
+def store(bucket, path, data, content_type):
+    # Sube los derivados y devuelve los campos para el documento del adjunto
+    with tracing.span("derivatives.build", content_type=content_type, bytes=len(data)):
+        d = build(data, content_type)
+    fields = {k: d[k] for k in ("pages", "width", "height") if d.get(k) is not None}
+    fields["derived"] = True
+    for kind in ("embed", "thumb"):
+        if kind in d:
+            dpath = f"{path}.{kind}.jpg"
+            with tracing.span("storage.upload", path=dpath, bytes=len(d[kind])):
+                bucket.blob(dpath).upload_from_string(d[kind], content_type="image/jpeg")
+            fields[f"{kind}_path"] = dpath
+            fields[f"{kind}_size"] = len(d[kind])
+    return fields
+
+@traced()
+def ensure(bucket, att_snap):
+    # Adjuntos subidos antes de existir los derivados: se generan la primera vez que se usan
+    ad = att_snap.to_dict() or {}
+    ctype = (ad.get("content_type") or "").lower()
+    if ad.get("embed_path") or ad.get("derived") or not (ctype.startswith("image/") or ctype == "application/pdf"):
+        return ad
+    fields = store(bucket, ad["path"], bucket.blob(ad["path"]).download_as_bytes(), ctype)
+    att_snap.reference.update(fields)
+    return {**ad, **fields}
@@ -0,0 +1,185 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore as gcf
+from core.firebase import get_db, run_transaction
+from core import uow
+from core.tracing import traced
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+EVENT_LAG_SECONDS = int(_get("EVENT_LAG_SECONDS", 10))   # margen para commits con timestamp anterior aún en vuelo
+FOLD_BATCH = int(_get("EVENT_FOLD_BATCH", 500))
+
+# Registro de eventos append-only (colección `events`) y vistas materializadas
+# (colección `views`). Cada vista guarda su estado y el offset (ts + ids ya
+# aplicados con ese ts); fold() aplica solo los eventos nuevos y replay()
+# reconstruye desde cero. Los eventos más nuevos que EVENT_LAG_SECONDS se
+# dejan para la próxima pasada: el ts lo asigna el servidor al confirmar y
+# dos escrituras concurrentes pueden llegar desordenadas.
+
+def record(kind, agreement_id, installment_id=None, actor=None, status=None, prev=None,
+           amount=None, batch=None, db=None, **data):
+    db = db or get_db()
+    batch = batch if batch is not None else uow.current()   # dentro de una acción, con sus escrituras
+    ref = db.collection("events").document()
+    ev = {"kind": kind, "agreement_id": agreement_id, "installment_id": installment_id,
+          "actor": actor, "status": status, "from": prev, "amount": amount,
+          "data": data or None, "ts": gcf.SERVER_TIMESTAMP}
+    if batch is not None:
+        batch.set(ref, ev)
+    else:
+        ref.set(ev)
+    return ref
+
+@traced()
+def transition(ref, fields, kind, agreement_id, installment_id=None, db=None, **event):
+    # Cambio de estado y su evento en un mismo batch
+    db = db or get_db()
+    pending = uow.current()
+    if pending is not None:
+        pending.update(ref, fields)
+        record(kind, agreement_id, installment_id, batch=pending, db=db, **event)
+        return
+    if getattr(ref, "embedded", False):
+        # Cuota embebida en el convenio: se reescriben sus columnas en una transacción con el evento
+        ref.update(fields, on_tx=lambda tx: record(kind, agreement_id, installment_id, batch=tx, db=db, **event))
+        return
+    batch = db.batch()
+    batch.update(ref, fields)
+    record(kind, agreement_id, installment_id, batch=batch, db=db, **event)
+    batch.commit()
+
+@traced()
+def history(db, agreement_id, limit=200):
+    q = db.collection("events").where("agreement_id", "==", agreement_id).order_by("ts").limit(limit)
+    return [e.to_dict() for e in q.stream()]
+
+# --- vistas ---
+
+VIEWS = {}
+
+def view(name):
+    def deco(fn):
+        VIEWS[name] = fn
+        return fn
+    return deco
+
+@view("agreement_status")
+def _agreement_status(state, ev):
+    counts = state.setdefault("counts", {})
+    if ev.get("from"):
+        counts[ev["from"]] = counts.get(ev["from"], 0) - 1
+    if ev.get("status"):
+        counts[ev["status"]] = counts.get(ev["status"], 0) + 1
+
+@view("activity_by_actor")
+def _activity_by_actor(state, ev):
+    row = state.setdefault(ev.get("actor") or "(sistema)", {})
+    row[ev["kind"]] = row.get(ev["kind"], 0) + 1
+    if ev["kind"] in ("INSTALLMENT_PAID", "RECEIPT_APPROVED") and ev.get("amount"):
+        row["collected"] = round(row.get("collected", 0.0) + float(ev["amount"]), 2)
+    elif ev["kind"] == "INSTALLMENT_UNPAID" and ev.get("amount"):
+        row["collected"] = round(row.get("collected", 0.0) - float(ev["amount"]), 2)
+
+@view("daily_activity")
+def _daily_activity(state, ev):
+    ts = ev.get("ts")
+    day = ts.date().isoformat() if hasattr(ts, "date") else "?"
+    row = state.setdefault(day, {})
+    row[ev["kind"]] = row.get(ev["kind"], 0) + 1
+    # Ventana acotada para que el documento no crezca sin límite
+    for old in sorted(state)[:-90]:
+        del state[old]
+
+def _pending(db, offset_ts, offset_ids, horizon):
+    q = db.collection("events").where("ts", "<=", horizon)
+    if offset_ts is not None:
+        q = q.where("ts", ">=", offset_ts)
+    q = q.order_by("ts").limit(FOLD_BATCH + len(offset_ids))
+    skip = set(offset_ids)
+    return [e for e in q.stream() if e.id not in skip]
+
+@traced()
+def fold(db, name, reset=False):
+    # Aplica los eventos pendientes a la vista; devuelve el estado actualizado
+    apply = VIEWS[name]
+    ref = db.collection("views").document(name)
+    horizon = datetime.now(timezone.utc) - timedelta(seconds=EVENT_LAG_SECONDS)
+    while True:
+        snap = ref.get()
+        cur = snap.to_dict() if snap.exists and not reset else {}
+        state = cur.get("state") or {}
+        offset_ts, offset_ids, applied = cur.get("offset_ts"), cur.get("offset_ids") or [], cur.get("applied", 0)
+        evs = _pending(db, offset_ts, offset_ids, horizon)
+        if not evs and not reset:
+            return state
+        for e in evs:
+            apply(state, e.to_dict())
+        if evs:
+            last = evs[-1].to_dict()["ts"]
+            same = [e.id for e in evs if e.to_dict()["ts"] == last]
+            offset_ids = (offset_ids + same) if last == offset_ts else same
+            offset_ts = last
+
+        def write(tx, expected=applied, was_reset=reset):
+            s = tx.get(ref)
+            now_applied = (s.to_dict() or {}).get("applied", 0) if s.exists else 0
+            if not was_reset and now_applied != expected:
+                return False   # otra sesión avanzó la vista: se reintenta desde su estado
+            tx.set(ref, {"state": state, "offset_ts": offset_ts, "offset_ids": offset_ids,
+                         "applied": (0 if was_reset else expected) + len(evs),
+                         "updated_at": gcf.SERVER_TIMESTAMP})
+            return True
+        if not run_transaction(db, write):
+            continue
+        reset = False
+        if len(evs) < FOLD_BATCH:
+            return state
+
+def replay(db, name):
+    return fold(db, name, reset=True)
+
+@traced()
+def backfill(db, actor=None):
+    # Una vez: un evento AGREEMENT_IMPORTED por convenio existente, para que
+    # las vistas partan del estado actual y no de una colección vacía
+    meta = db.collection("views").document("_meta")
+    if meta.get().exists:
+        return 0
+    # Convenios que ya tienen eventos: se importa el estado previo al primer
+    # evento registrado (o nada, si nacieron con AGREEMENT_CREATED)
+    first = {}
+    for e in db.collection("events").order_by("ts").stream():
+        first.setdefault(e.to_dict().get("agreement_id"), e.to_dict())
+    n = 0
+    batch = db.batch()
+    for ag in db.collection("agreements").stream():
+        ev = first.get(ag.id)
+        if ev is not None and ev.get("kind") == "AGREEMENT_CREATED":
+            continue
+        status = ev.get("from") if ev is not None and ev.get("from") else (ag.to_dict() or {}).get("status", "DRAFT")
+        record("AGREEMENT_IMPORTED", ag.id, actor=actor, status=status, batch=batch, db=db)
+        n += 1
+        if n % 400 == 0:
+            batch.commit(); batch = db.batch()
+    batch.set(meta, {"backfilled_at": gcf.SERVER_TIMESTAMP, "imported": n})
+    batch.commit()
+    return n
+
+def is_backfilled(db):
+    return db.collection("views").document("_meta").get().exists
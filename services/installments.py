@@ -1,37 +1,85 @@
 from datetime import date
 from google.cloud import firestore as gcf
 from core import calc
+from services.reminders import next_reminder_at, shard_of
+from services.mirror import get_mirror
+from services import events, schedule
+from core import uow
+from core.tracing import traced
 
-def generate_schedule(db, ag_ref):
-    ag = ag_ref.get().to_dict()
-    for it in ag_ref.collection("installments").stream():
-        it.reference.delete()
+def read_installments(ag_doc):
+    # Lectura directa, sin espejo: columnas del propio convenio o subcolección ordenada
+    if schedule.is_embedded(ag_doc):
+        return schedule.rows(ag_doc)
+    return list(ag_doc.reference.collection("installments").order_by("number").stream())
+
+@traced()
+def list_installments(db, ag_doc):
+    # Cronograma embebido: ya vino con el convenio. Si no, del espejo en
+    # memoria si está listo o consulta ordenada por número
+    if schedule.is_embedded(ag_doc):
+        return schedule.rows(ag_doc)
+    mirror = get_mirror(db)
+    items = mirror.installments(ag_doc.reference) if mirror else None
+    if items is None:
+        items = read_installments(ag_doc)
+    return items
+
+@traced()
+def generate_schedule(db, ag_ref, ag=None):
+    # ag: datos del convenio si todavía no están escritos (misma unidad de trabajo)
+    ag = ag if ag is not None else ag_ref.get().to_dict()
+    embedded = schedule.is_embedded(ag)
     if ag["method"] == "declining":
         items = calc.schedule_declining(ag["principal"], ag["interest_rate"], ag["installments"], date.fromisoformat(ag["start_date"]))
     else:
         items = calc.schedule_french(ag["principal"], ag["interest_rate"], ag["installments"], date.fromisoformat(ag["start_date"]))
-    batch = db.batch()
-    for it in items:
-        doc_ref = ag_ref.collection("installments").document()
-        batch.set(doc_ref, {**it, "paid": False, "paid_at": None,
-                            "last_reminder_sent": None,
-                            "receipt_status": None, "receipt_url": None, "receipt_note": None})
-    batch.commit()
+    rows = [{**it, "paid": False, "paid_at": None,
+             "last_reminder_sent": None,
+             "next_reminder_at": next_reminder_at(it["due_date"]),
+             "receipt_status": None, "receipt_url": None, "receipt_note": None,
+             "updated_at": gcf.SERVER_TIMESTAMP} for it in items]
+    with uow.batch(db) as batch:
+        if embedded:
+            # El cronograma completo reemplaza al anterior en una sola escritura del convenio
+            batch.update(ag_ref, schedule.schedule_fields(rows))
+        else:
+            for it in ag_ref.collection("installments").stream():
+                batch.delete(it.reference)
+            for row in rows:
+                batch.set(ag_ref.collection("installments").document(), {**row, "shard": shard_of(ag_ref.id)})
+        events.record("SCHEDULE_GENERATED", ag_ref.id, amount=round(sum(it["total"] for it in items), 2),
+                      batch=batch, db=db, installments=len(items))
 
-def mark_paid(inst_ref, manual_note: str = None):
-    inst_ref.update({
+@traced()
+def mark_paid(inst_ref, manual_note: str = None, actor=None):
+    d = inst_ref.get().to_dict()
+    receipt_status = d.get("receipt_status")
+    events.transition(inst_ref, {
         "paid": True,
         "paid_at": gcf.SERVER_TIMESTAMP,
-        "receipt_status": "APPROVED" if not inst_ref.get().to_dict().get("receipt_status") else inst_ref.get().to_dict().get("receipt_status"),
-        "receipt_note": manual_note
-    })
+        "receipt_status": receipt_status or "APPROVED",
+        "receipt_note": manual_note,
+        "next_reminder_at": None,
+        "updated_at": gcf.SERVER_TIMESTAMP
+    }, "INSTALLMENT_PAID", inst_ref.parent.parent.id, inst_ref.id, actor=actor,
+        amount=d.get("total"), number=d.get("number"), manual=bool(manual_note))
 
-def mark_unpaid(inst_ref):
-    inst_ref.update({"paid": False, "paid_at": None})
+@traced()
+def mark_unpaid(inst_ref, actor=None):
+    d = inst_ref.get().to_dict()
+    events.transition(inst_ref, {"paid": False, "paid_at": None, "updated_at": gcf.SERVER_TIMESTAMP,
+                                 "next_reminder_at": next_reminder_at(d["due_date"], d.get("last_reminder_sent"))},
+                      "INSTALLMENT_UNPAID", inst_ref.parent.parent.id, inst_ref.id, actor=actor,
+                      amount=d.get("total"), number=d.get("number"))
 
-def auto_complete_if_all_paid(db, ag_doc):
-    items = list(ag_doc.reference.collection("installments").stream())
+@traced()
+def auto_complete_if_all_paid(db, ag_doc, actor=None):
+    # Las columnas embebidas del snapshot recibido pueden ser anteriores al pago: se relee
+    items = read_installments(ag_doc.reference.get() if schedule.is_embedded(ag_doc) else ag_doc)
     if items and all(it.to_dict().get("paid") for it in items):
-        ag_doc.reference.update({"status":"COMPLETED","completed_at":gcf.SERVER_TIMESTAMP})
+        events.transition(ag_doc.reference, {"status":"COMPLETED","completed_at":gcf.SERVER_TIMESTAMP,"updated_at":gcf.SERVER_TIMESTAMP},
+                          "AGREEMENT_COMPLETED", ag_doc.id, db=db, actor=actor,
+                          status="COMPLETED", prev=(ag_doc.to_dict() or {}).get("status"))
         return True
     return False
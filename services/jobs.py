@@ -0,0 +1,219 @@
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore as gcf
+from core.firebase import run_transaction
+from core import loader, tracing
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+JOB_WORKERS = int(_get("JOB_WORKERS", 2))
+JOB_MAX_ATTEMPTS = int(_get("JOB_MAX_ATTEMPTS", 3))
+JOB_POLL_SECONDS = float(_get("JOB_POLL_SECONDS", 60))
+JOB_STALE_SECONDS = int(_get("JOB_STALE_SECONDS", 300))   # RUNNING sin latido: el proceso murió
+
+# Tareas pesadas fuera del rerun: la UI crea un documento en `jobs` y un pool
+# de hilos del proceso lo ejecuta. El estado y el progreso quedan en el
+# documento, así que sobreviven a la sesión; un sondeo periódico retoma los
+# QUEUED pendientes y los RUNNING abandonados.
+
+HANDLERS = {}
+
+def job_handler(kind):
+    def deco(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return deco
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def new_job(db, kind, params, user=None, batch=None):
+    # Con batch, el job se confirma junto con el resto de las escrituras del llamador
+    ref = db.collection("jobs").document()
+    data = {
+        "kind": kind, "params": params, "status": "QUEUED", "attempts": 0,
+        "max_attempts": JOB_MAX_ATTEMPTS, "progress": 0.0, "message": "En cola",
+        "done_steps": [], "error": None,
+        "created_by": (user or {}).get("email"), "created_at": gcf.SERVER_TIMESTAMP,
+        "updated_at": gcf.SERVER_TIMESTAMP,
+    }
+    if batch is not None:
+        batch.set(ref, data)
+    else:
+        ref.set(data)
+    return ref
+
+def submit(db, job_ref):
+    get_runner(db).submit(job_ref.id)
+
+def retry_job(db, job_id):
+    db.collection("jobs").document(job_id).update({
+        "status": "QUEUED", "attempts": 0, "error": None, "message": "Reintento manual",
+        "updated_at": gcf.SERVER_TIMESTAMP,
+    })
+    get_runner(db).submit(job_id)
+
+class JobContext:
+    def __init__(self, db, ref, data):
+        self.db = db
+        self.ref = ref
+        self.params = data.get("params") or {}
+        self.done_steps = set(data.get("done_steps") or [])
+
+    def progress(self, fraction, message=""):
+        self.ref.update({"progress": float(fraction), "message": message,
+                         "heartbeat_at": _now(), "updated_at": gcf.SERVER_TIMESTAMP})
+
+    def step(self, name, fn):
+        # Pasos idempotentes: si un reintento ya lo completó, no se repite (p. ej. un email)
+        if name in self.done_steps:
+            return
+        fn()
+        self.done_steps.add(name)
+        self.ref.update({"done_steps": gcf.ArrayUnion([name]), "heartbeat_at": _now()})
+
+class JobRunner:
+    def __init__(self, db):
+        self.db = db
+        self.pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+        self._inflight = set()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._poll, name="job-poller", daemon=True).start()
+
+    def submit(self, job_id):
+        with self._lock:
+            if job_id in self._inflight:
+                return
+            self._inflight.add(job_id)
+        self.pool.submit(self._run, job_id)
+
+    def _claim(self, ref):
+        def fn(tx):
+            snap = tx.get(ref)
+            d = snap.to_dict() if snap.exists else None
+            if not d or d.get("status") != "QUEUED":
+                return None
+            tx.update(ref, {"status": "RUNNING", "attempts": d.get("attempts", 0) + 1,
+                            "started_at": _now(), "heartbeat_at": _now(),
+                            "updated_at": gcf.SERVER_TIMESTAMP})
+            d["attempts"] = d.get("attempts", 0) + 1
+            return d
+        return run_transaction(self.db, fn)
+
+    def _run(self, job_id):
+        ref = self.db.collection("jobs").document(job_id)
+        loader.begin()   # cada tarea es un pedido nuevo: nada memorizado de la anterior
+        try:
+            with tracing.span("job.run", job_id=job_id) as sp:
+                self._run_claimed(ref, job_id, sp)
+        finally:
+            with self._lock:
+                self._inflight.discard(job_id)
+
+    def _run_claimed(self, ref, job_id, sp):
+        data = self._claim(ref)
+        if data is None:
+            return
+        sp.set(kind=data.get("kind"), attempt=data["attempts"],
+               agreement_id=(data.get("params") or {}).get("agreement_id"))
+        handler = HANDLERS.get(data.get("kind"))
+        if handler is None:
+            ref.update({"status": "FAILED", "error": f"Tipo de tarea desconocido: {data.get('kind')}",
+                        "updated_at": gcf.SERVER_TIMESTAMP})
+            return
+        try:
+            handler(JobContext(self.db, ref, data))
+            ref.update({"status": "DONE", "progress": 1.0, "message": "Completado",
+                        "finished_at": _now(), "updated_at": gcf.SERVER_TIMESTAMP})
+        except Exception as e:
+            LOG.exception("Falló la tarea %s (%s)", job_id, data.get("kind"))
+            sp.set(**{"job.error": f"{e}"})
+            final = data["attempts"] >= data.get("max_attempts", JOB_MAX_ATTEMPTS)
+            ref.update({"status": "FAILED" if final else "QUEUED", "error": f"{e}",
+                        "traceback": traceback.format_exc()[-4000:],
+                        "message": "Falló" if final else f"Reintentando (intento {data['attempts']})",
+                        "updated_at": gcf.SERVER_TIMESTAMP})
+
+    def _poll(self):
+        while True:
+            try:
+                self.recover()
+            except Exception:
+                LOG.exception("Error sondeando tareas")
+            time.sleep(JOB_POLL_SECONDS)
+
+    def recover(self):
+        for snap in self.db.collection("jobs").where("status", "==", "QUEUED").stream():
+            self.submit(snap.id)
+        stale = _now() - timedelta(seconds=JOB_STALE_SECONDS)
+        for snap in self.db.collection("jobs").where("status", "==", "RUNNING").stream():
+            hb = (snap.to_dict() or {}).get("heartbeat_at")
+            if hb is not None and hb < stale and snap.id not in self._inflight:
+                snap.reference.update({"status": "QUEUED", "message": "Retomada tras interrupción",
+                                       "updated_at": gcf.SERVER_TIMESTAMP})
+                self.submit(snap.id)
+
+_RUNNER = None
+_RUNNER_LOCK = threading.Lock()
+
+def get_runner(db) -> JobRunner:
+    global _RUNNER
+    with _RUNNER_LOCK:
+        if _RUNNER is None:
+            _RUNNER = JobRunner(db)
+    return _RUNNER
+
+def list_jobs(db, limit=50):
+    return list(db.collection("jobs").order_by("created_at", direction=gcf.Query.DESCENDING).limit(limit).stream())
+
+# --- Tareas ---
+
+@job_handler("finalize_agreement")
+def _finalize_agreement(ctx):
+    from core.firebase import get_bucket
+    from core.mail import send_email
+    from services.pdf_export import build_agreement_pdf
+    ag_doc = ctx.db.collection("agreements").document(ctx.params["agreement_id"]).get()
+    if not ag_doc.exists:
+        raise ValueError("El convenio ya no existe")
+    ag = ag_doc.to_dict()
+    nombre = ctx.params.get("nombre") or ag_doc.id
+    ctx.progress(0.1, "Generando PDF")
+    pdf_bytes = build_agreement_pdf(ctx.db, get_bucket(), ag_doc, leyenda="Convenio finalizado")
+    asunto = f"{nombre} finalizado"
+    html = "<h4>Convenio finalizado</h4><p>Adjunto PDF con todas las cuotas pagas.</p>"
+    adjuntos = [(f"{nombre}.pdf", pdf_bytes, "application/pdf")]
+    destinos = [("operador", ag.get("operator_email") or ctx.params.get("operator_email")),
+                ("cliente", ag.get("client_email"))]
+    for i, (quien, email) in enumerate(destinos):
+        ctx.progress(0.4 + 0.3 * i, f"Enviando email al {quien}")
+        def enviar(email=email, quien=quien):
+            if email and not send_email(email, asunto, html, attachments=adjuntos):
+                raise RuntimeError(f"No se pudo enviar el email al {quien} ({email})")
+        ctx.step(f"email_{quien}", enviar)
+
+@job_handler("archive_agreements")
+def _archive_agreements(ctx):
+    from core.firebase import get_bucket
+    from services.archive import ARCHIVE_AFTER_MONTHS, run_archival
+    run_archival(ctx.db, get_bucket(), int(ctx.params.get("months") or ARCHIVE_AFTER_MONTHS),
+                 actor=ctx.params.get("actor"), progress=ctx.progress)
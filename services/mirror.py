@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+from core import metrics
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+MIRROR_ENABLED = str(_get("MIRROR_ENABLED", "true")).strip().lower() in {"1","true","yes","on"}
+MIRROR_MAX_DOCS = int(_get("MIRROR_MAX_DOCS", 50000))                  # por colección espejada
+RECONNECT_BACKOFF = float(_get("MIRROR_RECONNECT_SECONDS", 5))
+DISABLED_BACKOFF = float(_get("MIRROR_DISABLED_SECONDS", 600))          # reintento tras superar el límite (se duplica, hasta 1 h)
+INDEXED_FIELDS = ("operator_id", "client_email", "status")
+
+# Espejo en memoria, compartido por todas las sesiones del proceso, alimentado
+# por listeners on_snapshot. Las páginas leen de acá sin ir a la red; si el
+# espejo no está listo (o el backend no soporta listeners) vuelven a consultar.
+
+class _Feed:
+    def __init__(self, name, query_fn):
+        self.name = name
+        self.query_fn = query_fn
+        self.watch = None
+        self.ready = threading.Event()
+        self.disabled = False
+        self.disabled_until = 0.0
+        self.disables = 0        # deshabilitaciones seguidas (backoff)
+        self.docs = 0
+        self.last_attempt = 0.0
+
+class Mirror:
+    def __init__(self, db):
+        self._db = metrics.unwrap(db)
+        self._lock = threading.RLock()
+        self._agreements: Dict[str, object] = {}
+        self._index = {f: defaultdict(set) for f in INDEXED_FIELDS}
+        self._installments: Dict[str, Dict[str, object]] = defaultdict(dict)   # path convenio -> {path cuota: snap}
+        self._version = 0                    # cambia con cada cambio aplicado (caché del tamaño en stats)
+        self._bytes = (None, 0)
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+        self._feeds = {
+            "agreements": _Feed("agreements", lambda: self._db.collection("agreements")),
+            "installments": _Feed("installments", lambda: self._db.collection_group("installments")),
+        }
+
+    # --- suscripción ---
+
+    def start(self):
+        for feed in self._feeds.values():
+            self._subscribe(feed)
+        return self
+
+    def _subscribe(self, feed):
+        feed.last_attempt = time.monotonic()
+        feed.ready.clear()
+        try:
+            feed.watch = feed.query_fn().on_snapshot(lambda docs, changes, read_time, f=feed: self._on_snapshot(f, changes))
+        except Exception as e:
+            self.last_error = f"{feed.name}: {e}"
+            LOG.warning("No se pudo suscribir el espejo de %s: %s", feed.name, e)
+            feed.watch = None
+
+    def _ensure(self, feed):
+        # Reconexión perezosa: si el listener se cayó, se vuelve a suscribir
+        # (como mucho una vez cada RECONNECT_BACKOFF segundos)
+        if feed.disabled:
+            if time.monotonic() < feed.disabled_until:
+                return False
+            LOG.info("Reintentando espejo de %s tras deshabilitarlo por tamaño", feed.name)
+            feed.disabled = False
+            self._subscribe(feed)
+            return False
+        if feed.watch is not None and feed.watch.is_active:
+            return feed.ready.is_set()
+        if time.monotonic() - feed.last_attempt >= RECONNECT_BACKOFF:
+            if feed.watch is not None:
+                try: feed.watch.unsubscribe()
+                except Exception: pass
+            self.reconnects += 1
+            LOG.info("Reconectando espejo de %s", feed.name)
+            self._subscribe(feed)
+        return False
+
+    def close(self):
+        for feed in self._feeds.values():
+            if feed.watch is not None:
+                try: feed.watch.unsubscribe()
+                except Exception: pass
+
+    # --- aplicación de cambios ---
+
+    def _on_snapshot(self, feed, changes):
+        with self._lock:
+            if feed.disabled:
+                return   # llamadas ya encoladas del listener dado de baja
+            if not feed.ready.is_set():
+                # Primer snapshot tras (re)conectar: trae el conjunto completo
+                self._clear(feed.name)
+            self._version += 1
+            for ch in changes:
+                snap = ch.document
+                if ch.type.name == "REMOVED":
+                    self._remove(feed.name, snap.reference)
+                else:
+                    self._put(feed.name, snap)
+                    # El límite se controla documento a documento y por colección
+                    if feed.docs > MIRROR_MAX_DOCS:
+                        self._disable(feed)
+                        return
+            feed.disables = 0
+        feed.ready.set()
+
+    def _disable(self, feed):
+        # Memoria acotada: si se excede el límite, se deja de espejar esa
+        # colección (las páginas vuelven a consultar Firestore) y se reintenta
+        # tras un backoff que se duplica mientras siga excediendo
+        wait = min(DISABLED_BACKOFF * 2 ** feed.disables, 3600.0)
+        LOG.warning("Espejo de %s deshabilitado por %ss: supera MIRROR_MAX_DOCS=%s", feed.name, int(wait), MIRROR_MAX_DOCS)
+        feed.disabled = True
+        feed.disables += 1
+        feed.disabled_until = time.monotonic() + wait
+        feed.ready.clear()
+        if feed.watch is not None:
+            try: feed.watch.unsubscribe()
+            except Exception: pass
+        self._clear(feed.name)
+
+    def _clear(self, name):
+        if name == "agreements":
+            self._agreements.clear()
+            for idx in self._index.values():
+                idx.clear()
+        else:
+            self._installments.clear()
+        self._feeds[name].docs = 0
+        self._version += 1
+
+    def _put(self, name, snap):
+        path = snap.reference.path
+        self._remove(name, snap.reference)
+        self._feeds[name].docs += 1
+        if name == "agreements":
+            self._agreements[path] = snap
+            data = snap.to_dict() or {}
+            for f in INDEXED_FIELDS:
+                self._index[f][data.get(f)].add(path)
+        else:
+            self._installments[path.rsplit("/", 2)[0]][path] = snap
+
+    def _remove(self, name, ref):
+        path = ref.path
+        if name == "agreements":
+            old = self._agreements.pop(path, None)
+            if old is not None:
+                self._feeds[name].docs -= 1
+                data = old.to_dict() or {}
+                for f in INDEXED_FIELDS:
+                    self._index[f][data.get(f)].discard(path)
+        else:
+            items = self._installments.get(path.rsplit("/", 2)[0])
+            if items is not None and items.pop(path, None) is not None:
+                self._feeds[name].docs -= 1
+                if not items:
+                    del self._installments[path.rsplit("/", 2)[0]]
+
+    # --- lecturas (None = el espejo no puede responder, consultar Firestore) ---
+
+    def agreements(self, **filters) -> Optional[List]:
+        if not self._ensure(self._feeds["agreements"]):
+            return None
+        with self._lock:
+            paths = None
+            for f, v in filters.items():
+                hit = self._index[f].get(v, set())
+                paths = set(hit) if paths is None else paths & hit
+            snaps = [self._agreements[p] for p in (self._agreements if paths is None else paths)]
+        return [metrics.wrap_snapshot(s) for s in sorted(snaps, key=lambda s: s.reference.path)]
+
+    def installments(self, ag_ref) -> Optional[List]:
+        if not self._ensure(self._feeds["installments"]):
+            return None
+        with self._lock:
+            snaps = list(self._installments.get(ag_ref.path, {}).values())
+        snaps.sort(key=lambda s: (s.to_dict() or {}).get("number", 0))
+        return [metrics.wrap_snapshot(s) for s in snaps]
+
+    def _approx_bytes(self):
+        # Solo para el panel: se calcula al pedirlo y se recalcula si hubo cambios
+        with self._lock:
+            version = self._version
+            if self._bytes[0] == version:
+                return self._bytes[1]
+            snaps = list(self._agreements.values()) + [s for items in self._installments.values() for s in items.values()]
+        total = sum(len(json.dumps(s.to_dict() or {}, default=str)) for s in snaps)
+        with self._lock:
+            self._bytes = (version, total)
+        return total
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        approx = self._approx_bytes()
+        with self._lock:
+            return {
+                "docs": sum(f.docs for f in self._feeds.values()),
+                "approx_bytes": approx,
+                "max_docs": MIRROR_MAX_DOCS,
+                "reconnects": self.reconnects,
+                "feeds": {f.name: (f"deshabilitado (reintenta en {max(0, int(f.disabled_until - now))} s)" if f.disabled else
+                                   f"listo ({f.docs})" if f.ready.is_set() and f.watch is not None and f.watch.is_active else
+                                   "conectando") for f in self._feeds.values()},
+                "last_error": self.last_error,
+            }
+
+_MIRROR = None
+_MIRROR_LOCK = threading.Lock()
+
+def get_mirror(db) -> Optional[Mirror]:
+    global _MIRROR
+    if not MIRROR_ENABLED or not hasattr(metrics.unwrap(db).collection("agreements"), "on_snapshot"):
+        return None
+    with _MIRROR_LOCK:
+        if _MIRROR is None:
+            _MIRROR = Mirror(db).start()
+    return _MIRROR
+
+def current_stats() -> Optional[Dict]:
+    return _MIRROR.stats() if _MIRROR is not None else None
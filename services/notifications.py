@@ -1,4 +1,7 @@
-from core.mail import send_email, send_email_admins
+from core.mail import admin_emails
+from core import loader
+from services.outbox import queue_email
+from core.tracing import traced
 
 def _base_url(st):
     try:
@@ -6,8 +9,9 @@ def _base_url(st):
     except Exception:
         return "https://example.com"
 
+@traced()
 def notify_agreement_sent(st, db, ag_ref):
-    ag = ag_ref.get().to_dict()
+    ag = loader.snapshot(ag_ref).to_dict()
     base = _base_url(st)
     subject = f"Convenio enviado para aceptación (#{ag_ref.id})"
     html = f"""
@@ -19,14 +23,16 @@ Interés: {ag['interest_rate']*100:.2f}%
 Cuotas: {ag['installments']}
 Ingresá a la app para revisarlo y aceptarlo: {base}
 """
-    op = db.collection("users").document(ag["operator_id"]).get().to_dict()
+    op = loader.user(db, ag["operator_id"]) or {}
     for to in {op.get("email"), ag.get("client_email")}:
-        if to: send_email(to, subject, html)
-    send_email_admins("Nuevo convenio creado",
-                      f"#### Nuevo convenio creado\n\nConvenio #{ag_ref.id}\nOperador: {op.get('email')}\nCliente: {ag.get('client_email')}\nAcceso: {base}")
+        if to: queue_email(to, subject, html)
+    for to in admin_emails():
+        queue_email(to, "Nuevo convenio creado",
+                    f"#### Nuevo convenio creado\n\nConvenio #{ag_ref.id}\nOperador: {op.get('email')}\nCliente: {ag.get('client_email')}\nAcceso: {base}")
 
+@traced()
 def notify_agreement_accepted(st, db, ag_ref):
-    ag = ag_ref.get().to_dict()
+    ag = loader.snapshot(ag_ref).to_dict()
     base = _base_url(st)
     subject = f"Convenio aceptado (#{ag_ref.id})"
     html = f"""
@@ -36,12 +42,13 @@ Cliente: {ag.get('client_email','')}
 El convenio fue aceptado y está activo.
 Acceso: {base}
 """
-    op = db.collection("users").document(ag["operator_id"]).get().to_dict()
+    op = loader.user(db, ag["operator_id"]) or {}
     for to in {op.get("email"), ag.get("client_email")}:
-        if to: send_email(to, subject, html)
+        if to: queue_email(to, subject, html)
 
+@traced()
 def notify_agreement_rejected(st, db, ag_ref, note):
-    ag = ag_ref.get().to_dict()
+    ag = loader.snapshot(ag_ref).to_dict()
     base = _base_url(st)
     subject = f"Convenio rechazado (#{ag_ref.id})"
     html = f"""
@@ -51,22 +58,23 @@ Cliente: {ag.get('client_email','')}
 Motivo: {note}
 Acceso: {base}
 """
-    op = db.collection("users").document(ag["operator_id"]).get().to_dict()
+    op = loader.user(db, ag["operator_id"]) or {}
     for to in {op.get("email"), ag.get("client_email")}:
-        if to: send_email(to, subject, html)
+        if to: queue_email(to, subject, html)
 
+@traced()
 def notify_operator_new_receipt(st, db, ag_doc, inst_num, user_email):
     base = _base_url(st)
-    op = db.collection("users").document(ag_doc.to_dict()["operator_id"]).get().to_dict()
-    send_email(op.get("email"), "Nuevo comprobante/pago declarado",
-               f"#### Nuevo comprobante/pago declarado\n\nConvenio #{ag_doc.id} - Cuota {inst_num}\nDeclarado por: {user_email}\nAcceso: {base}")
+    op = loader.user(db, loader.snapshot(ag_doc).to_dict()["operator_id"]) or {}
+    queue_email(op.get("email"), "Nuevo comprobante/pago declarado",
+                f"#### Nuevo comprobante/pago declarado\n\nConvenio #{ag_doc.id} - Cuota {inst_num}\nDeclarado por: {user_email}\nAcceso: {base}")
 
+@traced()
 def notify_client_receipt_decision(st, db, ag_doc, inst_num, decision, note):
     base = _base_url(st)
-    ag = ag_doc.to_dict()
+    ag = loader.snapshot(ag_doc).to_dict()
     email = ag.get("client_email")
     if ag.get("client_id"):
-        cl = db.collection("users").document(ag["client_id"]).get().to_dict()
-        email = (cl or {}).get("email") or email
-    send_email(email, "Resultado de verificación de pago",
-               f"#### Resultado de verificación de pago\n\nConvenio #{ag_doc.id} - Cuota {inst_num}\nEstado: **{decision}**\nDetalle: {note or '(sin detalle)'}\nAcceso: {base}")
+        email = (loader.user(db, ag["client_id"]) or {}).get("email") or email
+    queue_email(email, "Resultado de verificación de pago",
+                f"#### Resultado de verificación de pago\n\nConvenio #{ag_doc.id} - Cuota {inst_num}\nEstado: **{decision}**\nDetalle: {note or '(sin detalle)'}\nAcceso: {base}")
@@ -0,0 +1,291 @@
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from core.mail import send_many
+from core import tracing
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+DIGEST_WINDOW_SECONDS = float(_get("MAIL_DIGEST_WINDOW_SECONDS", 60))   # 0 = envío inmediato
+RATE_PER_HOUR = int(_get("MAIL_MAX_PER_RECIPIENT_HOUR", 6))             # 0 = sin límite
+RETRY_SECONDS = float(_get("MAIL_RETRY_SECONDS", 300))                  # espera tras un envío fallido
+LEASE_SECONDS = float(_get("MAIL_OUTBOX_LEASE_SECONDS", 900))           # reserva de un evento por proceso
+COLLECTION = "outbox"
+
+# Cola de notificaciones por destinatario: los eventos que llegan dentro de la
+# ventana se juntan en un único email (digest) y se envían todos los
+# destinatarios vencidos en una sola sesión SMTP. Si un destinatario alcanzó
+# su límite por hora, sus eventos siguen acumulándose para el próximo digest.
+# Cada evento queda además en la colección `outbox` hasta que el SMTP confirma
+# el envío: un digest fallido vuelve a la cola (reintento en RETRY_SECONDS) y
+# lo pendiente al reiniciar el proceso se recupera de ahí. Cada documento lleva
+# owner/lease_until: un proceso solo envía lo que tiene reservado (reserva en
+# transacción antes de cada sesión SMTP) y solo recupera lo que nadie tiene
+# reservado, así varias réplicas no mandan el mismo digest.
+
+def _default_db():
+    from core.firebase import get_db
+    return get_db()
+
+class Outbox:
+    def __init__(self, window=DIGEST_WINDOW_SECONDS, rate=RATE_PER_HOUR, sender=send_many, db=_default_db):
+        self.window = window
+        self.rate = rate
+        self._send = sender
+        self._db = db                        # callable -> cliente; None = solo en memoria
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._restored = db is None
+        self._next_scan = 0.0
+        self._cond = threading.Condition()
+        self._pending = defaultdict(list)    # destinatario -> [(asunto, html, id en outbox)]
+        self._due = {}                       # destinatario -> instante de envío
+        self._sent = defaultdict(deque)      # destinatario -> envíos confirmados de la última hora
+        self._thread = None
+        self.stats = {"events": 0, "emails": 0, "sessions": 0, "failed": 0, "restored": 0, "taken_over": 0}
+
+    def _store(self, to, subject, html):
+        if self._db is None:
+            return None
+        try:
+            ref = self._db().collection(COLLECTION).document()
+            now = datetime.now(timezone.utc)
+            ref.set({"to": to, "subject": subject, "html": html, "created_at": now, "owner": self._owner,
+                     "lease_until": now + timedelta(seconds=self.window + LEASE_SECONDS)})
+            return ref.id
+        except Exception:
+            # Sin base no se pierde el aviso: queda en memoria como antes
+            LOG.exception("No se pudo guardar la notificación para %s en %s", to, COLLECTION)
+            return None
+
+    def _forget(self, ids):
+        ids = [i for i in ids if i]
+        if not ids or self._db is None:
+            return
+        try:
+            db = self._db()
+            for k in range(0, len(ids), 450):
+                batch = db.batch()
+                for doc_id in ids[k:k + 450]:
+                    batch.delete(db.collection(COLLECTION).document(doc_id))
+                batch.commit()
+        except Exception:
+            # Quedan en la colección: vencida la reserva se reenviarían (duplicado antes que pérdida)
+            LOG.exception("No se pudieron borrar %s notificación(es) enviadas de %s", len(ids), COLLECTION)
+
+    def _claim(self, ids):
+        # -> ids que este proceso tiene reservados (los renueva). Un evento sin
+        # documento o ya reservado por otra réplica vigente no se toma.
+        from core.firebase import run_transaction
+        db = self._db()
+        now = datetime.now(timezone.utc)
+        until = now + timedelta(seconds=LEASE_SECONDS)
+        claimed = set()
+        for k in range(0, len(ids), 200):
+            refs = [db.collection(COLLECTION).document(i) for i in ids[k:k + 200]]
+            def fn(tx, refs=refs):
+                snaps = [tx.get(r) for r in refs]
+                got = []
+                for ref, snap in zip(refs, snaps):
+                    d = (snap.to_dict() or {}) if snap.exists else None
+                    if d is None:
+                        continue   # otra réplica ya lo envió y lo borró
+                    if d.get("owner") not in (None, self._owner) and d.get("lease_until") and d["lease_until"] > now:
+                        continue
+                    tx.update(ref, {"owner": self._owner, "lease_until": until})
+                    got.append(ref.id)
+                return got
+            claimed.update(run_transaction(db, fn))
+        return claimed
+
+    def _restore(self):
+        # Una vez al arrancar el proceso: lo que quedó sin confirmar en la colección vuelve a la cola
+        with self._cond:
+            if self._restored:
+                return
+            self._restored = True
+        self._scan()
+
+    def _scan(self):
+        # Reservas vencidas (proceso caído, réplica que se reinició): se reservan y vuelven a la cola
+        self._next_scan = time.monotonic() + LEASE_SECONDS
+        now = datetime.now(timezone.utc)
+        try:
+            docs = list(self._db().collection(COLLECTION).stream())
+            with self._cond:
+                known = {i for events in self._pending.values() for _, _, i in events}
+            free = []
+            for d in docs:
+                data = d.to_dict() or {}
+                busy = data.get("owner") not in (None, self._owner) and data.get("lease_until") and data["lease_until"] > now
+                if d.id not in known and data.get("to") and not busy:
+                    free.append((d.id, data))
+            claimed = self._claim([i for i, _ in free]) if free else set()
+        except Exception:
+            LOG.exception("No se pudo leer la cola %s", COLLECTION)
+            return
+        free.sort(key=lambda f: str(f[1].get("created_at") or ""))
+        with self._cond:
+            mono = time.monotonic()
+            for i, data in free:
+                if i not in claimed:
+                    continue
+                self._pending[data["to"]].append((data.get("subject", ""), data.get("html", ""), i))
+                self._due.setdefault(data["to"], mono + self.window)
+                self.stats["restored"] += 1
+            self._wake(bool(claimed))
+
+    def _wake(self, thread=False):
+        # Con el lock tomado. Con ventana 0 el hilo solo hace falta para reintentos y lo recuperado
+        if self._thread is None and (self.window > 0 or thread):
+            self._thread = threading.Thread(target=self._loop, name="mail-outbox", daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def enqueue(self, to, subject, html):
+        if not to:
+            return
+        self._restore()
+        doc_id = self._store(to, subject, html)
+        with self._cond:
+            self.stats["events"] += 1
+            self._pending[to].append((subject, html, doc_id))
+            self._due.setdefault(to, time.monotonic() + self.window)
+            self._wake()
+        if self.window <= 0:
+            self.flush()
+
+    def resume(self):
+        self._restore()
+
+    def _allowed_at(self, to, now):
+        sent = self._sent[to]
+        while sent and now - sent[0] >= 3600:
+            sent.popleft()
+        if self.rate <= 0 or len(sent) < self.rate:
+            return now
+        return sent[0] + 3600
+
+    def _take(self, force=False):
+        now = time.monotonic()
+        slack = self.window / 4   # los que vencen enseguida comparten la sesión SMTP
+        batch = []
+        for to, due in list(self._due.items()):
+            if not force:
+                due = max(due, self._allowed_at(to, now))
+                self._due[to] = due
+                if due > now + slack:
+                    continue
+            batch.append((to, self._pending.pop(to)))
+            del self._due[to]
+        return batch
+
+    def flush(self, force=False):
+        with self._cond:
+            batch = self._take(force)
+        if not batch:
+            return 0
+        if self._db is not None:
+            # Reserva antes de la sesión SMTP: lo que otra réplica tiene reservado no se envía aquí
+            ids = [i for _, events in batch for _, _, i in events if i]
+            try:
+                mine = self._claim(ids) if ids else set()
+            except Exception:
+                LOG.exception("No se pudo reservar el digest en %s", COLLECTION)
+                self._requeue(batch, {to for to, _ in batch})
+                return 0
+            kept = [(to, [e for e in events if not e[2] or e[2] in mine]) for to, events in batch]
+            with self._cond:
+                self.stats["taken_over"] += len(ids) - len(mine)
+            batch = [(to, events) for to, events in kept if events]
+            if not batch:
+                return 0
+        messages = [(to,) + _digest(events) for to, events in batch]
+        with tracing.span("outbox.flush", recipients=len(messages), events=sum(len(e) for _, e in batch)) as sp:
+            try:
+                failed = set(self._send(messages))
+            except Exception:
+                LOG.exception("Error en la sesión SMTP del digest")
+                failed = {to for to, _ in batch}
+            sp.set(failed=len(failed))
+        with self._cond:
+            self.stats["sessions"] += 1
+            self.stats["emails"] += len(messages) - len(failed)
+            self.stats["failed"] += len(failed)
+        self._requeue(batch, failed)
+        self._forget([i for to, events in batch if to not in failed for _, _, i in events])
+        if failed:
+            LOG.warning("No se pudieron enviar %s digest(s), se reintentan en %ss: %s",
+                        len(failed), int(RETRY_SECONDS), ", ".join(sorted(failed)))
+        return len(messages)
+
+    def _requeue(self, batch, failed):
+        with self._cond:
+            now = time.monotonic()
+            for to, events in batch:
+                if to in failed:
+                    # Vuelven a la cola delante de lo que llegó mientras tanto
+                    self._pending[to][:0] = events
+                    self._due[to] = min(self._due.get(to, now + RETRY_SECONDS), now + RETRY_SECONDS)
+                else:
+                    # El límite por hora cuenta solo lo que el SMTP aceptó
+                    self._sent[to].append(now)
+            if failed:
+                self._wake(True)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                wait = min(self._due.values(), default=now + 3600) - now
+                if self._db is not None:
+                    wait = min(wait, self._next_scan - now)
+                if wait > 0:
+                    self._cond.wait(timeout=wait)
+                    continue
+            try:
+                if self._db is not None and time.monotonic() >= self._next_scan:
+                    self._scan()
+                self.flush()
+            except Exception:
+                LOG.exception("Error enviando notificaciones agrupadas")
+                time.sleep(5)
+
+def _digest(events):
+    if len(events) == 1:
+        return events[0][:2]
+    subject = f"{len(events)} novedades en tus convenios"
+    parts = [f"<p><b>{s}</b></p>\n{h}" for s, h, _ in events]
+    return subject, f"<h4>{subject}</h4>\n" + "\n<hr>\n".join(parts)
+
+_OUTBOX = Outbox()
+# Lo que quede en cola al terminar el proceso se envía igual
+atexit.register(lambda: _OUTBOX.flush(force=True))
+
+def queue_email(to, subject, html):
+    _OUTBOX.enqueue(to, subject, html)
+
+def resume_outbox():
+    _OUTBOX.resume()
+
+def outbox_stats():
+    return dict(_OUTBOX.stats)
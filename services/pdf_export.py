@@ -5,10 +5,15 @@ from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.utils import ImageReader
+from services import derivatives
+from services.installments import read_installments
+from core import tracing
+from core.tracing import traced
 
+@traced()
 def build_agreement_pdf(db, bucket, ag_doc, leyenda=""):
     ag = ag_doc.to_dict()
-    items = list(ag_doc.reference.collection("installments").order_by("number").stream())
+    items = read_installments(ag_doc)
     rows = [["Nº","Vencimiento","Capital","Interés","Total","Estado"]]
     sum_cap = sum(float(it.to_dict()["capital"]) for it in items)
     sum_int = sum(float(it.to_dict()["interest"]) for it in items)
@@ -67,18 +72,25 @@ def build_agreement_pdf(db, bucket, ag_doc, leyenda=""):
         story.append(Paragraph("No hay adjuntos.", styles["Normal"]))
     else:
         for a in atts:
-            ad=a.to_dict()
-            story.append(Paragraph(f"- {ad.get('name')} ({ad.get('content_type','')})", styles["Normal"]))
+            try:
+                ad = derivatives.ensure(bucket, a)
+            except Exception:
+                ad = a.to_dict()
+            paginas = f", {ad['pages']} pág." if ad.get("pages") else ""
+            story.append(Paragraph(f"- {ad.get('name')} ({ad.get('content_type','')}{paginas})", styles["Normal"]))
             ctype = (ad.get("content_type") or "").lower()
             if ctype.startswith("image/"):
                 try:
-                    blob = bucket.blob(ad["path"])
+                    # Versión reducida generada al subir; el original solo si no hay derivado
+                    blob = bucket.blob(ad.get("embed_path") or ad["path"])
                     img_bytes = blob.download_as_bytes()
                     img = Image(ImageReader(io.BytesIO(img_bytes)))
                     img._restrictSize(14*cm,10*cm)
                     story.append(Spacer(1,0.2*cm)); story.append(img); story.append(Spacer(1,0.2*cm))
                 except Exception:
                     pass
-    doc.build(story)
+    with tracing.span("pdf.render", items=len(items), attachments=len(atts)):
+        doc.build(story)
     pdf = buf.getvalue(); buf.close()
+    tracing.set_attrs(**{"pdf.bytes": len(pdf)})
     return pdf
@@ -0,0 +1,249 @@
+import io
+import os
+from datetime import datetime, timezone
+import pandas as pd
+from google.cloud import firestore as gcf
+from core.firebase import run_transaction
+from services import events, schedule
+from services.agreements import list_agreements_for_role
+from services.installments import list_installments
+from core.tracing import traced
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+RECON_AMOUNT_TOLERANCE = float(_get("RECON_AMOUNT_TOLERANCE", 1.0))   # $ de diferencia aceptados
+RECON_DATE_WINDOW_DAYS = int(_get("RECON_DATE_WINDOW_DAYS", 15))     # días entre vencimiento y acreditación
+RECON_TX_WRITES = 450   # escrituras por transacción (Firestore admite 500)
+
+# Conciliación de extractos: las filas del extracto (CSV/Excel del banco o
+# PSP) se cruzan en una sola pasada contra todas las cuotas impagas visibles
+# para el usuario. El cruce es un merge de pandas por identificador del
+# cliente (email, nombre o uid), filtrado por importe y ventana de fechas;
+# después, una asignación uno a uno por rondas (mejor cuota libre de cada
+# fila). La confirmación escribe pagos, eventos y convenios completados en
+# transacciones por grupo de convenios, que vuelven a verificar que cada
+# cuota siga impaga.
+
+COLUMN_ALIASES = {
+    "date": ("fecha", "fecha operacion", "fecha valor", "fecha de pago", "date", "value date"),
+    "amount": ("importe", "monto", "credito", "importe credito", "amount", "credit"),
+    "client": ("email", "mail", "cliente", "titular", "ordenante", "nombre", "client", "payer"),
+    "reference": ("referencia", "concepto", "descripcion", "detalle", "reference", "description"),
+}
+
+def _norm(s):
+    # Minúsculas, sin acentos ni espacios repetidos (vectorizado)
+    return (s.fillna("").astype(str).str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+            .str.lower().str.split().str.join(" "))
+
+def _amounts(s):
+    if pd.api.types.is_numeric_dtype(s):
+        return pd.to_numeric(s, errors="coerce")
+    s = s.fillna("").astype(str).str.replace(r"[^\d,.\-]", "", regex=True)
+    # "1.234,56" (formato local) -> "1234.56"; "1,234.56" -> "1234.56"
+    local = s.str.rfind(",") > s.str.rfind(".")
+    # Sin coma, puntos seguidos de exactamente 3 dígitos son de miles: "15.000", "12.345.678"
+    thousands = ~s.str.contains(",", regex=False) & s.str.fullmatch(r"-?\d+(\.\d{3})+")
+    s = s.where(~(local | thousands), s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    s = s.where(local | thousands, s.str.replace(",", "", regex=False))
+    return pd.to_numeric(s, errors="coerce")
+
+def _dates(s):
+    if not pd.api.types.is_datetime64_any_dtype(s):
+        # ISO (2026-01-10) primero; el resto, día/mes/año como en los extractos locales
+        s = s.astype(str).str.strip()
+        iso = pd.to_datetime(s, format="ISO8601", errors="coerce", utc=True).dt.tz_localize(None)
+        rest = pd.to_datetime(s[iso.isna()], format="mixed", dayfirst=True, errors="coerce", utc=True)
+        return iso.fillna(rest.dt.tz_localize(None))
+    return s.dt.tz_localize(None) if s.dt.tz is not None else s
+
+@traced()
+def read_statement(data, filename):
+    # -> (DataFrame(row, date, amount, client, reference, key), filas ilegibles(row, date, amount, client, reason));
+    # ValueError si no se reconocen las columnas
+    name = (filename or "").lower()
+    if name.endswith((".xlsx", ".xls")):
+        try:
+            raw = pd.read_excel(io.BytesIO(data))
+        except ImportError:
+            raise ValueError("Para leer Excel hace falta openpyxl (pip install openpyxl); también se acepta CSV.")
+    else:
+        text = data.decode("utf-8-sig", errors="replace")
+        raw = pd.read_csv(io.StringIO(text), sep=None, engine="python")
+    cols = {c: _norm(pd.Series([c]))[0] for c in raw.columns}
+    pick = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for c, n in cols.items():
+            if n in aliases and field not in pick:
+                pick[field] = c
+    missing = [f for f in ("date", "amount", "client") if f not in pick]
+    if missing:
+        raise ValueError(f"No se encontraron columnas para: {', '.join(missing)}. "
+                         f"Columnas del archivo: {', '.join(map(str, raw.columns))}")
+    out = pd.DataFrame({
+        "row": range(1, len(raw) + 1),
+        "date": _dates(raw[pick["date"]]),
+        "amount": _amounts(raw[pick["amount"]]),
+        "client": raw[pick["client"]].fillna("").astype(str),
+        "reference": raw[pick["reference"]].fillna("").astype(str) if "reference" in pick else "",
+    })
+    out["key"] = _norm(out["client"])
+    # Débitos y filas sin importe no son pagos; un importe o una fecha que no se pudo leer sí se informa
+    raw_amount = raw[pick["amount"]].fillna("").astype(str).str.strip()
+    reason = pd.Series(None, index=out.index, dtype=object)
+    credit = out["amount"] > 0
+    reason[credit & (out["key"] == "")] = "sin cliente"
+    reason[credit & out["date"].isna()] = "fecha ilegible"
+    reason[out["amount"].isna() & (raw_amount != "")] = "importe ilegible"
+    invalid = pd.DataFrame({"row": out["row"], "date": raw[pick["date"]].astype(str), "amount": raw_amount,
+                            "client": out["client"], "reason": reason})[reason.notna()].reset_index(drop=True)
+    return out[credit & reason.isna()].reset_index(drop=True), invalid
+
+@traced()
+def unpaid_frame(db, user):
+    # Cuotas impagas de los convenios activos visibles para el usuario, una fila por cuota
+    rows = []
+    for ag_doc in list_agreements_for_role(db, user):
+        ag = ag_doc.to_dict() or {}
+        if ag.get("status") != "ACTIVE":
+            continue
+        for inst in list_installments(db, ag_doc):
+            d = inst.to_dict() or {}
+            if d.get("paid"):
+                continue
+            rows.append({"agreement_id": ag_doc.id, "installment_id": inst.id, "number": d.get("number"),
+                         "due_date": d.get("due_date"), "total": d.get("total"),
+                         "receipt_status": d.get("receipt_status"), "client_name": ag.get("client_name") or "",
+                         "client_email": ag.get("client_email") or "", "client_id": ag.get("client_id") or ""})
+    df = pd.DataFrame(rows, columns=["agreement_id", "installment_id", "number", "due_date", "total",
+                                     "receipt_status", "client_name", "client_email", "client_id"])
+    df["due"] = pd.to_datetime(df["due_date"], errors="coerce")
+    df["total"] = pd.to_numeric(df["total"], errors="coerce")
+    return df
+
+def _keys(unpaid):
+    # Cada cuota se puede identificar por email, nombre o uid del cliente
+    long = unpaid.melt(id_vars=["installment_id"], value_vars=["client_email", "client_name", "client_id"],
+                       value_name="key")[["installment_id", "key"]]
+    long["key"] = _norm(long["key"])
+    return long[long["key"] != ""].drop_duplicates()
+
+@traced()
+def match(statement, unpaid, tolerance=RECON_AMOUNT_TOLERANCE, window_days=RECON_DATE_WINDOW_DAYS):
+    # -> (propuestas: una fila por par extracto/cuota, filas del extracto sin cuota)
+    cand = (statement.merge(_keys(unpaid), on="key")
+            .merge(unpaid.drop(columns=["client_name", "client_email", "client_id"]), on="installment_id"))
+    cand["amount_diff"] = (cand["amount"] - cand["total"]).abs().round(2)
+    cand["days"] = (cand["date"] - cand["due"]).dt.days
+    cand = cand[(cand["amount_diff"] <= tolerance) & (cand["days"].abs() <= window_days)]
+    cand = cand.assign(abs_days=cand["days"].abs()).sort_values(["amount_diff", "abs_days", "due", "row"])
+    # Asignación voraz por rondas: en cada una, la mejor cuota de cada fila y la mejor fila de cada cuota
+    chosen = []
+    while len(cand):
+        best = cand.drop_duplicates("row").drop_duplicates("installment_id")
+        chosen.append(best)
+        cand = cand[~cand["row"].isin(best["row"]) & ~cand["installment_id"].isin(best["installment_id"])]
+    cols = ["row", "date", "amount", "client", "reference", "agreement_id", "installment_id", "number",
+            "due_date", "total", "receipt_status", "amount_diff", "days"]
+    matches = (pd.concat(chosen)[cols] if chosen else pd.DataFrame(columns=cols)).sort_values("row").reset_index(drop=True)
+    unmatched = statement[~statement["row"].isin(matches["row"])].drop(columns=["key"]).reset_index(drop=True)
+    return matches, unmatched
+
+def _chunks(groups):
+    # Un convenio con más pagos de los que entran en una transacción se reparte en
+    # varias; cada una vuelve a leer el convenio y solo la última puede completarlo
+    per = (RECON_TX_WRITES - 3) // 2
+    chunk, writes = [], 0
+    for ag_id, ms in groups:
+        for i in range(0, len(ms), per):
+            part = ms[i:i + per]
+            n = 2 * len(part) + 3   # pago + evento por cuota; convenio, evento de cierre y columnas
+            if chunk and (writes + n > RECON_TX_WRITES or any(a == ag_id for a, _ in chunk)):
+                yield chunk
+                chunk, writes = [], 0
+            chunk.append((ag_id, part))
+            writes += n
+    if chunk:
+        yield chunk
+
+def _paid_fields(m):
+    ref = f" ({m['reference']})" if m.get("reference") else ""
+    return {"paid": True, "paid_at": gcf.SERVER_TIMESTAMP, "receipt_status": "APPROVED",
+            "receipt_note": f"Conciliado con extracto, fila {m['row']}{ref}", "next_reminder_at": None,
+            "updated_at": gcf.SERVER_TIMESTAMP}
+
+def _apply_chunk(db, chunk, actor):
+    def fn(tx):
+        out = {"paid": [], "skipped": [], "completed": []}
+        # Firestore exige todas las lecturas antes de la primera escritura
+        state = []
+        for ag_id, ms in chunk:
+            ag_ref = db.collection("agreements").document(ag_id)
+            ag_snap = tx.get(ag_ref)
+            ag = (ag_snap.to_dict() or {}) if ag_snap.exists else {}
+            if schedule.is_embedded(ag):
+                cols = ag.get("schedule") or {}
+                unpaid = {r["id"]: r for r in schedule.unpack(cols) if not r.get("paid")}
+            else:
+                cols = None
+                unpaid = {s.id: s.to_dict() or {} for s in
+                          tx.get(ag_ref.collection("installments").where("paid", "==", False))}
+            state.append((ag_id, ag_ref, ag, cols, unpaid, ms))
+        now = datetime.now(timezone.utc)
+        for ag_id, ag_ref, ag, cols, unpaid, ms in state:
+            ag_fields, paid = {}, 0
+            for m in ms:
+                inst_id = m["installment_id"]
+                if inst_id not in unpaid or ag.get("status") != "ACTIVE":
+                    out["skipped"].append(m)
+                    continue
+                if cols is not None:
+                    schedule.set_row(cols, inst_id, _paid_fields(m), now)
+                else:
+                    tx.update(ag_ref.collection("installments").document(inst_id), _paid_fields(m))
+                events.record("INSTALLMENT_PAID", ag_id, inst_id, actor=actor, amount=unpaid[inst_id].get("total"),
+                              batch=tx, db=db, number=unpaid[inst_id].get("number"), reconciled=True,
+                              statement_row=int(m["row"]), statement_amount=float(m["amount"]))
+                out["paid"].append(m)
+                unpaid.pop(inst_id)
+                paid += 1
+            if not paid:
+                continue
+            if cols is not None:
+                ag_fields.update(schedule.column_fields(cols))
+            if not unpaid:
+                ag_fields.update({"status": "COMPLETED", "completed_at": gcf.SERVER_TIMESTAMP,
+                                  "updated_at": gcf.SERVER_TIMESTAMP})
+                events.record("AGREEMENT_COMPLETED", ag_id, actor=actor, status="COMPLETED", prev="ACTIVE",
+                              batch=tx, db=db)
+                out["completed"].append(ag_id)
+            if ag_fields:
+                tx.update(ag_ref, ag_fields)
+        return out
+    return run_transaction(db, fn)
+
+@traced()
+def apply_matches(db, matches, actor=None):
+    # Confirma las propuestas: -> {"paid": [...], "skipped": [...], "completed": [ag_id, ...]}
+    records = matches.to_dict("records") if hasattr(matches, "to_dict") else list(matches)
+    groups = {}
+    for m in records:
+        groups.setdefault(m["agreement_id"], []).append(m)
+    out = {"paid": [], "skipped": [], "completed": []}
+    for chunk in _chunks(groups.items()):
+        res = _apply_chunk(db, chunk, actor)
+        for k in out:
+            out[k] += res[k]
+    return out
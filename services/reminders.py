@@ -0,0 +1,62 @@
+import hashlib
+import os
+from datetime import datetime, date, time, timedelta, timezone
+import pytz
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+APP_TZ = _get("APP_TZ","America/Argentina/Buenos_Aires")
+REMINDER_DAYS_BEFORE = int(_get("REMINDER_DAYS_BEFORE",3))
+REMINDER_DAYS_AFTER  = int(_get("REMINDER_DAYS_AFTER",3))
+REMINDER_COOLDOWN_DAYS = int(_get("REMINDER_COOLDOWN_DAYS",3))
+TZ = pytz.timezone(APP_TZ)
+SHARD_BUCKETS = 32   # convenios y cuotas llevan shard = bucket del id del convenio (filtro "in" de hasta 30 valores)
+
+def shard_of(ag_id: str) -> int:
+    # Hash estable (no hash() de Python, que varía por proceso)
+    return int(hashlib.sha1(ag_id.encode("utf-8")).hexdigest()[:8], 16) % SHARD_BUCKETS
+
+def shard_buckets(shard: int, shards: int):
+    # Buckets que procesa el shard i de N del worker
+    return [b for b in range(SHARD_BUCKETS) if b % shards == shard]
+
+def _aware(ts: datetime) -> datetime:
+    # Firestore guarda los datetime "naive" como UTC
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+def _as_date(due) -> date:
+    return due if isinstance(due, date) else date.fromisoformat(due)
+
+def _window(due: date):
+    # Desde REMINDER_DAYS_BEFORE días antes del vencimiento hasta el fin del
+    # día REMINDER_DAYS_AFTER después, en hora local (APP_TZ)
+    start = TZ.localize(datetime.combine(due - timedelta(days=REMINDER_DAYS_BEFORE), time.min))
+    end = TZ.localize(datetime.combine(due + timedelta(days=REMINDER_DAYS_AFTER + 1), time.min))
+    return start, end
+
+def next_reminder_at(due, last_sent=None, now=None):
+    # Próximo instante (UTC) en que corresponde avisar, respetando el cooldown
+    # desde el último envío. None = la cuota ya no genera recordatorios (la
+    # ventana terminó o el cooldown cae fuera de ella).
+    start, end = _window(_as_date(due))
+    now = _aware(now) if now is not None else datetime.now(timezone.utc)
+    at = start
+    if last_sent is not None:
+        at = max(at, _aware(last_sent) + timedelta(days=REMINDER_COOLDOWN_DAYS))
+    return at.astimezone(timezone.utc) if at < end and now < end else None
+
+def should_remind(due, last_sent, now: datetime) -> bool:
+    at = next_reminder_at(due, last_sent, now)
+    return at is not None and at <= _aware(now) < _window(_as_date(due))[1]
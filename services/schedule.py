@@ -0,0 +1,218 @@
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from google.cloud import firestore as gcf
+from core.firebase import get_db, run_transaction
+from core.tracing import traced
+from services.reminders import shard_of
+
+try:
+    import streamlit as st
+except Exception:
+    st = None
+
+LOG = logging.getLogger(__name__)
+
+def _get(name, default=None):
+    if st is not None:
+        try:
+            val = st.secrets.get(name, None)
+            if val is not None: return val
+        except Exception:
+            pass
+    return os.environ.get(name, default)
+
+SUBCOLLECTION = "subcollection"
+EMBEDDED = "embedded"
+SCHEDULE_LAYOUT = _get("SCHEDULE_LAYOUT", SUBCOLLECTION)         # layout de los convenios nuevos
+EMBED_MAX_ROWS = int(_get("SCHEDULE_EMBED_MAX_ROWS", 400))       # más cuotas que esto van a subcolección
+
+# Cronograma embebido: en vez de un documento por cuota, el convenio guarda
+# `schedule` como columnas empaquetadas ({campo: [valor por cuota]}, con los
+# IDs en "id"), así ver un convenio cuesta una lectura y crearlo una
+# escritura. Las cuotas se exponen con objetos que imitan snapshot y
+# referencia (ruta `agreements/<id>/installments/<cuota>`), de modo que
+# mark_paid, las transiciones de comprobantes y el PDF no distinguen el
+# layout. El convenio lleva además el menor next_reminder_at de sus cuotas
+# impagas para que el worker lo encuentre sin collection_group.
+
+def is_embedded(ag):
+    d = ag if isinstance(ag, dict) else (ag.to_dict() or {}) if ag is not None and ag.exists else {}
+    return d.get("schedule_layout") == EMBEDDED
+
+def layout_for(installments):
+    if SCHEDULE_LAYOUT == EMBEDDED and int(installments) <= EMBED_MAX_ROWS:
+        return EMBEDDED
+    return SUBCOLLECTION
+
+def new_id():
+    return uuid.uuid4().hex[:20]
+
+def pack(rows):
+    fields = ["id"]
+    for r in rows:
+        fields.extend(f for f in r if f not in fields)
+    return {f: [r.get(f) for r in rows] for f in fields}
+
+def unpack(cols):
+    cols = cols or {}
+    ids = cols.get("id") or []
+    return [{"id": inst_id, **{f: (v[i] if i < len(v) else None) for f, v in cols.items() if f != "id"}}
+            for i, inst_id in enumerate(ids)]
+
+def next_due(cols):
+    cols = cols or {}
+    paid = cols.get("paid") or []
+    pending = [ts for i, ts in enumerate(cols.get("next_reminder_at") or [])
+               if ts is not None and not (paid[i] if i < len(paid) else False)]
+    return min(pending) if pending else None
+
+def _value(v, now):
+    # Los sentinels no pueden ir dentro de un array: se resuelven acá
+    if v is gcf.SERVER_TIMESTAMP:
+        return now
+    if v is gcf.DELETE_FIELD:
+        return None
+    return v
+
+def schedule_fields(rows):
+    # Campos del convenio para guardar (o reemplazar) el cronograma completo
+    now = datetime.now(timezone.utc)
+    rows = [{"id": r.get("id") or new_id(), **{k: _value(v, now) for k, v in r.items() if k != "id"}} for r in rows]
+    return column_fields(pack(rows))
+
+class _Installments:
+    # Lo mínimo de una CollectionReference: inst_ref.parent.parent es el convenio
+    def __init__(self, ag_ref):
+        self.id = "installments"
+        self.parent = ag_ref
+        self.path = f"{ag_ref.path}/installments"
+
+class EmbeddedRef:
+    embedded = True
+
+    def __init__(self, ag_ref, inst_id, db=None):
+        self.id = inst_id
+        self.parent = _Installments(ag_ref)
+        self.path = f"{ag_ref.path}/installments/{inst_id}"
+        self._db = db
+
+    def __eq__(self, other):
+        return getattr(other, "path", None) == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f"EmbeddedRef({self.path})"
+
+    def get(self, *args, **kwargs):
+        return find(self.parent.parent.get(), self.id)
+
+    def update(self, fields, on_tx=None):
+        return update_row(self, fields, on_tx=on_tx)
+
+class EmbeddedSnapshot:
+    def __init__(self, ag_doc, inst_id, data):
+        self.id = inst_id
+        self.reference = EmbeddedRef(ag_doc.reference, inst_id)
+        self._data = data
+        ts = (data or {}).get("updated_at")
+        self.update_time = ts if isinstance(ts, datetime) else getattr(ag_doc, "update_time", None)
+        self.create_time = getattr(ag_doc, "create_time", None)
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+def rows(ag_doc):
+    # Cuotas del convenio ordenadas por número, como snapshots de subcolección
+    out = []
+    for r in unpack(((ag_doc.to_dict() or {}) if ag_doc.exists else {}).get("schedule")):
+        inst_id = r.pop("id")
+        out.append(EmbeddedSnapshot(ag_doc, inst_id, r))
+    out.sort(key=lambda s: s.get("number") or 0)
+    return out
+
+def find(ag_doc, inst_id):
+    for s in rows(ag_doc):
+        if s.id == inst_id:
+            return s
+    return EmbeddedSnapshot(ag_doc, inst_id, None)
+
+@traced()
+def update_row(ref, fields, on_tx=None, db=None):
+    # Lectura-modificación-escritura del convenio en una transacción; on_tx(tx)
+    # agrega escrituras al mismo commit (p. ej. el evento). Solo campos simples.
+    db = db or ref._db or get_db()
+    ag_ref = ref.parent.parent
+    now = datetime.now(timezone.utc)
+
+    def fn(tx):
+        snap = tx.get(ag_ref)
+        cols = ((snap.to_dict() or {}) if snap.exists else {}).get("schedule") or {}
+        if ref.id not in (cols.get("id") or []):
+            raise ValueError(f"La cuota {ref.id} no existe en el convenio {ag_ref.id}")
+        set_row(cols, ref.id, fields, now)
+        tx.update(ag_ref, column_fields(cols))
+        if on_tx is not None:
+            on_tx(tx)
+    run_transaction(db, fn)
+
+def set_row(cols, inst_id, fields, now=None):
+    # Modifica en el lugar la fila inst_id de las columnas
+    now = now or datetime.now(timezone.utc)
+    ids = cols.get("id") or []
+    i = ids.index(inst_id)
+    for f, v in fields.items():
+        col = cols.setdefault(f, [None] * len(ids))
+        col.extend([None] * (len(ids) - len(col)))
+        col[i] = _value(v, now)
+    return cols
+
+def column_fields(cols):
+    return {"schedule": cols, "next_reminder_at": next_due(cols), "updated_at": gcf.SERVER_TIMESTAMP}
+
+# --- migración entre layouts ---
+
+@traced()
+def to_embedded(db, ag_snap, actor=None):
+    # Cuotas de la subcolección -> columnas en el convenio, en un solo batch (IDs conservados)
+    from services import events
+    items = list(ag_snap.reference.collection("installments").order_by("number").stream())
+    if len(items) > EMBED_MAX_ROWS:
+        return False
+    batch = db.batch()
+    rows = [{k: v for k, v in {"id": s.id, **(s.to_dict() or {})}.items() if k != "shard"} for s in items]
+    batch.update(ag_snap.reference, {**schedule_fields(rows), "schedule_layout": EMBEDDED,
+                                     "shard": shard_of(ag_snap.id)})
+    for s in items:
+        batch.delete(s.reference)
+    events.record("SCHEDULE_MIGRATED", ag_snap.id, actor=actor, batch=batch, db=db,
+                  layout=EMBEDDED, installments=len(items))
+    batch.commit()
+    return True
+
+@traced()
+def to_subcollection(db, ag_snap, actor=None):
+    # Para convenios que necesitan consultas por cuota (collection_group, espejo)
+    from services import events
+    items = unpack((ag_snap.to_dict() or {}).get("schedule"))
+    batch = db.batch()
+    for r in items:
+        # updated_at nuevo para que la analítica incremental vea las cuotas
+        batch.set(ag_snap.reference.collection("installments").document(r.pop("id")),
+                  {**r, "shard": shard_of(ag_snap.id), "updated_at": gcf.SERVER_TIMESTAMP})
+    batch.update(ag_snap.reference, {"schedule": gcf.DELETE_FIELD, "next_reminder_at": gcf.DELETE_FIELD,
+                                     "schedule_layout": SUBCOLLECTION, "updated_at": gcf.SERVER_TIMESTAMP})
+    events.record("SCHEDULE_MIGRATED", ag_snap.id, actor=actor, batch=batch, db=db,
+                  layout=SUBCOLLECTION, installments=len(items))
+    batch.commit()
+    return True
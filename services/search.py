@@ -0,0 +1,94 @@
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Iterable, List, Optional, Set
+
+SEARCH_FIELDS = ("client_name", "client_email", "title", "notes")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+def normalize(text) -> str:
+    # Minúsculas y sin tildes: "José Núñez" -> "jose nunez"
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+def tokens(text) -> Set[str]:
+    return set(_TOKEN.findall(normalize(text)))
+
+class AgreementIndex:
+    # Índice invertido en memoria sobre los convenios visibles para un usuario.
+    # Cada doc se reindexa solo si cambió su update_time; los términos se
+    # mantienen ordenados para resolver prefijos con bisect.
+    def __init__(self):
+        self._versions = {}
+        self._terms = {}
+        self._postings = defaultdict(set)
+        self._sorted: List[str] = []
+
+    def __len__(self):
+        return len(self._versions)
+
+    def sync(self, snaps: Iterable) -> "AgreementIndex":
+        seen = set()
+        for s in snaps:
+            seen.add(s.id)
+            version = str(getattr(s, "update_time", None))
+            if self._versions.get(s.id) == version:
+                continue
+            d = s.to_dict() or {}
+            terms = tokens(s.id)
+            for f in SEARCH_FIELDS:
+                terms |= tokens(d.get(f))
+            self._put(s.id, terms)
+            self._versions[s.id] = version
+        for doc_id in [i for i in self._versions if i not in seen]:
+            self._drop(doc_id)
+        return self
+
+    def _put(self, doc_id, terms):
+        old = self._terms.get(doc_id, set())
+        for t in old - terms:
+            self._unpost(t, doc_id)
+        for t in terms - old:
+            if not self._postings[t]:
+                insort(self._sorted, t)
+            self._postings[t].add(doc_id)
+        self._terms[doc_id] = terms
+
+    def _unpost(self, term, doc_id):
+        ids = self._postings.get(term)
+        if ids is None:
+            return
+        ids.discard(doc_id)
+        if not ids:
+            del self._postings[term]
+            i = bisect_left(self._sorted, term)
+            if i < len(self._sorted) and self._sorted[i] == term:
+                self._sorted.pop(i)
+
+    def _drop(self, doc_id):
+        for t in self._terms.pop(doc_id, set()):
+            self._unpost(t, doc_id)
+        self._versions.pop(doc_id, None)
+
+    def _prefix(self, q) -> Set[str]:
+        out = set()
+        i = bisect_left(self._sorted, q)
+        while i < len(self._sorted) and self._sorted[i].startswith(q):
+            out |= self._postings[self._sorted[i]]
+            i += 1
+        return out
+
+    def search(self, query) -> Optional[Set[str]]:
+        # Cada palabra de la consulta se toma como prefijo; deben coincidir todas.
+        # None = consulta vacía (sin filtro)
+        words = _TOKEN.findall(normalize(query))
+        if not words:
+            return None
+        hits = None
+        for w in sorted(words, key=len, reverse=True):
+            ids = self._prefix(w)
+            hits = ids if hits is None else hits & ids
+            if not hits:
+                return set()
+        return hits
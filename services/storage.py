@@ -1,13 +1,19 @@
 from datetime import timedelta
+from core import tracing
+from core.tracing import traced
 
+@traced()
 def upload_file(bucket, path: str, file, content_type: str):
+    tracing.set_attrs(path=path, content_type=content_type)
     blob = bucket.blob(path)
     blob.upload_from_file(file, content_type=content_type)
     return True
 
+@traced()
 def signed_url(bucket, path: str, minutes: int = 15) -> str:
     return bucket.blob(path).generate_signed_url(expiration=timedelta(minutes=minutes))
 
+@traced()
 def delete_if_exists(bucket, path: str):
     try:
         bucket.blob(path).delete()
@@ -0,0 +1,218 @@
+"""Verifica el kernel en centavos de core.calc contra el cálculo anterior en float.
+
+    python -m tools.calc_check                     # 20000 cronogramas al azar + benchmark
+    python -m tools.calc_check --cases 200000 --seed 7
+    python -m tools.calc_check --rounding half_up --bench-only
+
+Para cada combinación (principal, tasa, cuotas, método) compara fila por fila
+con la implementación float previa (copiada acá como referencia) y verifica
+los invariantes del kernel: la suma de capital es exactamente el principal,
+total = capital + interés y ningún importe es negativo. Las diferencias se
+clasifican por la primera fila distinta: si el cálculo anterior no cerraba el
+saldo es un caso que el kernel corrige; si el valor exacto estaba a medio
+centavo es un empate que el float resolvía según su representación binaria
+(desde ahí el saldo arrastra la diferencia). Termina con código 1 si el
+kernel rompe un invariante o si las diferencias sin explicar superan
+--max-mismatch.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import date
+from fractions import Fraction
+
+from core import calc
+
+
+# --- referencia: cálculo float anterior ---
+
+def _legacy_declining(principal, r, n, start_date):
+    cap_fixed = round(principal / n, 2)
+    saldo = round(principal, 2)
+    items = []
+    for i in range(1, n + 1):
+        interest = round(saldo * r, 2)
+        capital = cap_fixed if i < n else round(saldo, 2)
+        total = round(capital + interest, 2)
+        due = calc.add_months(start_date, i - 1)
+        items.append({"number": i, "due_date": calc.iso(due),
+                      "capital": capital, "interest": interest, "total": total})
+        saldo = max(0.0, round(saldo - capital, 2))
+    if saldo != 0:
+        last = items[-1]; adjust = round(saldo, 2)
+        last["capital"] = round(last["capital"] + adjust, 2)
+        last["total"] = round(last["capital"] + last["interest"], 2)
+    return items
+
+
+def _legacy_french(principal, r, n, start_date):
+    if r == 0:
+        cuota = round(principal / n, 2)
+    else:
+        cuota = round(principal * (r / (1 - (1 + r) ** (-n))), 2)
+    saldo = round(principal, 2)
+    items = []
+    for i in range(1, n + 1):
+        interest = round(saldo * r, 2)
+        if i < n:
+            capital = round(cuota - interest, 2)
+            total_i = cuota
+        else:
+            capital = round(saldo, 2)
+            total_i = round(capital + interest, 2)
+        due = calc.add_months(start_date, i - 1)
+        items.append({"number": i, "due_date": calc.iso(due),
+                      "capital": capital, "interest": interest, "total": total_i})
+        saldo = max(0.0, round(saldo - capital, 2))
+    if saldo != 0:
+        last = items[-1]; adjust = round(saldo, 2)
+        last["capital"] = round(last["capital"] + adjust, 2)
+        last["total"] = round(last["capital"] + last["interest"], 2)
+    return items
+
+
+METHODS = {
+    "declining": (_legacy_declining, calc.schedule_declining),
+    "french": (_legacy_french, calc.schedule_french),
+}
+
+
+def grid(cases, seed):
+    # Como los carga la app: principal con centavos, tasa mensual con 6 decimales, hasta 480 cuotas
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(cases):
+        scale = rnd.choice((1, 100, 10_000, 1_000_000))
+        principal = round(rnd.uniform(0.01, 10 * scale), rnd.choice((0, 2, 2, 2)))
+        principal = max(principal, 0.01)
+        rate = rnd.choice((0.0, round(rnd.uniform(0, 0.15), 6), round(rnd.choice((1, 2, 2.5, 3, 5, 7.5, 10)) / 100, 6)))
+        n = rnd.choice((rnd.randint(1, 24), rnd.randint(1, 480)))
+        start = calc.add_months(date(2020, 1, rnd.randint(1, 31)), rnd.randint(0, 120))
+        out.append((rnd.choice(tuple(METHODS)), principal, rate, n, start))
+    return out
+
+
+def _cents(items, key):
+    return [round(it[key] * 100) for it in items]
+
+
+def _invariants(items, principal, rounding):
+    capital, interest, total = _cents(items, "capital"), _cents(items, "interest"), _cents(items, "total")
+    return (sum(capital) == calc.to_cents(principal, rounding)
+            and all(c + i == t for c, i, t in zip(capital, interest, total))
+            and min(capital + interest) >= 0)
+
+
+def _is_tie(value):
+    # value (Fraction, en centavos) está a medio centavo, o tan cerca que el float lo resolvía al azar
+    return abs(value - (value.numerator // value.denominator) - Fraction(1, 2)) < Fraction(1, 10 ** 6)
+
+
+def _explain(method, principal, rate, n, old, new, rounding):
+    # Primera fila distinta: con el mismo saldo de partida, ¿la diferencia es un empate?
+    row = next(i for i, (a, b) in enumerate(zip(old, new)) if a != b)
+    cents = calc.to_cents(principal, rounding)
+    saldo = cents - sum(_cents(old[:row], "capital"))
+    r = Fraction(repr(float(rate)))
+    if _is_tie(saldo * r):
+        return row, "interest"
+    if method == "declining":
+        return row, "capital" if _is_tie(Fraction(cents, n)) else None
+    if r == 0:
+        return row, "cuota" if _is_tie(Fraction(cents, n)) else None
+    grow = (1 + r) ** n
+    return row, "cuota" if _is_tie(cents * r * grow / (grow - 1)) else None
+
+
+def compare(cases, rounding):
+    report = {"schedules": len(cases), "rows": 0, "identical": 0, "kernel_invariant_failures": 0,
+              "legacy_unbalanced": 0, "ties": {"interest": 0, "capital": 0, "cuota": 0},
+              "unexplained": 0, "max_first_diff_cents": 0, "examples": []}
+    for method, principal, rate, n, start in cases:
+        legacy_fn, new_fn = METHODS[method]
+        old = legacy_fn(principal, rate, n, start)
+        new = new_fn(principal, rate, n, start, rounding=rounding)
+        report["rows"] += n
+        if not _invariants(new, principal, rounding):
+            report["kernel_invariant_failures"] += 1
+            report["examples"].append({"kind": "invariant", "method": method, "principal": principal, "rate": rate, "n": n})
+            continue
+        if old == new:
+            report["identical"] += 1
+            continue
+        if not _invariants(old, principal, rounding):
+            # El cálculo anterior no cerraba el saldo (cuota fija que lo agota antes de tiempo, etc.)
+            report["legacy_unbalanced"] += 1
+            continue
+        row, tie = _explain(method, principal, rate, n, old, new, rounding)
+        diff = max(abs(round(old[row][k] * 100) - round(new[row][k] * 100)) for k in ("capital", "interest", "total"))
+        report["max_first_diff_cents"] = max(report["max_first_diff_cents"], diff)
+        if tie:
+            report["ties"][tie] += 1
+            continue
+        report["unexplained"] += 1
+        if len(report["examples"]) < 10:
+            report["examples"].append({"kind": "unexplained", "method": method, "principal": principal, "rate": rate,
+                                       "n": n, "row": row + 1, "legacy": old[row], "kernel": new[row]})
+    return report
+
+
+def bench(cases, rounding, repeat):
+    out = {}
+    rows = sum(n for _, _, _, n, _ in cases)
+    for name, pick in (("legacy_float", 0), ("kernel_cents", 1)):
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for method, principal, rate, n, start in cases:
+                fn = METHODS[method][pick]
+                fn(principal, rate, n, start) if pick == 0 else fn(principal, rate, n, start, rounding=rounding)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        out[name] = {"seconds": round(best, 3), "schedules_per_s": round(len(cases) / best),
+                     "rows_per_s": round(rows / best)}
+    # Solo el kernel (sin fechas ni dicts): lo que usa un recálculo masivo que trabaja en centavos
+    fns = {"declining": calc.declining_cents, "french": calc.french_cents}
+    prepared = [(fns[m], calc.to_cents(p, rounding), r, n) for m, p, r, n, _ in cases]
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for fn, cents, rate, n in prepared:
+            fn(cents, rate, n, rounding)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    out["kernel_cents_rows_only"] = {"seconds": round(best, 3), "schedules_per_s": round(len(cases) / best),
+                                     "rows_per_s": round(rows / best)}
+    out["speedup"] = round(out["legacy_float"]["seconds"] / out["kernel_cents"]["seconds"], 2)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara el kernel en centavos con el cálculo float anterior")
+    parser.add_argument("--cases", type=int, default=20000, help="cronogramas al azar a comparar")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounding", default=calc.HALF_EVEN, choices=[calc.HALF_EVEN, calc.HALF_UP])
+    parser.add_argument("--max-mismatch", type=float, default=0.001,
+                        help="fracción tolerada de cronogramas con diferencias que no son empates")
+    parser.add_argument("--bench-cases", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--bench-only", action="store_true")
+    args = parser.parse_args(argv)
+
+    summary = {"rounding": args.rounding, "seed": args.seed}
+    ok = True
+    if not args.bench_only:
+        report = compare(grid(args.cases, args.seed), args.rounding)
+        summary["verify"] = report
+        ok = (report["kernel_invariant_failures"] == 0
+              and report["unexplained"] <= args.max_mismatch * report["schedules"])
+    summary["bench"] = bench(grid(args.bench_cases, args.seed + 1), args.rounding, args.repeat)
+    summary["ok"] = ok
+    print(json.dumps(summary, ensure_ascii=False, indent=2, default=str))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Costo de arranque en frío por rol: tiempo de import y RSS.
+
+Cada medición corre en un proceso nuevo (import en frío):
+
+    python -m tools.import_bench                # una corrida por rol
+    python -m tools.import_bench --repeat 5     # mediana de 5
+    python -m tools.import_bench --all-pages    # además, todas las páginas del rol
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Página inicial de cada rol (la primera del menú) y el resto de sus páginas
+ROLE_PAGES = {
+    "cliente": ["agreements_list"],
+    "operador": ["dashboard_operator", "receipts_review", "reconciliation", "agreements_create", "agreements_list", "agreement_edit"],
+    "admin": ["dashboard_admin", "analytics_admin", "jobs_admin", "settings", "reconciliation", "agreements_create",
+              "agreements_list", "agreement_edit"],
+}
+HEAVY = ("reportlab", "pandas", "PIL", "pyarrow", "firebase_admin.storage", "google.cloud.storage")
+
+_CHILD = r"""
+import json, os, resource, sys, time
+t0 = time.perf_counter()
+import streamlit
+t1 = time.perf_counter()
+import app
+t2 = time.perf_counter()
+for name in sys.argv[1:]:
+    app._page(name)
+t3 = time.perf_counter()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss_mb = rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+print(json.dumps({"streamlit_ms": (t1 - t0) * 1000, "app_ms": (t2 - t1) * 1000, "pages_ms": (t3 - t2) * 1000,
+                  "total_ms": (t3 - t0) * 1000, "max_rss_mb": rss_mb,
+                  "heavy": [m for m in %r if m in sys.modules], "modules": len(sys.modules)}))
+""" % (HEAVY,)
+
+
+def _run(pages):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "DB_BACKEND": os.environ.get("DB_BACKEND", "sqlite"), "PYTHONDONTWRITEBYTECODE": "1"}
+    out = subprocess.run([sys.executable, "-c", _CHILD, *pages], cwd=root, env=env,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _median(runs):
+    res = {k: round(statistics.median(r[k] for r in runs), 1)
+           for k in ("streamlit_ms", "app_ms", "pages_ms", "total_ms", "max_rss_mb")}
+    res.update(heavy=runs[-1]["heavy"], modules=runs[-1]["modules"])
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Tiempo de import y RSS en frío por rol")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--all-pages", action="store_true", help="medir también todas las páginas del rol")
+    ap.add_argument("--json", action="store_true", help="salida JSON (para comparar entre versiones)")
+    args = ap.parse_args()
+    rows = []
+    for role, pages in ROLE_PAGES.items():
+        cases = [("inicio", pages[:1])] + ([("todas", pages)] if args.all_pages else [])
+        for label, subset in cases:
+            res = _median([_run(subset) for _ in range(args.repeat)])
+            rows.append({"role": role, "pages": label, **res})
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'rol':<9} {'páginas':<7} {'streamlit':>10} {'app':>8} {'páginas':>8} {'total':>8} {'RSS MB':>7}  pesados")
+    for r in rows:
+        print(f"{r['role']:<9} {r['pages']:<7} {r['streamlit_ms']:>10} {r['app_ms']:>8} {r['pages_ms']:>8} "
+              f"{r['total_ms']:>8} {r['max_rss_mb']:>7}  {', '.join(r['heavy']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+"""Prueba de carga: sesiones concurrentes de la app completa con AppTest.
+
+Todo corre en este proceso, como un servidor con muchas pestañas abiertas:
+backend SQLite temporal (o el emulador de Firestore con --backend firestore y
+FIRESTORE_EMULATOR_HOST), un sumidero SMTP local y el login de Identity
+Toolkit resuelto contra la colección `users`. Cada usuario virtual recorre
+el guion de su rol y se mide la latencia de cada acción (uno o más reruns) y
+las operaciones de Firestore que registró core.metrics para su uid.
+
+    python -m tools.load_test                                  # 8 operadores, 8 clientes, 1 admin
+    python -m tools.load_test --operators 20 --clients 20 --iterations 3
+    python -m tools.load_test --save-baseline tools/load_baseline.json
+    python -m tools.load_test --baseline tools/load_baseline.json   # sale con 1 si hay regresiones
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import resource
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "carga-123"
+
+
+# --- sumidero SMTP ---
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    # Lo justo de SMTP para smtplib: EHLO con AUTH, MAIL/RCPT/DATA y QUIT
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self._reply("220 load-sink ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode("utf-8", "replace").strip().split()
+            verb = cmd[0].upper() if cmd else ""
+            if verb == "EHLO":
+                self.wfile.write(b"250-load-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "AUTH":
+                prompts = ["VXNlcm5hbWU6", "UGFzc3dvcmQ6"] if cmd[1].upper() == "LOGIN" else ([""] if len(cmd) < 3 else [])
+                for p in prompts:
+                    self._reply(f"334 {p}".strip())
+                    self.rfile.readline()
+                self._reply("235 ok")
+            elif verb == "DATA":
+                self._reply("354 end with .")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data in (b".\r\n", b".\n"):
+                        break
+                    size += len(data)
+                self.server.received(size)
+                self._reply("250 queued")
+            elif verb == "QUIT":
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("250 ok")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SmtpHandler)
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+
+    def received(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+
+# --- RSS ---
+
+class RssSampler:
+    def __init__(self, every=0.2):
+        self.samples = []
+        self._stop = threading.Event()
+        self._every = every
+        threading.Thread(target=self._loop, name="rss", daemon=True).start()
+
+    @staticmethod
+    def current_mb():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+        except OSError:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.samples.append(self.current_mb())
+            self._stop.wait(self._every)
+
+    def stop(self):
+        self._stop.set()
+        self.samples.append(self.current_mb())
+        return {"start_mb": round(self.samples[0], 1), "peak_mb": round(max(self.samples), 1),
+                "end_mb": round(self.samples[-1], 1)}
+
+
+# --- operaciones de Firestore por uid (core.metrics registra una línea por rerun) ---
+
+class OpsCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.by_uid = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            d = json.loads(record.getMessage())
+        except ValueError:
+            return
+        with self._lock:
+            self.by_uid[d.get("uid")].append(d.get("totals") or {})
+
+    def mark(self, uid):
+        with self._lock:
+            return len(self.by_uid[uid])
+
+    def since(self, uid, mark):
+        with self._lock:
+            rows = self.by_uid[uid][mark:]
+        return {"reruns": len(rows), **{k: sum(r.get(k, 0) for r in rows) for k in ("reads", "writes", "deletes", "queries")}}
+
+
+# --- datos ---
+
+def seed(db, operators, clients, agreements, installments):
+    from services.installments import generate_schedule
+    from services.reminders import shard_of
+    users = {"admin": [], "operador": [], "cliente": []}
+    db.collection("users").document("admin0").set({"email": "admin0@carga.test", "full_name": "Admin", "role": "admin", "status": "APPROVED"})
+    users["admin"].append("admin0")
+    for c in range(clients):
+        db.collection("users").document(f"cl{c}").set({"email": f"cl{c}@carga.test", "full_name": f"Cliente {c}",
+                                                       "role": "cliente", "status": "APPROVED"})
+        users["cliente"].append(f"cl{c}")
+    for o in range(operators):
+        uid = f"op{o}"
+        db.collection("users").document(uid).set({"email": f"{uid}@carga.test", "full_name": f"Operador {o}",
+                                                  "role": "operador", "status": "APPROVED"})
+        users["operador"].append(uid)
+        for a in range(agreements):
+            c = (o + a) % max(clients, 1)
+            ref = db.collection("agreements").document()
+            status = "PENDING_ACCEPTANCE" if a % 4 == 3 else "ACTIVE"
+            ref.set({"title": "Convenio de carga", "notes": "", "operator_id": uid, "operator_email": f"{uid}@carga.test",
+                     "client_id": f"cl{c}", "client_email": f"cl{c}@carga.test", "client_name": f"Cliente {c}",
+                     "principal": 120000.0, "interest_rate": 0.03, "installments": installments, "method": "french",
+                     "status": status, "start_date": date.today().isoformat(), "shard": shard_of(ref.id)})
+            generate_schedule(db, ref)
+            if status == "ACTIVE":
+                # Un comprobante pendiente por convenio: trabajo para "aprobar"
+                first = next(iter(ref.collection("installments").order_by("number").limit(1).stream()))
+                first.reference.update({"receipt_status": "PENDING", "receipt_note": "transferencia"})
+    return users
+
+
+def _fake_sign_in(db):
+    # Identity Toolkit resuelto localmente: cualquier usuario existente con PASSWORD
+    def sign_in(email, password):
+        if password != PASSWORD:
+            return None
+        for snap in db.collection("users").where("email", "==", email).limit(1).stream():
+            return {"localId": snap.id}
+        return None
+    return sign_in
+
+
+def _share_runtime():
+    # AppTest instala un Runtime simulado global al empezar cada run y lo borra
+    # al terminar: con sesiones en paralelo, una lo borraría mientras otra
+    # corre. Se fija el primero y se comparte, como el Runtime único de un
+    # servidor real (incluidas las cachés de st.cache_data).
+    from streamlit.runtime import Runtime
+    shared = {}
+
+    def instance(cls):
+        if "rt" not in shared:
+            if cls._instance is None:
+                raise RuntimeError("Runtime hasn't been created!")
+            shared["rt"] = cls._instance
+        return shared["rt"]
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: "rt" in shared or cls._instance is not None)
+    # También una sola ScriptCache: app.py se compila una vez, no en cada run de cada sesión
+    from streamlit.testing.v1 import app_test
+    cache = app_test.ScriptCache()
+    app_test.ScriptCache = lambda: cache
+
+
+# --- guiones por rol ---
+
+def _goto(at, text):
+    radio = at.sidebar.radio[0]
+    opt = next(o for o in radio.options if text in o)
+    radio.set_value(opt).run()
+
+
+def _click_first(at, prefix):
+    btn = next((b for b in at.button if (b.key or "").startswith(prefix)), None)
+    if btn is None:
+        return False
+    btn.click().run()
+    return True
+
+
+def _login(at, email):
+    at.run()
+    inputs = [t for t in at.text_input if t.label in ("Email", "Contraseña")][:2]
+    inputs[0].set_value(email)
+    inputs[1].set_value(PASSWORD)
+    next(b for b in at.button if b.label == "Entrar").click().run()
+
+
+def _create(at, client_email):
+    _goto(at, "Crear convenio")
+    next(t for t in at.text_input if t.label == "Email del cliente").set_value(client_email)
+    next(n for n in at.number_input if n.label == "Deuda (principal)").set_value(90000.0)
+    next(n for n in at.number_input if n.label == "Cantidad de cuotas").set_value(12)
+    next(b for b in at.button if b.label == "Guardar convenio").click().run()
+
+
+SCRIPTS = {
+    "operador": [
+        ("mis_convenios", lambda at, u: _goto(at, "Mis convenios")),
+        ("comprobantes", lambda at, u: _goto(at, "Comprobantes")),
+        ("aprobar_comprobante", lambda at, u: _click_first(at, "ok_")),
+        ("crear_convenio", lambda at, u: _create(at, u["client_email"])),
+        ("panel_operador", lambda at, u: _goto(at, "Panel (operador)")),
+    ],
+    "cliente": [
+        ("mis_convenios", lambda at, u: _goto(at, "Mis convenios")),
+        ("declarar_pago", lambda at, u: _click_first(at, "declarar_pago_")),
+        ("aceptar_convenio", lambda at, u: _click_first(at, "aceptar_")),
+    ],
+    "admin": [
+        ("panel_admin", lambda at, u: _goto(at, "Panel (admin)")),
+        ("tareas", lambda at, u: _goto(at, "Tareas (admin)")),
+        ("mis_convenios", lambda at, u: _goto(at, "Mis convenios")),
+    ],
+}
+
+
+def _session(user, iterations, ops, timeout):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+    out = []
+
+    def step(name, fn):
+        mark = ops.mark(user["uid"])
+        t0 = time.perf_counter()
+        error = None
+        try:
+            fn(at, user)
+            if at.exception:
+                error = at.exception[0].value
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        out.append({"role": user["role"], "action": name, "ms": (time.perf_counter() - t0) * 1000,
+                    "ops": ops.since(user["uid"], mark), "error": error})
+
+    step("login", lambda at, u: _login(at, u["email"]))
+    for _ in range(iterations):
+        for name, fn in SCRIPTS[user["role"]]:
+            step(name, fn)
+    return out
+
+
+# --- reporte ---
+
+def _pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)], 1)   # nearest-rank
+
+
+def summarize(results):
+    groups = defaultdict(list)
+    for r in results:
+        groups[f"{r['role']}/{r['action']}"].append(r)
+    actions = {}
+    for key, rows in sorted(groups.items()):
+        ms = [r["ms"] for r in rows]
+        ops = [r["ops"] for r in rows if r["ops"]["reruns"]]
+        mean = lambda k: round(sum(o[k] for o in ops) / len(ops), 1) if ops else None
+        actions[key] = {"n": len(rows), "errors": sum(1 for r in rows if r["error"]),
+                        "p50_ms": _pct(ms, 50), "p95_ms": _pct(ms, 95), "p99_ms": _pct(ms, 99),
+                        "reruns": mean("reruns"), "reads": mean("reads"), "writes": mean("writes"),
+                        "queries": mean("queries")}
+    ms = [r["ms"] for r in results]
+    return {"p50_ms": _pct(ms, 50), "p95_ms": _pct(ms, 95), "p99_ms": _pct(ms, 99),
+            "actions": len(results), "errors": sum(1 for r in results if r["error"])}, actions
+
+
+def compare(report, baseline, tolerance):
+    # Regresión: latencia p95 o lecturas/escrituras medias por encima de la base + tolerancia
+    problems = []
+    for key, cur in report["actions"].items():
+        base = baseline.get("actions", {}).get(key)
+        if not base:
+            continue
+        for metric in ("p95_ms", "reads", "writes", "queries"):
+            b, c = base.get(metric), cur.get(metric)
+            if b is None or c is None:
+                continue
+            # Margen absoluto para valores chicos (1 lectura, 5 ms): evita falsos positivos
+            slack = 5.0 if metric == "p95_ms" else 1.0
+            if c > b * (1 + tolerance) + slack:
+                problems.append(f"{key} {metric}: {c} (base {b})")
+    b, c = baseline.get("overall", {}).get("p95_ms"), report["overall"]["p95_ms"]
+    if b is not None and c is not None and c > b * (1 + tolerance) + 5.0:
+        problems.append(f"global p95_ms: {c} (base {b})")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Sesiones concurrentes de la app con AppTest")
+    ap.add_argument("--operators", type=int, default=8)
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--admins", type=int, default=1)
+    ap.add_argument("--agreements", type=int, default=8, help="convenios por operador")
+    ap.add_argument("--installments", type=int, default=12, help="cuotas por convenio")
+    ap.add_argument("--iterations", type=int, default=2, help="vueltas del guion por sesión")
+    ap.add_argument("--concurrency", type=int, default=0, help="sesiones simultáneas (0 = todas)")
+    ap.add_argument("--timeout", type=float, default=120.0, help="segundos por rerun")
+    ap.add_argument("--backend", choices=("sqlite", "firestore"), default="sqlite")
+    ap.add_argument("--baseline", help="archivo base para detectar regresiones")
+    ap.add_argument("--save-baseline", help="guardar este resultado como base")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="margen relativo sobre la base")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    # La configuración se lee al importar los módulos: el entorno va primero
+    tmp = tempfile.mkdtemp(prefix="convenios-carga-")
+    sink = SmtpSink()
+    os.environ.update({
+        "DB_BACKEND": args.backend, "SQLITE_PATH": os.path.join(tmp, "carga.db"),
+        "LOCAL_STORAGE_DIR": os.path.join(tmp, "storage"),
+        "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(sink.server_address[1]), "SMTP_USER": "carga",
+        "SMTP_PASS": "carga", "SMTP_USE_TLS": "false", "SMTP_USE_SSL": "false", "SMTP_SENDER": "carga@carga.test",
+    })
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    from core import auth, metrics
+    from core.firebase import init_firebase, get_db
+    from services import outbox
+
+    init_firebase()
+    db = get_db()
+    t0 = time.perf_counter()
+    users = seed(db, args.operators, args.clients, args.agreements, args.installments)
+    seed_s = time.perf_counter() - t0
+    auth.firebase_sign_in = _fake_sign_in(db)
+
+    ops = OpsCollector()
+    metrics.LOG.addHandler(ops)
+    metrics.LOG.setLevel(logging.INFO)
+    metrics.LOG.propagate = False
+
+    sessions = []
+    for role, n in (("operador", args.operators), ("cliente", args.clients), ("admin", args.admins)):
+        for i, uid in enumerate(users[role][:n]):
+            d = db.collection("users").document(uid).get().to_dict()
+            sessions.append({"uid": uid, "role": role, "email": d["email"],
+                             "client_email": f"cl{i % max(args.clients, 1)}@carga.test"})
+
+    _share_runtime()
+    from streamlit.testing.v1 import AppTest
+    AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=args.timeout).run()   # fija el Runtime compartido
+
+    rss = RssSampler()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency or len(sessions)) as pool:
+        futures = [pool.submit(_session, u, args.iterations, ops, args.timeout) for u in sessions]
+        results = [r for f in futures for r in f.result()]
+    wall = time.perf_counter() - t0
+    outbox._OUTBOX.flush(force=True)
+    overall, actions = summarize(results)
+    report = {
+        "config": {k: getattr(args, k) for k in ("operators", "clients", "admins", "agreements",
+                                                 "installments", "iterations", "concurrency", "backend")},
+        "overall": {**overall, "wall_s": round(wall, 1), "actions_per_s": round(len(results) / wall, 1),
+                    "seed_s": round(seed_s, 1)},
+        "rss": rss.stop(),
+        "smtp": {"messages": sink.messages, "bytes": sink.bytes},
+        "actions": actions,
+    }
+    sink.shutdown()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    problems = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print(f"Aviso: la base se midió con otra configuración: {baseline.get('config')}", file=sys.stderr)
+        problems = compare(report, baseline, args.tolerance)
+        report["regressions"] = problems
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({k: report[k] for k in ("config", "overall", "rss", "actions")}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        o = report["overall"]
+        print(f"{len(sessions)} sesiones · {o['actions']} acciones en {o['wall_s']} s ({o['actions_per_s']}/s) · "
+              f"errores: {o['errors']}")
+        print(f"latencia por acción: p50 {o['p50_ms']} ms · p95 {o['p95_ms']} ms · p99 {o['p99_ms']} ms")
+        r = report["rss"]
+        print(f"RSS: inicio {r['start_mb']} MB · pico {r['peak_mb']} MB · final {r['end_mb']} MB · "
+              f"emails recibidos: {report['smtp']['messages']}")
+        print(f"\n{'acción':<30} {'n':>4} {'err':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'reruns':>7} {'lect.':>7} {'escr.':>6} {'consultas':>9}")
+        for key, a in actions.items():
+            print(f"{key:<30} {a['n']:>4} {a['errors']:>4} {a['p50_ms']:>8} {a['p95_ms']:>8} {a['p99_ms']:>8} "
+                  f"{a['reruns'] if a['reruns'] is not None else '-':>7} {a['reads'] if a['reads'] is not None else '-':>7} "
+                  f"{a['writes'] if a['writes'] is not None else '-':>6} {a['queries'] if a['queries'] is not None else '-':>9}")
+        errores = [r for r in results if r["error"]]
+        for r in errores[:5]:
+            print(f"  ! {r['role']}/{r['action']}: {r['error']}")
+        if problems:
+            print("\nRegresiones respecto de la base:")
+            for p in problems:
+                print(f"  - {p}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""Mantenimiento de datos: integridad, recálculo de cronogramas, backfill y blobs huérfanos.
+
+Recorre `agreements` por páginas (o el bucket, en sweep), procesa cada página
+con un pool acotado de hilos y escribe con BulkWriter (batches en SQLite).
+Tras cada página deja un checkpoint en `worker_checkpoints/maintain-<cmd>`;
+--resume sigue desde ahí. Con --dry-run no escribe nada, ni el checkpoint.
+
+    python -m tools.maintain scan                                   # informe de problemas
+    python -m tools.maintain recompute --status DRAFT --status PENDING_ACCEPTANCE --dry-run
+    python -m tools.maintain backfill --field client_name --field next_reminder_at
+    python -m tools.maintain sweep --min-age-hours 48 --dry-run
+    python -m tools.maintain backfill --resume --workers 16 --page-size 500
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+from google.cloud import firestore as gcf
+
+from core import calc, metrics
+from core.firebase import init_firebase, get_db, get_bucket
+from services.installments import generate_schedule, read_installments
+from services.reminders import next_reminder_at, shard_of
+from services import schedule
+
+BACKFILL_FIELDS = ("client_name", "updated_at", "next_reminder_at", "shard")
+RECEIPT_STATUSES = ("PENDING", "APPROVED", "REJECTED")
+BATCH_SIZE = 400
+
+
+class Writer:
+    # BulkWriter de Firestore (paraleliza y reintenta por su cuenta); en
+    # SQLite, batches de BATCH_SIZE. Compartido por los hilos del pool.
+    def __init__(self, db, dry_run):
+        raw = metrics.unwrap(db)
+        self.dry_run = dry_run
+        self.writes = 0
+        self._db = db
+        self._lock = threading.Lock()
+        self._bulk = raw.bulk_writer() if hasattr(raw, "bulk_writer") and not dry_run else None
+        self._batch, self._pending = None, 0
+
+    def update(self, ref, fields):
+        with self._lock:
+            self.writes += 1
+            if self.dry_run:
+                return
+            if getattr(ref, "embedded", False):
+                ref.update(fields)   # cuota embebida: transacción sobre el convenio
+            elif self._bulk is not None:
+                self._bulk.update(ref, fields)
+            else:
+                if self._batch is None:
+                    self._batch = self._db.batch()
+                self._batch.update(ref, fields)
+                self._pending += 1
+                if self._pending >= BATCH_SIZE:
+                    self._commit()
+
+    def _commit(self):
+        if self._batch is not None and self._pending:
+            self._batch.commit()
+        self._batch, self._pending = None, 0
+
+    def flush(self):
+        with self._lock:
+            if self._bulk is not None:
+                self._bulk.flush()
+            else:
+                self._commit()
+
+    def close(self):
+        self.flush()
+        if self._bulk is not None:
+            self._bulk.close()
+
+
+class Checkpoint:
+    def __init__(self, db, name, dry_run):
+        self.ref = db.collection("worker_checkpoints").document(f"maintain-{name}")
+        self.dry_run = dry_run
+
+    def load(self):
+        snap = self.ref.get()
+        return (snap.to_dict() or {}) if snap.exists else {}
+
+    def save(self, **fields):
+        if not self.dry_run:
+            self.ref.set({**fields, "updated_at": datetime.now(timezone.utc)}, merge=True)
+
+
+class Stats:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.docs = 0
+        self.pages = 0
+        self.counts = Counter()
+        self.examples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, key, example=None, n=1):
+        with self._lock:
+            self.counts[key] += n
+            if example is not None and len(self.examples[key]) < 20:
+                self.examples[key].append(example)
+
+    def page(self, n):
+        self.docs += n
+        self.pages += 1
+        elapsed = time.perf_counter() - self.t0
+        print(f"[maintain] página {self.pages}: {self.docs} docs, {self.docs / max(elapsed, 1e-9):.1f} docs/s",
+              file=sys.stderr)
+
+    def summary(self, **extra):
+        elapsed = time.perf_counter() - self.t0
+        return {**extra, "docs": self.docs, "pages": self.pages, "elapsed_s": round(elapsed, 2),
+                "docs_per_s": round(self.docs / max(elapsed, 1e-9), 1),
+                "counts": dict(self.counts), "examples": dict(self.examples)}
+
+
+def _pages(db, args, ckpt):
+    # Páginas de convenios en orden de ID; start_after con el último snapshot de la página
+    q = db.collection("agreements")
+    if args.status:
+        q = q.where("status", "in", args.status)
+    last = None
+    if args.resume:
+        last_id = ckpt.load().get("last_id")
+        if last_id:
+            last = db.collection("agreements").document(last_id).get()
+            if not last.exists:
+                print(f"[maintain] el checkpoint apunta a {last_id}, que ya no existe: se empieza de cero",
+                      file=sys.stderr)
+                last = None
+    while True:
+        page_q = q.limit(args.page_size)
+        if last is not None:
+            page_q = page_q.start_after(last)
+        page = list(page_q.stream())
+        if not page:
+            return
+        yield page
+        last = page[-1]
+        if len(page) < args.page_size:
+            return
+
+
+def _run_pages(db, args, fn, writer, stats):
+    ckpt = Checkpoint(db, args.cmd, args.dry_run)
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="maintain") as pool:
+        for page in _pages(db, args, ckpt):
+            for _ in pool.map(fn, page):
+                pass
+            # El checkpoint avanza solo con las escrituras de la página confirmadas
+            writer.flush()
+            stats.page(len(page))
+            ckpt.save(last_id=page[-1].id, docs=stats.docs, status="running")
+    writer.close()
+    stats.counts["writes"] += writer.writes
+    ckpt.save(last_id=None, status="done")
+
+
+# --- chequeos ---
+
+def _schedule_ok(ag, items):
+    # Los cronogramas del cálculo float anterior difieren en empates de medio centavo y la
+    # última cuota absorbe el arrastre: un centavo por cuota y capital que cierre exacto.
+    # Se compara en centavos contra el kernel, sin armar el cronograma en dicts.
+    rows = [it.to_dict() or {} for it in items]
+    n = ag["installments"]
+    if len(rows) != n:
+        return False
+    exp = calc.schedule_cents(ag.get("method"), ag["principal"], ag["interest_rate"], n)
+    dues = calc.due_dates(date.fromisoformat(ag["start_date"]), n)
+    if not all(r.get("number") == i + 1 and r.get("due_date") == dues[i]
+               and (i == n - 1 or abs(round(float(r.get("total") or 0) * 100) - e[2]) <= 1)
+               for i, (r, e) in enumerate(zip(rows, exp))):
+        return False
+    return sum(round(float(r.get("capital") or 0) * 100) for r in rows) == calc.to_cents(ag["principal"])
+
+def inspect(ag_snap):
+    # -> (problemas del convenio, cuotas leídas)
+    ag = ag_snap.to_dict() or {}
+    items = read_installments(ag_snap)
+    issues = []
+    try:
+        if not _schedule_ok(ag, items):
+            issues.append("schedule_mismatch")
+    except (KeyError, TypeError, ValueError):
+        issues.append("terms_invalid")
+    if not ag.get("client_name") and (ag.get("client_id") or ag.get("client_email")):
+        issues.append("client_name_missing")
+    if "updated_at" not in ag:
+        issues.append("updated_at_missing")
+    if "shard" not in ag:
+        issues.append("shard_missing")
+    for it in items:
+        d = it.to_dict() or {}
+        if d.get("receipt_status") in RECEIPT_STATUSES and not d.get("receipt_url") and not d.get("receipt_note"):
+            issues.append("receipt_without_file")
+        if d.get("receipt_status") == "APPROVED" and not d.get("paid"):
+            issues.append("approved_unpaid")
+        if not d.get("paid") and d.get("due_date") and "next_reminder_at" not in d:
+            issues.append("next_reminder_missing")
+    return issues, items
+
+
+def cmd_scan(db, args, stats):
+    writer = Writer(db, True)
+    def fn(snap):
+        issues, _ = inspect(snap)
+        for i in sorted(set(issues)):
+            stats.add(i, snap.id, n=issues.count(i))
+    _run_pages(db, args, fn, writer, stats)
+
+
+def cmd_recompute(db, args, stats):
+    # Solo cronogramas sin pagos ni comprobantes: regenerarlos no pierde nada
+    writer = Writer(db, args.dry_run)
+    def fn(snap):
+        issues, items = inspect(snap)
+        if "schedule_mismatch" not in issues:
+            return
+        if any((it.to_dict() or {}).get("paid") or (it.to_dict() or {}).get("receipt_status") for it in items):
+            stats.add("skipped_has_payments", snap.id)
+            return
+        if not args.dry_run:
+            generate_schedule(db, snap.reference)
+        stats.add("recomputed", snap.id)
+    _run_pages(db, args, fn, writer, stats)
+
+
+def _client_name(db, ag):
+    if ag.get("client_id"):
+        u = db.collection("users").document(ag["client_id"]).get()
+        if u.exists:
+            return (u.to_dict() or {}).get("full_name")
+    if ag.get("client_email"):
+        for u in db.collection("users").where("email", "==", ag["client_email"]).limit(1).stream():
+            return (u.to_dict() or {}).get("full_name")
+    return None
+
+
+def cmd_backfill(db, args, stats):
+    fields = args.field or list(BACKFILL_FIELDS)
+    writer = Writer(db, args.dry_run)
+    now = datetime.now(timezone.utc)
+    def fn(snap):
+        ag = snap.to_dict() or {}
+        upd = {}
+        if "client_name" in fields and not ag.get("client_name"):
+            name = _client_name(db, ag)
+            if name:
+                upd["client_name"] = name
+            else:
+                stats.add("client_name_unresolved", snap.id)
+        if "updated_at" in fields and "updated_at" not in ag:
+            upd["updated_at"] = gcf.SERVER_TIMESTAMP
+        if "shard" in fields and ag.get("shard") != shard_of(snap.id):
+            upd["shard"] = shard_of(snap.id)
+        if upd:
+            writer.update(snap.reference, upd)
+            for k in upd:
+                stats.add(k, snap.id)
+        if "next_reminder_at" in fields:
+            for it in read_installments(snap):
+                d = it.to_dict() or {}
+                if d.get("paid") or not d.get("due_date"):
+                    continue
+                nxt = next_reminder_at(d["due_date"], d.get("last_reminder_sent"), now)
+                # Faltante, o un valor de una ventana ya terminada que el worker releería en cada pasada
+                if "next_reminder_at" in d and (d["next_reminder_at"] is None or nxt is not None):
+                    continue
+                writer.update(it.reference, {"next_reminder_at": nxt})
+                stats.add("next_reminder_at", snap.id)
+        if "shard" in fields and not schedule.is_embedded(ag):
+            # Las cuotas embebidas usan el shard del convenio
+            for it in read_installments(snap):
+                if (it.to_dict() or {}).get("shard") != shard_of(snap.id):
+                    writer.update(it.reference, {"shard": shard_of(snap.id)})
+                    stats.add("installment_shard", snap.id)
+    _run_pages(db, args, fn, writer, stats)
+
+
+# --- blobs huérfanos ---
+
+def _referenced(db, ag_id):
+    # -> rutas usadas por el convenio, o None si no se puede decidir (archivado)
+    ag = db.collection("agreements").document(ag_id).get()
+    if not ag.exists:
+        return None if db.collection("agreements_archive").document(ag_id).get().exists else set()
+    paths = set()
+    for a in ag.reference.collection("attachments").stream():
+        ad = a.to_dict() or {}
+        paths.update(ad[k] for k in ("path", "embed_path", "thumb_path") if ad.get(k))
+    for it in read_installments(ag):
+        if (it.to_dict() or {}).get("receipt_url"):
+            paths.add(it.to_dict()["receipt_url"])
+    return paths
+
+
+def _archive_orphan(db, blob_name):
+    ag_id = blob_name.rsplit("/", 1)[-1].split(".", 1)[0]
+    if db.collection("agreements_archive").document(ag_id).get().exists:
+        return False
+    ag = db.collection("agreements").document(ag_id).get()
+    # Con archived_path el archivado quedó a medias y se retoma con ese archivo
+    return not (ag.exists and (ag.to_dict() or {}).get("archived_path") == blob_name)
+
+
+def cmd_sweep(db, args, stats):
+    from services.archive import ARCHIVE_PREFIX
+    bucket = get_bucket()
+    ckpt = Checkpoint(db, args.cmd, args.dry_run)
+    after = ckpt.load().get("last_id") if args.resume else None
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=args.min_age_hours)
+    # Adjuntos agrupados por convenio (agreements/<id>/...) y archivos de archive/
+    groups = defaultdict(list)
+    for blob in bucket.list_blobs(prefix="agreements/"):
+        groups[blob.name.split("/")[1]].append(blob)
+    archives = list(bucket.list_blobs(prefix=ARCHIVE_PREFIX + "/"))
+
+    def old(blob):
+        return blob.updated is None or blob.updated < cutoff
+
+    def delete(blob):
+        stats.add("orphaned", blob.name)
+        stats.add("orphaned_bytes", n=blob.size or 0)
+        if not args.dry_run:
+            blob.delete()
+
+    def fn(ag_id):
+        refs = _referenced(db, ag_id)
+        if refs is None:
+            stats.add("kept_archived", n=len(groups[ag_id]))
+            return
+        for blob in groups[ag_id]:
+            if blob.name not in refs and old(blob):
+                delete(blob)
+
+    ids = sorted(i for i in groups if after is None or i > after)
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="maintain") as pool:
+        for start in range(0, len(ids), args.page_size):
+            page = ids[start:start + args.page_size]
+            for _ in pool.map(fn, page):
+                pass
+            stats.page(len(page))
+            ckpt.save(last_id=page[-1], docs=stats.docs, status="running")
+        for blob, orphan in zip(archives, pool.map(lambda b: _archive_orphan(db, b.name), archives)):
+            if orphan and old(blob):
+                delete(blob)
+    ckpt.save(last_id=None, status="done")
+
+
+COMMANDS = {"scan": cmd_scan, "recompute": cmd_recompute, "backfill": cmd_backfill, "sweep": cmd_sweep}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Mantenimiento de convenios, cuotas y Storage")
+    ap.add_argument("cmd", choices=sorted(COMMANDS))
+    ap.add_argument("--status", action="append", help="solo convenios en este estado (repetible)")
+    ap.add_argument("--field", action="append", choices=BACKFILL_FIELDS, help="backfill: campo a completar (repetible)")
+    ap.add_argument("--workers", type=int, default=8, help="hilos por página")
+    ap.add_argument("--page-size", type=int, default=200)
+    ap.add_argument("--min-age-hours", type=float, default=24, help="sweep: no tocar blobs más nuevos")
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--resume", action="store_true", help="seguir desde el último checkpoint")
+    args = ap.parse_args(argv)
+    if args.cmd == "scan":
+        args.dry_run = True   # el informe no escribe, tampoco el checkpoint
+
+    init_firebase()
+    db = get_db()
+    stats = Stats()
+    COMMANDS[args.cmd](db, args, stats)
+    print(json.dumps(stats.summary(cmd=args.cmd, dry_run=args.dry_run), ensure_ascii=False, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Migra cronogramas entre la subcolección `installments` y el layout embebido.
+
+    python -m tools.migrate_schedule --to embedded --dry-run      # qué se movería
+    python -m tools.migrate_schedule --to embedded                 # todos los convenios
+    python -m tools.migrate_schedule --to embedded --status ACTIVE --limit 100
+    python -m tools.migrate_schedule --to subcollection --id <convenio>
+
+Cada convenio se migra en un solo batch (cuotas, convenio y evento
+SCHEDULE_MIGRATED), así que cortar a mitad deja convenios enteros en uno u
+otro layout y se puede volver a correr.
+"""
+import argparse
+import json
+
+from core.firebase import init_firebase, get_db
+from services import schedule
+
+
+def _targets(db, args):
+    if args.id:
+        snaps = [db.collection("agreements").document(i).get() for i in args.id]
+        return [s for s in snaps if s.exists]
+    q = db.collection("agreements")
+    if args.status:
+        q = q.where("status", "in", args.status)
+    return list(q.stream())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migra el layout del cronograma de cuotas")
+    parser.add_argument("--to", required=True, choices=[schedule.EMBEDDED, schedule.SUBCOLLECTION])
+    parser.add_argument("--status", action="append", help="solo convenios en este estado (repetible)")
+    parser.add_argument("--id", action="append", help="solo este convenio (repetible)")
+    parser.add_argument("--limit", type=int, default=0, help="como máximo N convenios migrados")
+    parser.add_argument("--actor", default="migrate_schedule")
+    parser.add_argument("--dry-run", action="store_true", help="solo cuenta, no escribe")
+    args = parser.parse_args(argv)
+
+    init_firebase()
+    db = get_db()
+    summary = {"to": args.to, "dry_run": args.dry_run, "migrated": 0, "already": 0, "skipped": []}
+    for snap in _targets(db, args):
+        if args.limit and summary["migrated"] >= args.limit:
+            break
+        if schedule.is_embedded(snap) == (args.to == schedule.EMBEDDED):
+            summary["already"] += 1
+            continue
+        if args.to == schedule.EMBEDDED and int((snap.to_dict() or {}).get("installments") or 0) > schedule.EMBED_MAX_ROWS:
+            summary["skipped"].append(snap.id)
+            continue
+        if not args.dry_run:
+            fn = schedule.to_embedded if args.to == schedule.EMBEDDED else schedule.to_subcollection
+            if not fn(db, snap, actor=args.actor):
+                summary["skipped"].append(snap.id)
+                continue
+        summary["migrated"] += 1
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
+import argparse
+import json
 import os
-from datetime import datetime, date
-import pytz
+import socket
+import time
+import uuid
+from datetime import datetime, date, timedelta, timezone
 
 try:
     import streamlit as st
 except Exception:
     st = None
 
-from core.firebase import init_firebase, get_db
+from core.firebase import init_firebase, get_db, run_transaction
+from core import loader, tracing
 from core.mail import send_email
+from services.reminders import TZ, SHARD_BUCKETS, next_reminder_at, shard_buckets, should_remind
+from services import schedule
 
 def _get(name, default=None):
     if st is not None:
@@ -20,68 +27,268 @@ def _get(name, default=None):
     return os.environ.get(name, default)
 
 APP_BASE_URL = _get("APP_BASE_URL","https://example.com")
-APP_TZ = _get("APP_TZ","America/Argentina/Buenos_Aires")
-REMINDER_DAYS_BEFORE = int(_get("REMINDER_DAYS_BEFORE",3))
-REMINDER_DAYS_AFTER  = int(_get("REMINDER_DAYS_AFTER",3))
-REMINDER_COOLDOWN_DAYS = int(_get("REMINDER_COOLDOWN_DAYS",3))
-TZ = pytz.timezone(APP_TZ)
-
-def _today() -> date: return datetime.now(TZ).date()
-
-def _should_remind(due: date, last_sent, today: date) -> bool:
-    days = (due - today).days
-    if days < 0 and abs(days) > REMINDER_DAYS_AFTER: return False
-    if days > 0 and days > REMINDER_DAYS_BEFORE: return False
-    if last_sent is None: return True
-    delta = datetime.now(TZ) - last_sent
+CLOSED_STATUSES = {"COMPLETED", "CANCELLED", "REJECTED"}
+LEASE_SECONDS = int(_get("REMINDER_LEASE_SECONDS", 600))
+CHECKPOINT_EVERY = int(_get("REMINDER_CHECKPOINT_EVERY", 25))
+LOOKUP_BATCH = int(_get("REMINDER_LOOKUP_BATCH", 100))   # cuotas por get_all de convenios/clientes
+
+def parse_shard(value: str):
     try:
-        # last_sent puede ser Firestore Timestamp
-        delta_days = (delta.days if hasattr(delta,"days") else 9999)
+        i, n = (int(x) for x in value.split("/"))
     except Exception:
-        delta_days = 9999
-    return delta_days >= REMINDER_COOLDOWN_DAYS
+        raise argparse.ArgumentTypeError("Formato esperado: i/N (por ejemplo 0/4)")
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError("Se requiere 0 <= i < N")
+    if n > SHARD_BUCKETS:
+        raise argparse.ArgumentTypeError(f"N no puede superar {SHARD_BUCKETS}")
+    return i, n
+
+def _sharded(q, shard, shards):
+    # El filtro va en la consulta (campo shard, índice compuesto con next_reminder_at):
+    # cada shard lee solo sus cuotas. Con un solo shard no se filtra, así que
+    # los documentos sin shard (anteriores al backfill) se procesan igual.
+    return q if shards == 1 else q.where("shard", "in", shard_buckets(shard, shards))
+
+def _acquire_lease(db, ref, owner, now):
+    def fn(tx):
+        snap = tx.get(ref)
+        d = (snap.to_dict() or {}) if snap.exists else {}
+        if d.get("owner") not in (None, owner) and d.get("expires_at") and d["expires_at"] > now:
+            return False
+        tx.set(ref, {"owner": owner, "acquired_at": now,
+                     "expires_at": now + timedelta(seconds=LEASE_SECONDS)})
+        return True
+    return run_transaction(db, fn)
+
+def _renew_lease(db, ref, owner):
+    def fn(tx):
+        snap = tx.get(ref)
+        if not snap.exists or (snap.to_dict() or {}).get("owner") != owner:
+            return False
+        tx.update(ref, {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=LEASE_SECONDS)})
+        return True
+    return run_transaction(db, fn)
+
+def _release_lease(db, ref, owner):
+    def fn(tx):
+        snap = tx.get(ref)
+        if snap.exists and (snap.to_dict() or {}).get("owner") == owner:
+            tx.delete(ref)
+    run_transaction(db, fn)
+
+def _client_email(db, ag):
+    return (loader.user(db, ag.get("client_id")) or {}).get("email") or ag.get("client_email")
+
+def _prefetch(db, chunk):
+    # Convenios del bloque y luego sus clientes: dos get_all en vez de dos get por cuota
+    ags = loader.current().get_many(db, [ag_ref for _, d, ag_ref in chunk if not d.get("paid")])
+    clients = {(a.to_dict() or {}).get("client_id") for a in ags
+               if a.exists and (a.to_dict() or {}).get("status") == "ACTIVE"}
+    loader.current().get_many(db, [db.collection("users").document(uid) for uid in clients if uid])
+
+def _message(d, due, today, ag_id):
+    days_to_due = (due - today).days
+    if days_to_due > 0:
+        subject = f"Recordatorio: cuota #{d.get('number')} vence el {due.isoformat()} (Convenio #{ag_id})"
+        html = f"<h3>Recordatorio de vencimiento</h3><p>Vence el <b>{due.isoformat()}</b> (en {days_to_due} días).</p><p>Acceso: {APP_BASE_URL}</p>"
+    elif days_to_due == 0:
+        subject = f"Vence hoy la cuota #{d.get('number')} (Convenio #{ag_id})"
+        html = f"<h3>Vencimiento hoy</h3><p>Hoy vence esta cuota.</p><p>Acceso: {APP_BASE_URL}</p>"
+    else:
+        subject = f"Aviso: cuota #{d.get('number')} vencida (Convenio #{ag_id})"
+        html = f"<h3>Cuota vencida</h3><p>Venció el <b>{due.isoformat()}</b>.</p><p>Acceso: {APP_BASE_URL}</p>"
+    return subject, html
+
+def run_reminders(shard: int = 0, shards: int = 1):
+    with tracing.span("reminders.run", shard=f"{shard}/{shards}") as sp:
+        res = _run_reminders(shard, shards)
+        sp.set(status=res["status"], checked=res["checked"], sent=res["sent"])
+        return res
 
-def run_reminders():
+def _run_reminders(shard, shards):
+    t_start = time.perf_counter()
+    timings = {"lease": 0.0, "query": 0.0, "prepare": 0.0, "send": 0.0, "write": 0.0}
     init_firebase()
     db = get_db()
-    today = _today()
+    now = datetime.now(timezone.utc)
+    today = now.astimezone(TZ).date()
+    name = f"reminders-{shard}-of-{shards}"
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    lease_ref = db.collection("worker_leases").document(name)
+    ckpt_ref = db.collection("worker_checkpoints").document(name)
+    summary = {"shard": f"{shard}/{shards}", "owner": owner, "started_at": now.isoformat()}
 
+    t0 = time.perf_counter()
+    with tracing.span("reminders.lease") as sp:
+        acquired = _acquire_lease(db, lease_ref, owner, now)
+        sp.set(acquired=acquired)
+    if not acquired:
+        # Otra ejecución del mismo shard tiene el lease vigente: no duplicar envíos
+        timings["lease"] += time.perf_counter() - t0
+        return {**summary, "status": "locked", "checked": 0, "sent": 0,
+                "timings_ms": {k: round(v * 1000, 1) for k, v in timings.items()}}
+    timings["lease"] += time.perf_counter() - t0
+
+    # Si la corrida anterior quedó a medias, se retoma desde su cursor
+    ckpt = ckpt_ref.get()
+    ck = (ckpt.to_dict() or {}) if ckpt.exists else {}
+    resumed = ck.get("status") == "running"
+    run_id = ck["run_id"] if resumed else uuid.uuid4().hex
+    checked = ck.get("checked", 0) if resumed else 0
+    sent = ck.get("sent", 0) if resumed else 0
+    cursor = ck.get("cursor") if resumed else None
+    ckpt_ref.set({"run_id": run_id, "status": "running", "owner": owner, "checked": checked,
+                  "sent": sent, "cursor": cursor, "started_at": ck.get("started_at", now) if resumed else now,
+                  "updated_at": now})
+
+    # Solo las cuotas cuyo próximo aviso ya venció: el costo es proporcional
+    # a los recordatorios pendientes, no al tamaño de la cartera.
+    due_q = _sharded(db.collection_group("installments"), shard, shards)
+    due_q = due_q.where("next_reminder_at","<=",now).order_by("next_reminder_at")
+    if cursor:
+        due_q = due_q.start_at({"next_reminder_at": cursor["next_reminder_at"]})
+    loader.begin()
+    processed = 0
+    status = "done"
+
+    def checkpoint(checked, sent, cursor):
+        # -> False si el lease pasó a otra corrida: hay que dejar de enviar
+        with tracing.span("reminders.checkpoint", checked=checked, sent=sent):
+            ckpt_ref.update({"checked": checked, "sent": sent, "cursor": cursor,
+                             "updated_at": datetime.now(timezone.utc)})
+            t1 = time.perf_counter()
+            ok = _renew_lease(db, lease_ref, owner)
+            timings["lease"] += time.perf_counter() - t1
+            return ok
+    try:
+        it_stream = iter(due_q.stream())
+        exhausted = False
+        while not exhausted and status == "done":
+            # Se lee un bloque de cuotas, se resuelven sus lecturas en lote y se procesa
+            chunk = []
+            t0 = time.perf_counter()
+            with tracing.span("reminders.query") as sp:
+                while len(chunk) < LOOKUP_BATCH:
+                    it = next(it_stream, None)
+                    if it is None:
+                        exhausted = True; break
+                    d = it.to_dict() or {}
+                    path = it.reference.path
+                    if cursor and d.get("next_reminder_at") == cursor["next_reminder_at"] and path <= cursor["path"]:
+                        continue
+                    chunk.append((it, d, it.reference.parent.parent))
+                sp.set(items=len(chunk))
+            timings["query"] += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            with tracing.span("reminders.prefetch", items=len(chunk)):
+                _prefetch(db, chunk)
+            timings["prepare"] += time.perf_counter() - t0
+            for it, d, ag_ref in chunk:
+                checked += 1; processed += 1
+                with tracing.span("reminders.item", agreement_id=ag_ref.id, installment=d.get("number")) as sp:
+                    n = _process(db, it, d, ag_ref, now, today, timings)
+                    sp.set(sent=n)
+                sent += n
+                cursor = {"next_reminder_at": d.get("next_reminder_at"), "path": it.reference.path}
+                if processed % CHECKPOINT_EVERY == 0 and not checkpoint(checked, sent, cursor):
+                    status = "lease_lost"; break
+        if status == "done":
+            base = (checked, sent)
+            n_checked, n_sent, status = _run_embedded(
+                db, shard, shards, now, today, timings,
+                lambda c, n: checkpoint(base[0] + c, base[1] + n, cursor))
+            checked += n_checked; sent += n_sent
+    except BaseException:
+        # El checkpoint queda en "running" con el último cursor: la próxima
+        # corrida del shard retoma desde ahí
+        status = "failed"
+        raise
+    finally:
+        if status != "failed":
+            ckpt_ref.update({"status": status, "checked": checked, "sent": sent,
+                             "cursor": None if status == "done" else cursor,
+                             "finished_at": datetime.now(timezone.utc)})
+        if status != "lease_lost":
+            _release_lease(db, lease_ref, owner)
+    timings["total"] = time.perf_counter() - t_start
+    return {**summary, "status": status, "run_id": run_id, "resumed": resumed,
+            "checked": checked, "sent": sent,
+            "timings_ms": {k: round(v * 1000, 1) for k, v in timings.items()}}
+
+def _run_embedded(db, shard, shards, now, today, timings, checkpoint):
+    # Convenios con cronograma embebido: no aparecen en el collection_group,
+    # pero llevan el menor next_reminder_at de sus cuotas. Sin cursor: cada
+    # envío corre next_reminder_at, así que repetir la pasada no reenvía. El
+    # lease se renueva igual cada CHECKPOINT_EVERY cuotas.
     checked = sent = 0
-    for ag_doc in db.collection("agreements").where("status","==","ACTIVE").stream():
-        ag = ag_doc.to_dict() or {}
-        client_email = ag.get("client_email")
-        if ag.get("client_id"):
-            cl = db.collection("users").document(ag["client_id"]).get()
-            if cl.exists:
-                client_email = (cl.to_dict() or {}).get("email") or client_email
-
-        if not client_email: continue
-
-        for it in ag_doc.reference.collection("installments").where("paid","==",False).stream():
-            d = it.to_dict() or {}
-            try:
-                due = date.fromisoformat(d["due_date"])
-            except Exception:
-                continue
-            last_sent = d.get("last_reminder_sent")
-            if not _should_remind(due, last_sent, today):
-                continue
-            days_to_due = (due - today).days
-            if days_to_due > 0:
-                subject = f"Recordatorio: cuota #{d.get('number')} vence el {due.isoformat()} (Convenio #{ag_doc.id})"
-                html = f"<h3>Recordatorio de vencimiento</h3><p>Vence el <b>{due.isoformat()}</b> (en {days_to_due} días).</p><p>Acceso: {APP_BASE_URL}</p>"
-            elif days_to_due == 0:
-                subject = f"Vence hoy la cuota #{d.get('number')} (Convenio #{ag_doc.id})"
-                html = f"<h3>Vencimiento hoy</h3><p>Hoy vence esta cuota.</p><p>Acceso: {APP_BASE_URL}</p>"
-            else:
-                subject = f"Aviso: cuota #{d.get('number')} vencida (Convenio #{ag_doc.id})"
-                html = f"<h3>Cuota vencida</h3><p>Venció el <b>{due.isoformat()}</b>.</p><p>Acceso: {APP_BASE_URL}</p>"
-
-            send_email(client_email, subject, html)
-            it.reference.update({"last_reminder_sent": datetime.now()})
-            sent += 1; checked += 1
-    return {"checked": checked, "sent": sent}
+    status = "done"
+    with tracing.span("reminders.embedded") as sp:
+        ag_q = _sharded(db.collection("agreements"), shard, shards).where("next_reminder_at", "<=", now)
+        for ag_doc in ag_q.stream():
+            loader.current().prime(ag_doc)
+            for it in schedule.rows(ag_doc):
+                d = it.to_dict()
+                if d.get("next_reminder_at") is None or d["next_reminder_at"] > now:
+                    continue
+                checked += 1
+                with tracing.span("reminders.item", agreement_id=ag_doc.id, installment=d.get("number")) as isp:
+                    n = _process(db, it, d, ag_doc.reference, now, today, timings)
+                    isp.set(sent=n)
+                sent += n
+                if checked % CHECKPOINT_EVERY == 0 and not checkpoint(checked, sent):
+                    status = "lease_lost"; break
+            if status != "done":
+                break
+        sp.set(checked=checked, sent=sent, status=status)
+    return checked, sent, status
+
+def _process(db, it, d, ag_ref, now, today, timings):
+    t0 = time.perf_counter()
+    try:
+        if d.get("paid"):
+            it.reference.update({"next_reminder_at": None}); return 0
+        ag_doc = loader.current().get(ag_ref)
+        ag = (ag_doc.to_dict() or {}) if ag_doc.exists else {}
+        client_email = _client_email(db, ag) if ag.get("status") == "ACTIVE" else None
+        if ag.get("status") != "ACTIVE":
+            # Borradores/pendientes conservan el índice hasta ser aceptados
+            if not ag or ag.get("status") in CLOSED_STATUSES:
+                it.reference.update({"next_reminder_at": None})
+            return 0
+        if not client_email: return 0
+        try:
+            due = date.fromisoformat(d["due_date"])
+        except Exception:
+            it.reference.update({"next_reminder_at": None}); return 0
+        last_sent = d.get("last_reminder_sent")
+        if not should_remind(due, last_sent, now):
+            # Se corre hacia adelante o se limpia (ventana terminada): nunca se reescribe el mismo valor
+            nxt = next_reminder_at(due, last_sent, now)
+            if nxt != d.get("next_reminder_at"):
+                it.reference.update({"next_reminder_at": nxt})
+            return 0
+    finally:
+        timings["prepare"] += time.perf_counter() - t0
+    subject, html = _message(d, due, today, ag_ref.id)
+    t0 = time.perf_counter()
+    send_email(client_email, subject, html)
+    timings["send"] += time.perf_counter() - t0
+    t0 = time.perf_counter()
+    it.reference.update({"last_reminder_sent": now, "next_reminder_at": next_reminder_at(due, now, now)})
+    timings["write"] += time.perf_counter() - t0
+    return 1
 
 if __name__=="__main__":
-    res = run_reminders()
-    print(f"[send_reminders] Procesadas: {res['checked']} · Enviadas: {res['sent']}")
+    parser = argparse.ArgumentParser(description="Envía recordatorios de cuotas")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1), help="i/N: procesa solo el shard i de N")
+    parser.add_argument("--backfill", action="store_true",
+                        help="solo indexa next_reminder_at en cuotas antiguas (= tools.maintain backfill) y sale")
+    args = parser.parse_args()
+    if args.backfill:
+        # Una sola implementación del backfill; indexar no envía nada
+        from tools import maintain
+        maintain.main(["backfill", "--field", "next_reminder_at"])
+        raise SystemExit(0)
+    res = run_reminders(*args.shard)
+    print(f"[send_reminders] Shard {res['shard']} · {res['status']} · Procesadas: {res['checked']} · Enviadas: {res['sent']}")
+    print(json.dumps(res, default=str))